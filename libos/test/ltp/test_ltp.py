@@ -4,18 +4,28 @@
 # Copyright (C) 2021 Intel Corporation
 #                    Paweł Marczewski <pawel@invisiblethingslab.com>
 
+import argparse
+import concurrent.futures
 import configparser
 import fnmatch
+import glob
+import heapq
+import json
 import logging
 import os
 import pathlib
+import re
 import shlex
+import statistics
 import subprocess
 import sys
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
 
 import pytest
 
-from graminelibos.regression import HAS_SGX, run_command
+from graminelibos.regression import HAS_SGX, get_timing_db, run_command
 
 DEFAULT_LTP_SCENARIO = 'install/runtest/syscalls'
 DEFAULT_LTP_CONFIG = 'ltp.cfg'
@@ -25,6 +35,12 @@ if HAS_SGX:
 LTP_SCENARIO = os.environ.get('LTP_SCENARIO', DEFAULT_LTP_SCENARIO)
 LTP_CONFIG = os.environ.get('LTP_CONFIG', DEFAULT_LTP_CONFIG).split(' ')
 LTP_TIMEOUT_FACTOR = float(os.environ.get('LTP_TIMEOUT_FACTOR', '1'))
+LTP_SHARD = os.environ.get('LTP_SHARD')
+LTP_DURATIONS = os.environ.get('LTP_DURATIONS', '').split()
+
+# Default `sgx.enclave_size` (not overridden in `manifest.template`), used for estimating how many
+# tests fit in EPC at the same time
+SGX_ENCLAVE_SIZE = 256 * 1024 * 1024
 
 
 def read_scenario(scenario):
@@ -104,12 +120,99 @@ class Config:
         return self.cfg[self.cfg.default_section]
 
 
-def list_tests(ltp_config=LTP_CONFIG, ltp_scenario=LTP_SCENARIO):
-    """List all tests along with their configuration."""
+def parse_shard(value):
+    """Parse a shard specification (`K/N`, i.e. K-th of N shards, counting from 1).
+
+    Returns a tuple (K, N), or None if `value` is empty.
+    """
+
+    if not value:
+        return None
+    match = re.fullmatch(r'(\d+)/(\d+)', value)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise ValueError(f'invalid shard {value!r}, expected K/N (with 1 <= K <= N)')
+    return int(match.group(1)), int(match.group(2))
+
+
+def read_durations(paths):
+    """Read test durations (in seconds) from previous runs.
+
+    The files can be JUnit XML reports written by Pytest (`--junit-xml`), or JSON files mapping
+    tags to durations. Wildcards are expanded. If a test is in many files, the last one wins.
+    """
+
+    durations = {}
+    for pattern in paths:
+        for path in sorted(glob.glob(pattern)):
+            if path.endswith('.json'):
+                with open(path, 'r', encoding='utf-8') as f:
+                    durations.update(json.load(f))
+                continue
+
+            for testcase in ET.parse(path).iter('testcase'):
+                match = re.fullmatch(r'test_ltp\[(.*)\]', testcase.get('name', ''))
+                if match:
+                    durations[match.group(1)] = float(testcase.get('time', 0))
+    return durations
+
+
+def read_timing_db_durations():
+    """Read test durations recorded by `run_command` in the timing database."""
+
+    timing_db = get_timing_db()
+    if not timing_db:
+        return {}
+
+    durations = {}
+    for test, duration in timing_db.get_durations().items():
+        match = re.fullmatch(r'.*::test_ltp\[(.*)\]', test)
+        if match:
+            durations[match.group(1)] = duration
+    return durations
 
-    config = Config(ltp_config)
 
-    for tag, cmd in read_scenario(ltp_scenario):
+def assign_shards(tags, shard_count, durations):
+    """Split tests into shards with similar total duration.
+
+    Tests are assigned from the longest one, each to the shard with the shortest total duration so
+    far. Tests not present in `durations` are assumed to take the median time.
+
+    The assignment depends only on the list of tags and durations (and not on which tests are
+    skipped), so that it's the same when building manifests and when running tests in different
+    configurations.
+
+    Returns a dict mapping tags to shard numbers (counting from 1).
+    """
+
+    known = [durations[tag] for tag in tags if tag in durations]
+    default = statistics.median(known) if known else 1.0
+
+    loads = [(0.0, shard) for shard in range(1, shard_count + 1)]
+    shards = {}
+    for tag in sorted(set(tags), key=lambda tag: (-durations.get(tag, default), tag)):
+        load, shard = heapq.heappop(loads)
+        shards[tag] = shard
+        heapq.heappush(loads, (load + durations.get(tag, default), shard))
+    return shards
+
+
+def list_tests(ltp_config=LTP_CONFIG, ltp_scenario=LTP_SCENARIO, shard=LTP_SHARD):
+    """List all tests (or only tests in given shard) along with their configuration."""
+
+    config = Config(ltp_config)
+    scenario = list(read_scenario(ltp_scenario))
+
+    tags_in_shard = None
+    shard = parse_shard(shard)
+    if shard:
+        index, count = shard
+        shards = assign_shards([tag for tag, _cmd in scenario], count,
+                               read_durations(LTP_DURATIONS))
+        tags_in_shard = {tag for tag, tag_shard in shards.items() if tag_shard == index}
+
+    for tag, cmd in scenario:
+        if tags_in_shard is not None and tag not in tags_in_shard:
+            continue
         section = config.get(tag)
         yield tag, cmd, section
 
@@ -211,12 +314,40 @@ def test_ltp(cmd, section):
 
 
 def test_lint():
+    shard = parse_shard(LTP_SHARD)
+    if shard and shard[0] != 1:
+        pytest.skip('run only in the first shard')
+
     cmd = ['./contrib/conf_lint.py', '--scenario', LTP_SCENARIO, *LTP_CONFIG]
     p = subprocess.run(cmd)
     if p.returncode:
         pytest.fail('conf_lint.py failed, see stdout for details')
 
 
+def test_assign_shards():
+    shard = parse_shard(LTP_SHARD)
+    if shard and shard[0] != 1:
+        pytest.skip('run only in the first shard')
+
+    durations = {'a': 5, 'b': 4, 'c': 3, 'd': 3, 'e': 2, 'f': 1}
+    tags = list(durations)
+
+    # longest first, each to the least loaded shard: 5+3+1 and 4+3+2
+    expected = {'a': 1, 'b': 2, 'c': 2, 'd': 1, 'e': 2, 'f': 1}
+    assert assign_shards(tags, 2, durations) == expected
+    # the order of tags (and duplicates) don't matter
+    assert assign_shards([*reversed(tags), 'a'], 2, durations) == expected
+
+    # unknown tests take the median time (3), and ties are broken by the shard number
+    assert assign_shards([*tags, 'x'], 2, durations) == {
+        'a': 1, 'b': 2, 'c': 2, 'd': 1, 'x': 2, 'e': 1, 'f': 1,
+    }
+    assert assign_shards(['x', 'y'], 2, {}) == {'x': 1, 'y': 2}
+
+    assert assign_shards(tags, 1, durations) == {tag: 1 for tag in tags}
+    assert sorted(assign_shards(tags, 10, durations).values()) == [1, 2, 3, 4, 5, 6]
+
+
 def pytest_generate_tests(metafunc):
     """Generate all tests.
 
@@ -232,34 +363,138 @@ def pytest_generate_tests(metafunc):
             marks = [] if section else [pytest.mark.skip]
             params.append(pytest.param(cmd, section, id=tag, marks=marks))
 
+        # Run the slowest tests first, so that they don't delay the end of a parallel run
+        if LTP_DURATIONS:
+            durations = read_durations(LTP_DURATIONS)
+        else:
+            durations = read_timing_db_durations()
+        params.sort(key=lambda param: -durations.get(param.id, 0))
+
         metafunc.parametrize('cmd,section', params)
 
 
-def main():
-    if sys.argv[1:] == ['--list']:
-        seen = set()
-        for _tag, cmd, section in list_tests():
-            executable = cmd[0]
-            if section and executable not in seen:
-                seen.add(executable)
-                print(executable)
-    else:
-        usage = '''\
-Usage:
+def get_epc_size():
+    """Return the total size of EPC in bytes (as reported by the kernel), or 0 if unknown."""
+
+    size = 0
+    for path in glob.glob('/sys/devices/system/node/node*/x86/sgx_total_bytes'):
+        with open(path, 'r', encoding='utf-8') as f:
+            size += int(f.read())
+    return size
+
+
+def get_default_jobs():
+    """Return the number of shards to run concurrently.
 
-    {} --list   (to list test executables)
+    This is the number of CPUs, and under SGX, additionally the number of enclaves that fit in EPC
+    (or 1 if the EPC size is unknown).
+    """
+
+    jobs = os.cpu_count() or 1
+    if HAS_SGX:
+        jobs = min(jobs, max(1, get_epc_size() // SGX_ENCLAVE_SIZE))
+    return jobs
+
+
+def run_shards(shard_count, jobs, pytest_args):
+    """Build and run Pytest in `shard_count` shards, at most `jobs` of them at the same time.
 
-Invoke Pytest directly (python3 -m pytest) to run tests.
+    Before running the tests of a shard, its manifests are built using `gramine-test build`. The
+    builds run one at a time (they share the build directory), but can overlap with the tests of
+    other shards.
 
+    Output (of both the build and the tests) and JUnit XML report of the K-th shard are written to
+    `ltp-shard-K.log` and `ltp-shard-K.xml`.
+
+    Returns True if all shards passed.
+    """
+
+    # The reports (and the timing database) are updated while the shards run, so pass a snapshot of
+    # the durations to the shards: all of them have to use the same assignment of tests.
+    if LTP_DURATIONS:
+        durations = read_durations(LTP_DURATIONS)
+    else:
+        durations = read_timing_db_durations()
+    with tempfile.NamedTemporaryFile('w', prefix='ltp-durations-', suffix='.json') as f:
+        json.dump(durations, f)
+        f.flush()
+
+        build_lock = threading.Lock()
+
+        def run_shard(index):
+            env = dict(os.environ, LTP_SHARD=f'{index}/{shard_count}', LTP_DURATIONS=f.name)
+            cmd = [sys.executable, '-m', 'pytest', '-v', f'--junit-xml=ltp-shard-{index}.xml',
+                   *pytest_args]
+            with open(f'ltp-shard-{index}.log', 'w', encoding='utf-8') as log:
+                with build_lock:
+                    returncode = subprocess.run(['gramine-test', 'build'], env=env, stdout=log,
+                                                stderr=subprocess.STDOUT, check=False).returncode
+                if returncode != 0:
+                    return returncode
+                return subprocess.run(cmd, env=env, stdout=log, stderr=subprocess.STDOUT,
+                                      check=False).returncode
+
+        success = True
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(run_shard, index): index
+                       for index in range(1, shard_count + 1)}
+            for future in concurrent.futures.as_completed(futures):
+                index = futures[future]
+                returncode = future.result()
+                if returncode == 0:
+                    status = 'passed'
+                else:
+                    status = f'failed (exit status {returncode})'
+                print(f'shard {index}/{shard_count}: {status}, see ltp-shard-{index}.log')
+                success = success and returncode == 0
+    return success
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='List LTP test executables, or run tests in parallel shards. Invoke Pytest '
+                    'directly (python3 -m pytest) to run tests in a single process.',
+        epilog=f'''\
 Supports the following environment variables:
 
     SGX: set to 1 to enable SGX mode (default: disabled)
-    LTP_SCENARIO: LTP scenario file (default: {})
-    LTP_CONFIG: space-separated list of LTP config files (default: {})
+    LTP_SCENARIO: LTP scenario file (default: {DEFAULT_LTP_SCENARIO})
+    LTP_CONFIG: space-separated list of LTP config files (default: {DEFAULT_LTP_CONFIG})
     LTP_TIMEOUT_FACTOR: multiply all timeouts by given value
-'''.format(sys.argv[0], DEFAULT_LTP_SCENARIO, DEFAULT_LTP_CONFIG)
-        print(usage, file=sys.stderr)
-        sys.exit(1)
+    LTP_SHARD: only list or run tests in given shard (K/N: K-th of N shards)
+    LTP_DURATIONS: space-separated list of files with durations from previous runs (JUnit XML
+                   reports, or JSON), used to balance the shards (with --run-shards, the timing
+                   database is used if not set)
+    GRAMINE_TEST_RECORD_TIMINGS: set to 1 to record durations of tests in the timing database
+    GRAMINE_TEST_ADAPTIVE_TIMEOUTS: set to 1 to derive timeouts from previous runs (implies
+                                    GRAMINE_TEST_RECORD_TIMINGS=1)
+''')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--list', action='store_true',
+                       help='list test executables')
+    group.add_argument('--run-shards', type=int, metavar='N',
+                       help='build the manifests and run tests in N shards, using a separate '
+                            'instance of Pytest for each')
+    parser.add_argument('--jobs', '-j', type=int,
+                        help='number of shards to run at the same time (default: number of CPUs, '
+                             'under SGX also limited by EPC size)')
+    parser.add_argument('pytest_args', nargs='*', metavar='PYTEST_ARG',
+                        help='additional arguments for Pytest (after "--")')
+    args = parser.parse_args(args)
+
+    if args.list:
+        seen = set()
+        for _tag, cmd, section in list_tests():
+            executable = cmd[0]
+            if section and executable not in seen:
+                seen.add(executable)
+                print(executable)
+    else:
+        if args.run_shards < 1:
+            parser.error('--run-shards must be at least 1')
+        if not run_shards(args.run_shards, args.jobs or get_default_jobs(), args.pytest_args):
+            sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -341,13 +341,12 @@ class TC_01_Bootstrap(RegressionTestCase):
             self.run_binary(['exit'])
 
     def test_401_exit_group(self):
-        for thread_idx in range(4):
-            exit_code = 100 + thread_idx
-            try:
-                self.run_binary(['exit_group', str(thread_idx), str(exit_code)])
-                self.fail('exit_group returned 0 instead of {}'.format(exit_code))
-            except subprocess.CalledProcessError as e:
-                self.assertEqual(e.returncode, exit_code)
+        # the runs are independent, so launch them at the same time
+        results = self.run_binaries(
+            [['exit_group', str(thread_idx), str(100 + thread_idx)] for thread_idx in range(4)],
+            can_fail=True)
+        for thread_idx, (returncode, _stdout, _stderr) in enumerate(results):
+            self.assertEqual(returncode, 100 + thread_idx)
 
     def test_402_signalexit(self):
         with self.expect_returncode(134):
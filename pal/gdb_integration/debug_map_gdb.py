@@ -26,6 +26,11 @@ except ImportError:
 # enough for GDB to load all the sections. When we can depend on it, we will be able to stop parsing
 # the ELF file here.
 
+# Sections of ELF files loaded so far: {file_name: (mtime, [(name, addr)])}, with addresses not
+# adjusted by load address. Used so that we don't parse the same file again on every update.
+elf_sections_cache = {}
+
+
 def load_elf_sections(file_name, load_addr):
     '''
     Open an ELF file and determine a list of sections along with addresses.
@@ -33,26 +38,56 @@ def load_elf_sections(file_name, load_addr):
     Returns a list of (name, addr) elements.
     '''
 
-    if not os.path.exists(file_name):
+    try:
+        mtime = os.stat(file_name).st_mtime_ns
+    except FileNotFoundError:
         print('file not found: {}'.format(file_name))
-        return {}
+        return []
+
+    cached = elf_sections_cache.get(file_name)
+    if cached is not None and cached[0] == mtime:
+        sections = cached[1]
+    else:
+        sections = []
+        with open(file_name, 'rb') as f:
+            elf = ELFFile(f)
+
+            for section in elf.iter_sections():
+                if section.name and section.header['sh_addr']:
+                    # Workaround for old version of pyelftools (Ubuntu 16)
+                    # that stores section.name as bytes.
+                    name = section.name
+                    if isinstance(name, bytes):
+                        name = name.decode('ascii')
 
-    sections = []
-    with open(file_name, 'rb') as f:
-        elf = ELFFile(f)
+                    sections.append((name, section.header['sh_addr']))
 
-        for section in elf.iter_sections():
-            if section.name and section.header['sh_addr']:
-                # Workaround for old version of pyelftools (Ubuntu 16)
-                # that stores section.name as bytes.
-                name = section.name
-                if isinstance(name, bytes):
-                    name = name.decode('ascii')
+        elf_sections_cache[file_name] = (mtime, sections)
 
-                addr = load_addr + section.header['sh_addr']
-                sections.append((name, addr))
+    return [(name, load_addr + addr) for name, addr in sections]
+
+
+def get_debug_map(file_name, load_addr):
+    '''
+    Determine the debug map for a file loaded at given address. Returns a tuple
+    (file_name, text_addr, [(name, addr)]), or None if the file cannot be loaded.
+    '''
 
-    return sections
+    if file_name.startswith('['):
+        # This is vDSO, not a real file.
+        return (file_name, load_addr, [])
+
+    file_name = os.path.abspath(file_name)
+    sections = load_elf_sections(file_name, load_addr)
+    text_addr = None
+    for name, addr in sections:
+        if name == '.text':
+            text_addr = addr
+            break
+    # We need the text_addr to use add-symbol-file (at least until GDB 8.2).
+    if text_addr is None:
+        return None
+    return (file_name, text_addr, sections)
 
 
 def retrieve_debug_maps():
@@ -69,26 +104,60 @@ def retrieve_debug_maps():
         file_name = val_map['name'].string()
         load_addr = int(val_map['addr'])
 
-        if file_name.startswith('['):
-            # This is vDSO, not a real file.
-            debug_maps[load_addr] = (file_name, load_addr, [])
-        else:
-            file_name = os.path.abspath(file_name)
-            sections = load_elf_sections(file_name, load_addr)
-            text_addr = None
-            for name, addr in sections:
-                if name == '.text':
-                    text_addr = addr
-                    break
-            # We need the text_addr to use add-symbol-file (at least until GDB 8.2).
-            if text_addr is not None:
-                debug_maps[load_addr] = (file_name, text_addr, sections)
+        debug_map = get_debug_map(file_name, load_addr)
+        if debug_map is not None:
+            debug_maps[load_addr] = debug_map
 
         val_map = val_map['next']
 
     return debug_maps
 
 
+def retrieve_debug_map_generation():
+    '''
+    Retrieve the number of changes made to the debug maps by the inferior process so far. Returns
+    None if the process doesn't keep a log of changes (i.e. it uses an older version of Gramine).
+    '''
+
+    try:
+        return int(gdb.parse_and_eval('g_debug_map_generation'))
+    except gdb.error:
+        return None
+
+
+def retrieve_debug_map_changes(start, end):
+    '''
+    Retrieve changes to the debug maps with generations from `start` to `end` (exclusive) from the
+    log in the inferior process. The result is a dict with the following structure, describing the
+    last change to each map:
+
+    {load_addr: file_name (or None if the map was removed)}
+
+    Returns None if some of the changes are not in the log anymore, or if `end` is before `start`
+    (i.e. the log is not the one that `start` came from).
+    '''
+
+    if end < start:
+        return None
+
+    val_changes = gdb.parse_and_eval('g_debug_map_changes')
+    size = int(gdb.parse_and_eval('sizeof(g_debug_map_changes) / sizeof(g_debug_map_changes[0])'))
+    # The oldest entry might be overwritten by a change that is in progress right now
+    if end - start >= size:
+        return None
+
+    val_names = {}
+    for generation in range(start, end):
+        val_change = val_changes[generation % size]
+        if int(val_change['generation']) != generation:
+            return None
+        val_names[int(val_change['addr'])] = val_change['name']
+
+    # Read the names only now: the name of an added map is freed when the map is removed
+    return {load_addr: (val_name.string() if int(val_name) != 0 else None)
+            for load_addr, val_name in val_names.items()}
+
+
 class UpdateDebugMaps(gdb.Command):
     """Update debug maps for the inferior process."""
 
@@ -105,10 +174,38 @@ class UpdateDebugMaps(gdb.Command):
         progspace = gdb.current_progspace()
         if not hasattr(progspace, 'debug_maps'):
             progspace.debug_maps = {}
+            progspace.debug_map_generation = None
+            progspace.debug_map_pid = None
 
         old = progspace.debug_maps
-        new = retrieve_debug_maps()
-        for load_addr in set(old) | set(new):
+
+        # If possible, process only the maps that changed since the last update. Note that the
+        # generation has to be retrieved before the maps, in case the inferior is in the middle of
+        # changing them. The generation is only meaningful for the process it was retrieved from, so
+        # a new process (e.g. after `run` or `attach`) always gets a full walk.
+        pid = gdb.selected_inferior().pid
+        generation = retrieve_debug_map_generation()
+        changes = None
+        if (generation is not None and progspace.debug_map_generation is not None
+                and progspace.debug_map_pid == pid):
+            changes = retrieve_debug_map_changes(progspace.debug_map_generation, generation)
+
+        if changes is None:
+            new = retrieve_debug_maps()
+            changed_addrs = set(old) | set(new)
+        else:
+            new = dict(old)
+            for load_addr, file_name in changes.items():
+                debug_map = None
+                if file_name is not None:
+                    debug_map = get_debug_map(file_name, load_addr)
+                if debug_map is not None:
+                    new[load_addr] = debug_map
+                else:
+                    new.pop(load_addr, None)
+            changed_addrs = set(changes)
+
+        for load_addr in changed_addrs:
             # Skip unload/reload if the map is unchanged
             if old.get(load_addr) == new.get(load_addr):
                 continue
@@ -149,6 +246,8 @@ class UpdateDebugMaps(gdb.Command):
                     gdb.execute('pop-pagination')
 
         progspace.debug_maps = new
+        progspace.debug_map_generation = generation
+        progspace.debug_map_pid = pid
 
 
 class DebugMapBreakpoint(gdb.Breakpoint):
@@ -175,6 +274,8 @@ def debug_map_clear_objfiles_handler(event):
     # not try to remove them again.
     if hasattr(event.progspace, 'debug_maps'):
         delattr(event.progspace, 'debug_maps')
+        delattr(event.progspace, 'debug_map_generation')
+        delattr(event.progspace, 'debug_map_pid')
 
 
 def main():
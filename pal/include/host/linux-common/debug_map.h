@@ -27,6 +27,24 @@ struct debug_map {
 
 extern struct debug_map* _Atomic g_debug_map;
 
+/*
+ * Log of recent changes to `g_debug_map`, so that GDB can process only the changed maps instead of
+ * walking the whole list on each update. `g_debug_map_generation` is the number of changes made so
+ * far, and the change number `gen` is stored in `g_debug_map_changes[gen % DEBUG_MAP_CHANGES_SIZE]`
+ * (unless it has already been overwritten by a newer one). `name` is the name of the added map
+ * (owned by the map), or NULL if the map was removed.
+ */
+#define DEBUG_MAP_CHANGES_SIZE 64
+
+struct debug_map_change {
+    uint64_t generation;
+    const char* name;
+    void* addr;
+};
+
+extern uint64_t _Atomic g_debug_map_generation;
+extern struct debug_map_change g_debug_map_changes[DEBUG_MAP_CHANGES_SIZE];
+
 /* GDB will set a breakpoint on this function. */
 void debug_map_update_debugger(void);
 
@@ -17,6 +17,9 @@ struct debug_map* _Atomic g_debug_map = NULL;
  * we need to prevent concurrent modification. */
 static spinlock_t g_debug_map_lock = INIT_SPINLOCK_UNLOCKED;
 
+uint64_t _Atomic g_debug_map_generation = 0;
+struct debug_map_change g_debug_map_changes[DEBUG_MAP_CHANGES_SIZE];
+
 static struct debug_map* debug_map_new(const char* name, void* addr) {
     struct debug_map* map;
 
@@ -33,6 +36,19 @@ static struct debug_map* debug_map_new(const char* name, void* addr) {
     return map;
 }
 
+/* Record a change in `g_debug_map_changes`. Has to be called with `g_debug_map_lock` held. */
+static void debug_map_record_change(const char* name, void* addr) {
+    uint64_t generation = g_debug_map_generation;
+
+    struct debug_map_change* change = &g_debug_map_changes[generation % DEBUG_MAP_CHANGES_SIZE];
+    change->generation = generation;
+    change->name = name;
+    change->addr = addr;
+
+    /* Make the change visible to GDB only after it's fully written */
+    g_debug_map_generation = generation + 1;
+}
+
 /* This function is hooked by our gdb integration script and should be left as is. */
 __attribute__((__noinline__)) void debug_map_update_debugger(void) {
     __asm__ volatile(""); // Required in addition to __noinline__ to prevent deleting this function.
@@ -62,6 +78,7 @@ int debug_map_add(const char* name, void* addr) {
 
     map->next = g_debug_map;
     g_debug_map = map;
+    debug_map_record_change(map->name, map->addr);
 
     spinlock_unlock(&g_debug_map_lock);
 
@@ -90,6 +107,7 @@ int debug_map_remove(void* addr) {
     } else {
         g_debug_map = map->next;
     }
+    debug_map_record_change(/*name=*/NULL, map->addr);
 
     spinlock_unlock(&g_debug_map_lock);
 
@@ -1,5 +1,7 @@
 '''Python support for Gramine'''
+import importlib as _importlib
 import os as _os
+import sys as _sys
 
 __version__ = '@VERSION@'
 
@@ -15,12 +17,44 @@ if __version__.startswith('@') and not _os.getenv('GRAMINE_IMPORT_FOR_SPHINX_ANY
         'https://gramine.readthedocs.io/en/latest/devel/building.html.')
 
 # pylint: disable=wrong-import-position
-from .gen_jinja_env import make_env
-
-_env = make_env()
-
 from .manifest import Manifest, ManifestError
+
+# Names below are imported on first use (see __getattr__), because importing them is slow (mostly
+# due to jinja2 and cryptography), and many tools don't need them.
+_LAZY_ATTRS = {}
 if _CONFIG_SGX_ENABLED:
-    from .sgx_get_token import get_token, is_oot
-    from .sgx_sign import get_tbssigstruct, sign_with_local_key, SGX_LIBPAL, SGX_RSA_KEY_PATH
-    from .sigstruct import Sigstruct
+    _LAZY_ATTRS.update({
+        'AesmdClient': 'sgx_get_token',
+        'get_cpu_features': 'sgx_get_token',
+        'get_token': 'sgx_get_token',
+        'get_tokens': 'sgx_get_token',
+        'is_oot': 'sgx_get_token',
+        'get_tbssigstruct': 'sgx_sign',
+        'load_private_key': 'sgx_sign',
+        'sign_manifest': 'sgx_sign',
+        'sign_with_local_key': 'sgx_sign',
+        'sign_with_private_key': 'sgx_sign',
+        'SGX_LIBPAL': 'sgx_sign',
+        'SGX_RSA_KEY_PATH': 'sgx_sign',
+        'Sigstruct': 'sigstruct',
+    })
+
+def __getattr__(name):
+    if name == '_env':
+        # pylint: disable=import-outside-toplevel
+        from .gen_jinja_env import get_env
+        return get_env()
+    if name in _LAZY_ATTRS:
+        value = getattr(_importlib.import_module(f'.{_LAZY_ATTRS[name]}', __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def __dir__():
+    return [*globals(), *_LAZY_ATTRS]
+
+if _sys.version_info < (3, 7):
+    # Module __getattr__ (PEP 562) is not supported, so import everything right away
+    _env = __getattr__('_env')
+    for _name in _LAZY_ATTRS:
+        __getattr__(_name)
@@ -1,39 +1,389 @@
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import itertools
+import json
 import os
 import pathlib
+import platform
+import shutil
+import sqlite3
 import subprocess
 import sys
 import sysconfig
+import threading
+import time
 
+import elftools.common.exceptions
+import elftools.elf.elffile
 import jinja2
 
 from . import _CONFIG_PKGLIBDIR
 
+# Sonames of the dynamic loader itself, which ldd doesn't list as a dependency
+RTLD_SONAMES = frozenset({
+    'ld-linux-x86-64.so.2',
+    'ld-linux.so.2',
+    'ld-linux-aarch64.so.1',
+})
+
+# Files modified less than this many nanoseconds ago are not stored in the on-disk cache
+CACHE_RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+
+def get_cache_dir():
+    '''Get the directory for on-disk caches of Gramine tools.
+
+    This is ``$GRAMINE_CACHE_DIR`` if set (an empty value disables on-disk caches), or
+    ``$XDG_CACHE_HOME/gramine`` otherwise.
+
+    Returns:
+        pathlib.Path: Path to the cache directory or ``None`` if on-disk caches are disabled.
+    '''
+    cache_dir = os.getenv('GRAMINE_CACHE_DIR')
+    if cache_dir is None:
+        cache_dir = pathlib.Path(os.getenv('XDG_CACHE_HOME')
+            or pathlib.Path.home() / '.cache') / 'gramine'
+    return pathlib.Path(cache_dir) if cache_dir else None
+
+ElfInfo = collections.namedtuple('ElfInfo',
+    ('elfclass', 'machine', 'dynamic', 'interp', 'soname', 'needed', 'rpath', 'runpath'))
+
+def read_elf_info(path):
+    with open(path, 'rb') as f:
+        elf = elftools.elf.elffile.ELFFile(f)
+        dynamic = False
+        interp = soname = None
+        needed, rpath, runpath = [], [], []
+        for segment in elf.iter_segments():
+            if segment['p_type'] == 'PT_INTERP':
+                interp = segment.get_interp_name()
+            elif segment['p_type'] == 'PT_DYNAMIC':
+                dynamic = True
+                for tag in segment.iter_tags():
+                    if tag.entry.d_tag == 'DT_NEEDED':
+                        needed.append(tag.needed)
+                    elif tag.entry.d_tag == 'DT_SONAME':
+                        soname = tag.soname
+                    elif tag.entry.d_tag == 'DT_RPATH':
+                        rpath.extend(tag.rpath.split(':'))
+                    elif tag.entry.d_tag == 'DT_RUNPATH':
+                        runpath.extend(tag.runpath.split(':'))
+        return ElfInfo(elf.elfclass, elf['e_machine'], dynamic, interp, soname, needed, rpath,
+            runpath)
+
+class FileInfoCache:
+    '''Cache of information extracted from files.
+
+    Entries are keyed by the path of the file, together with its device, inode number, size and
+    mtime (and an optional extra key). They are kept in memory and, if possible, in
+    ``<name>.sqlite3`` in the directory returned by :py:func:`get_cache_dir`.
+
+    Args:
+        name (str): Name of the cache.
+        compute: Function extracting the information from a file. Gets the path to the file and
+            must return a value which can be serialized to JSON.
+        decode (optional): Function converting the value deserialized from JSON back to the one
+            returned by *compute*.
+        validate (optional): Function checking if the value loaded from the on-disk cache is still
+            valid (for information which also depends on other files).
+    '''
+    def __init__(self, name, compute, decode=None, validate=None):
+        self.name = name
+        self._compute = compute
+        self._decode = decode or (lambda value: value)
+        self._validate = validate or (lambda value: True)
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._db = None
+        self._db_opened = False
+
+    def _get_db(self):
+        # called with self._lock held
+        if not self._db_opened:
+            self._db_opened = True
+            cache_dir = get_cache_dir()
+            if cache_dir is not None:
+                try:
+                    cache_dir.mkdir(parents=True, exist_ok=True)
+                    # sqlite3.connect() accepts path-like objects only since Python 3.7
+                    self._db = sqlite3.connect(os.fspath(cache_dir / f'{self.name}.sqlite3'),
+                        timeout=60, check_same_thread=False)
+                    self._db.execute('PRAGMA journal_mode=WAL')
+                    self._db.execute('''CREATE TABLE IF NOT EXISTS info (
+                        path TEXT, dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+                        extra_key TEXT,
+                        value TEXT,
+                        PRIMARY KEY (path, dev, ino, size, mtime_ns, extra_key)
+                    )''')
+                    self._db.commit()
+                except Exception: # pylint: disable=broad-except
+                    # The cache is only an optimization, so don't fail rendering the manifest if it
+                    # cannot be used for any reason
+                    if self._db is not None:
+                        self._db.close()
+                    self._db = None
+        return self._db
+
+    def get(self, path, extra_key=''):
+        '''Get information about a file.
+
+        Args:
+            path (str): Path to the file.
+            extra_key (:obj:`str`, optional): Additional key of the entry, for information which
+                depends not only on the file.
+
+        Returns:
+            The information, as returned by *compute*.
+
+        Raises:
+            OSError: The file could not be accessed.
+        '''
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, extra_key)
+
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]
+            db = self._get_db()
+            if db is not None:
+                try:
+                    row = db.execute('''SELECT value FROM info WHERE path = ? AND dev = ?
+                        AND ino = ? AND size = ? AND mtime_ns = ? AND extra_key = ?''',
+                        key).fetchone()
+                except sqlite3.Error:
+                    row = None
+                if row is not None:
+                    value = self._decode(json.loads(row[0]))
+                    if self._validate(value):
+                        self._cache[key] = value
+                        return value
+
+        value = self._compute(path)
+
+        with self._lock:
+            self._cache[key] = value
+            db = self._get_db()
+            if db is not None and st.st_mtime_ns < int(time.time() * 1e9) - CACHE_RACY_WINDOW_NS:
+                # Commit right away, so that the write lock of the database is not held (which
+                # would block other processes using the cache)
+                try:
+                    with db:
+                        db.execute('INSERT OR REPLACE INTO info VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (*key, json.dumps(value)))
+                except sqlite3.Error:
+                    pass
+        return value
+
+    def commit(self):
+        '''Save the on-disk cache.'''
+        with self._lock:
+            if self._db is not None:
+                try:
+                    self._db.commit()
+                except sqlite3.Error:
+                    pass
+
+_elf_info_cache = FileInfoCache('ldd', read_elf_info, decode=lambda value: ElfInfo(*value))
+
+@functools.lru_cache(maxsize=None)
+def get_ld_so_cache():
+    '''Get the contents of the dynamic loader cache (as listed by ``ldconfig -p``).
+
+    Returns:
+        dict: Mapping from library names to lists of paths.
+    '''
+    for ldconfig in ('ldconfig', '/sbin/ldconfig'):
+        try:
+            output = subprocess.run([ldconfig, '-p'], stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL, check=True).stdout
+            break
+        except (OSError, subprocess.CalledProcessError):
+            continue
+    else:
+        return {}
+
+    ret = {}
+    for line in os.fsdecode(output).splitlines():
+        # e.g. "libc.so.6 (libc6,x86-64) => /lib/x86_64-linux-gnu/libc.so.6"
+        name, sep, path = line.strip().partition(' => ')
+        # skip hardware-specific variants, the manifest shouldn't depend on the build machine
+        if not sep or '/glibc-hwcaps/' in path:
+            continue
+        ret.setdefault(name.split(' (', 1)[0], []).append(path)
+    return ret
+
+def expand_search_path(dirs, origin, elfclass):
+    ret = []
+    for directory in dirs:
+        if not directory:
+            continue
+        for var, value in (
+            ('ORIGIN', origin),
+            ('LIB', 'lib64' if elfclass == 64 else 'lib'),
+            ('PLATFORM', platform.machine()),
+        ):
+            directory = directory.replace(f'${{{var}}}', value).replace(f'${var}', value)
+        ret.append(directory)
+    return ret
+
+def find_library(name, requester, search_path):
+    if '/' in name:
+        candidates = [name]
+    else:
+        default_dirs = ['/lib64', '/usr/lib64'] if requester.elfclass == 64 else []
+        default_dirs += ['/lib', '/usr/lib']
+        candidates = [
+            *(os.path.join(directory, name) for directory in search_path),
+            *get_ld_so_cache().get(name, []),
+            *(os.path.join(directory, name) for directory in default_dirs),
+        ]
+
+    for path in candidates:
+        try:
+            info = _elf_info_cache.get(path)
+        except (OSError, elftools.common.exceptions.ELFError):
+            continue
+        if info.elfclass == requester.elfclass and info.machine == requester.machine:
+            return path, info
+    return None
+
+def resolve_dependencies(binary, ld_library_path):
+    info = _elf_info_cache.get(binary)
+    if not info.dynamic:
+        raise ValueError(f'{binary}: not a dynamic executable')
+
+    loaded = set(RTLD_SONAMES)
+    if info.interp:
+        loaded.add(os.path.basename(info.interp))
+
+    # Search libraries breadth-first, like the dynamic loader does
+    ret = []
+    queue = collections.deque([(binary, info, [])])
+    while queue:
+        path, info, rpath_chain = queue.popleft()
+        origin = os.path.dirname(os.path.abspath(path))
+        rpath_chain = rpath_chain + expand_search_path(info.rpath, origin, info.elfclass)
+        if info.runpath:
+            # DT_RPATH of all objects is ignored if the requesting object has DT_RUNPATH
+            search_path = [*ld_library_path,
+                           *expand_search_path(info.runpath, origin, info.elfclass)]
+        else:
+            search_path = [*rpath_chain, *ld_library_path]
+
+        for name in info.needed:
+            if name in loaded:
+                continue
+            loaded.add(name)
+            found = find_library(name, info, search_path)
+            if found is None:
+                # ldd prints "not found" for such libraries, we skip them
+                continue
+            lib_path, lib_info = found
+            if lib_info.soname:
+                loaded.add(lib_info.soname)
+            ret.append(lib_path)
+            queue.append((lib_path, lib_info, rpath_chain))
+    return ret
+
+_ldd_results = {}
+
 def ldd(*args):
     '''
     Args:
         binaries for which to generate manifest trusted files list.
+
+    Libraries are found by parsing the ELF files (unlike the ``ldd`` tool, which executes the
+    binaries), following the search rules of the glibc dynamic loader: ``DT_RPATH``,
+    ``LD_LIBRARY_PATH``, ``DT_RUNPATH``, ``ld.so.cache`` and default directories. The results are
+    cached, and many binaries are resolved concurrently.
+
+    Returns:
+        list(str): Sorted list of paths to the libraries (without the dynamic loader itself).
+
+    Raises:
+        ValueError: One of the binaries is not dynamically linked.
+    '''
+    ld_library_path = tuple(expand_search_path(os.getenv('LD_LIBRARY_PATH', '').split(':'),
+        '', 64))
+
+    def resolve(binary):
+        st = os.stat(binary)
+        key = (os.path.abspath(binary), st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns,
+            ld_library_path)
+        if key not in _ldd_results:
+            _ldd_results[key] = resolve_dependencies(binary, ld_library_path)
+        return _ldd_results[key]
+
+    binaries = [os.fspath(i) for i in args]
+    if len(binaries) > 1:
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            results = list(executor.map(resolve, binaries))
+    else:
+        results = [resolve(binary) for binary in binaries]
+    _elf_info_cache.commit()
+
+    return sorted(set(itertools.chain.from_iterable(results)))
+
+# Environment variables which affect sys.path of the interpreter
+PYTHON_PATH_ENV_VARS = ('PYTHONPATH', 'PYTHONHOME', 'PYTHONNOUSERSITE', 'PYTHONUSERBASE',
+    'PYTHONSAFEPATH')
+
+_PYTHON_INFO_SCRIPT = '''
+import json, sys, sysconfig
+print(json.dumps({
+    'sys_path': [path for path in sys.path if path],
+    'paths': sysconfig.get_paths(),
+    'ext_suffix': sysconfig.get_config_var('EXT_SUFFIX'),
+}))
+'''
+
+def _dir_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def query_python_info(interpreter):
+    info = json.loads(subprocess.check_output([interpreter, '-c', _PYTHON_INFO_SCRIPT]))
+    # Installing packages may change sys.path (via .pth files) without touching the interpreter,
+    # but it changes mtimes of the directories on sys.path.
+    info['dir_mtimes'] = {path: _dir_mtime(path) for path in info['sys_path']}
+    return info
+
+def _validate_python_info(info):
+    return all(_dir_mtime(path) == mtime for path, mtime in info['dir_mtimes'].items())
+
+_python_info_cache = FileInfoCache('python', query_python_info, validate=_validate_python_info)
+
+def python_get_interpreter_info(interpreter):
+    '''Get information about a Python interpreter.
+
+    The interpreter is run once to collect ``sys.path``, ``sysconfig.get_paths()`` and the
+    ``EXT_SUFFIX`` config variable. The results are cached in memory and on disk (by interpreter
+    path and mtime, environment variables which affect ``sys.path``, and mtimes of directories on
+    ``sys.path``).
+
+    Args:
+        interpreter (str or path-like): Path to the interpreter or its name (looked up in
+            ``PATH``).
+
+    Returns:
+        dict: Dictionary with keys ``sys_path`` (list of non-empty entries of ``sys.path``),
+        ``paths`` (dictionary returned by ``sysconfig.get_paths()``) and ``ext_suffix``.
     '''
-    # Be careful: We have to skip vdso, which doesn't have a corresponding file on the disk (we
-    # assume that such files have paths starting with '/', seems ldd always prints absolute paths).
-    # Also, old ldd (from Ubuntu 16.04) prints vdso differently than newer ones:
-    # old:
-    #     linux-vdso.so.1 =>  (0x00007ffd31fee000)
-    # new:
-    #     linux-vdso.so.1 (0x00007ffd31fee000)
-    ret = set()
-    for line in subprocess.check_output(['ldd', *(os.fspath(i) for i in args)]).decode('ascii'):
-        line = line.strip().split()
-        if line[1] == '=>' and line[2].startswith('/'):
-            ret.add(line[2])
-        elif line[0].startswith('/') and line[1].startswith('/'):
-            ret.add(line[0])
-    return sorted(ret)
+    interpreter = os.fspath(interpreter)
+    if os.sep not in interpreter:
+        interpreter = shutil.which(interpreter) or interpreter
+    extra_key = json.dumps([os.getenv(var) for var in PYTHON_PATH_ENV_VARS])
+    info = _python_info_cache.get(interpreter, extra_key)
+    _python_info_cache.commit()
+    return info
 
 def python_get_sys_path(interpreter, include_nonexisting=False):
-    for path in subprocess.check_output([interpreter, '-c',
-        '''import sys; print('\\0'.join(path for path in sys.path if path), end='')'''
-    ]).split(b'\0'):
-        path = pathlib.Path(os.fsdecode(path))
+    for path in python_get_interpreter_info(interpreter)['sys_path']:
+        path = pathlib.Path(path)
         if not include_nonexisting and not path.exists():
             continue
         yield path
@@ -59,6 +409,7 @@ def add_globals_from_python(env):
         'implementation': sys.implementation,
 
         'get_sys_path': python_get_sys_path,
+        'get_interpreter_info': python_get_interpreter_info,
     }
 
 class Runtimedir:
@@ -90,9 +441,84 @@ def add_globals_misc(env):
     env.globals['env'] = os.environ
     env.globals['ldd'] = ldd
 
+class StringLoader(jinja2.BaseLoader):
+    '''Loader of templates given as strings.
+
+    Templates are named by the SHA-256 hash of their source (see :py:meth:`add`). Unlike
+    :py:meth:`jinja2.Environment.from_string`, templates loaded with
+    :py:meth:`jinja2.Environment.get_template` go through the in-memory template cache and the
+    bytecode cache of the environment, so the same template is compiled only once.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sources = {}
+
+    def add(self, source):
+        '''Add a template.
+
+        Args:
+            source (str): Source of the template.
+
+        Returns:
+            str: Name of the template.
+        '''
+        name = hashlib.sha256(source.encode('utf-8')).hexdigest()
+        with self._lock:
+            self._sources[name] = source
+        return name
+
+    def get_source(self, environment, template):
+        with self._lock:
+            source = self._sources.get(template)
+        if source is None:
+            raise jinja2.TemplateNotFound(template)
+        return source, None, lambda: True
+
+class BytecodeCache(jinja2.FileSystemBytecodeCache):
+    '''Filesystem bytecode cache which ignores errors when saving the bytecode.'''
+    def dump_bytecode(self, bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError:
+            pass
+
+def get_bytecode_cache():
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return None
+    try:
+        (cache_dir / 'jinja').mkdir(parents=True, exist_ok=True)
+    except OSError:
+        return None
+    return BytecodeCache(os.fspath(cache_dir / 'jinja'))
+
 def make_env():
-    env = jinja2.Environment(undefined=jinja2.StrictUndefined, keep_trailing_newline=True)
+    env = jinja2.Environment(undefined=jinja2.StrictUndefined, keep_trailing_newline=True,
+        loader=StringLoader(), bytecode_cache=get_bytecode_cache())
     add_globals_from_gramine(env)
     add_globals_from_python(env)
     add_globals_misc(env)
     return env
+
+@functools.lru_cache(maxsize=None)
+def get_env():
+    '''Get the Jinja environment for rendering manifest templates.
+
+    The environment is created on the first call and reused afterwards.
+    '''
+    return make_env()
+
+def get_template(source):
+    '''Get a compiled template from the environment returned by :py:func:`get_env`.
+
+    Compiled templates are cached in memory and on disk (in ``jinja`` subdirectory of the
+    directory returned by :py:func:`get_cache_dir`).
+
+    Args:
+        source (str): Source of the template.
+
+    Returns:
+        jinja2.Template: The template.
+    '''
+    env = get_env()
+    return env.get_template(env.loader.add(source))
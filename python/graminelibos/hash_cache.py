@@ -0,0 +1,208 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (C) 2024 Intel Corporation
+
+"""
+Persistent cache of trusted files hashes
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from .manifest import ManifestError, _hash_file
+
+DEFAULT_MAX_ENTRIES = 1000000
+
+# Files modified less than this many nanoseconds before hashing are not cached: they could be
+# modified again without changing their mtime (same trick as in Git's "racily clean" entries).
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+
+def _stat_key(st):
+    return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+class HashCache:
+    """On-disk cache of SHA-256 hashes of trusted files.
+
+    Entries are keyed by the path of the file, together with its inode number, size, mtime and
+    ctime, so any change to the file (which is noticed by :py:func:`os.stat`) invalidates the entry.
+    The cache is safe to use from many threads and from many processes at the same time.
+
+    The cache also serves as an index of directories (see
+    :py:func:`graminelibos.manifest.walk_tree`), keyed the same way, so unchanged trusted
+    directories don't need to be listed again.
+
+    Can be used as a context manager, which calls :py:meth:`close` on exit.
+
+    Args:
+        cache_dir (str or path-like): Directory where the cache is stored. Created if missing.
+        max_entries (:obj:`int`, optional): Maximum number of entries kept in the cache. When
+            exceeded, least recently used entries are evicted on :py:meth:`close`.
+        strict (:obj:`bool`, optional): If true, always rehash the files and compare the result with
+            the cached hash (raising :py:class:`ManifestError` on mismatch).
+    """
+
+    def __init__(self, cache_dir, max_entries=DEFAULT_MAX_ENTRIES, strict=False):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.max_entries = max_entries
+        self.strict = strict
+        self.hits = 0
+        self.misses = 0
+
+        # Paths of entries found in the cache, to update their `last_used` in close() (doing it on
+        # each lookup would hold the write lock of the database, blocking other processes)
+        self._used = {'hashes': set(), 'dirs': set()}
+
+        # Every write is committed right away, so that the write lock of the database is held only
+        # for a moment and many processes can use the cache at the same time.
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(cache_dir, 'hashes.sqlite3'), timeout=60,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # In WAL mode, this doesn't sync the database on each commit, but it's still consistent
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS hashes (
+            path TEXT PRIMARY KEY,
+            ino INTEGER, size INTEGER, mtime_ns INTEGER, ctime_ns INTEGER,
+            sha256 TEXT,
+            last_used REAL
+        )''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used)')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS dirs (
+            path TEXT PRIMARY KEY,
+            ino INTEGER, size INTEGER, mtime_ns INTEGER, ctime_ns INTEGER,
+            entries TEXT,
+            last_used REAL
+        )''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS dirs_last_used ON dirs (last_used)')
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _lookup(self, path, key):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT ino, size, mtime_ns, ctime_ns, sha256 FROM hashes WHERE path = ?',
+                (path,)).fetchone()
+            if row is None or tuple(row[:4]) != key:
+                return None
+            self._used['hashes'].add(path)
+            return row[4]
+
+    def _store(self, path, key, hash_):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (path, *key, hash_, time.time()))
+
+    def hash_file(self, path):
+        """Get the SHA-256 hash of a file, from the cache if possible.
+
+        Suitable as a drop-in replacement for :py:func:`graminelibos.manifest.hash_file_contents`.
+
+        Args:
+            path (str or path-like): Path to the file.
+
+        Returns:
+            str: Hex-encoded SHA-256 hash of the file contents.
+
+        Raises:
+            ManifestError: Strict mode is enabled and the cached hash does not match.
+        """
+        return self.hash_file_with_stats(path)[0]
+
+    def hash_file_with_stats(self, path):
+        """Like :py:meth:`hash_file`, but also tell how the hash was obtained.
+
+        Args:
+            path (str or path-like): Path to the file.
+
+        Returns:
+            tuple: ``(hash, bytes_read, cached)``, where ``bytes_read`` is the number of bytes read
+            from the file and ``cached`` tells whether the hash was taken from the cache without
+            reading the file.
+
+        Raises:
+            ManifestError: Strict mode is enabled and the cached hash does not match.
+        """
+        path = os.path.abspath(path)
+        key = _stat_key(os.stat(path))
+
+        cached = self._lookup(path, key)
+        if cached is not None and not self.strict:
+            self.hits += 1
+            return cached, 0, True
+
+        hash_, bytes_read = _hash_file(path)
+        if cached is not None:
+            self.hits += 1
+            if cached != hash_:
+                raise ManifestError(f'Cached hash of {path} does not match its contents '
+                                    f'(cached {cached}, actual {hash_})')
+            return hash_, bytes_read, False
+
+        self.misses += 1
+        st = os.stat(path)
+        # Don't cache files that were modified while hashing or just before
+        if _stat_key(st) == key and st.st_mtime_ns < int(time.time() * 1e9) - RACY_WINDOW_NS:
+            self._store(path, key, hash_)
+        return hash_, bytes_read, False
+
+    def lookup_dir(self, path, st):
+        """Get the cached listing of a directory.
+
+        Args:
+            path (str or path-like): Path to the directory.
+            st (os.stat_result): Result of :py:func:`os.stat` on the directory.
+
+        Returns:
+            list: The listing, as returned by :py:func:`graminelibos.manifest.list_dir`, or ``None``
+            if the directory is not in the cache or has changed.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT ino, size, mtime_ns, ctime_ns, entries FROM dirs WHERE path = ?',
+                (path,)).fetchone()
+            if row is None or tuple(row[:4]) != _stat_key(st):
+                return None
+            self._used['dirs'].add(path)
+        return [tuple(entry) for entry in json.loads(row[4])]
+
+    def store_dir(self, path, st, listing):
+        """Store the listing of a directory.
+
+        The listing is not stored if the directory was modified after *st* was taken or just before.
+
+        Args:
+            path (str or path-like): Path to the directory.
+            st (os.stat_result): Result of :py:func:`os.stat` on the directory, taken before
+                listing it.
+            listing (list): The listing, as returned by :py:func:`graminelibos.manifest.list_dir`.
+        """
+        path = os.path.abspath(path)
+        key = _stat_key(st)
+        st = os.stat(path)
+        if _stat_key(st) != key or st.st_mtime_ns >= int(time.time() * 1e9) - RACY_WINDOW_NS:
+            return
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (path, *key, json.dumps(listing), time.time()))
+
+    def close(self):
+        """Update the last use of the entries found in the cache, evict the least recently used
+        entries above the limit and close the cache."""
+        with self._lock:
+            with self._db:
+                now = time.time()
+                for table in ('hashes', 'dirs'):
+                    self._db.executemany(f'UPDATE {table} SET last_used = ? WHERE path = ?',
+                                         ((now, path) for path in self._used[table]))
+                    self._db.execute(f'''DELETE FROM {table} WHERE path IN (
+                        SELECT path FROM {table} ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                    )''', (self.max_entries,))
+            self._db.close()
@@ -9,14 +9,16 @@ Gramine manifest management and rendering
 """
 
 import hashlib
+import json
+import mmap
 import os
 import pathlib
+import threading
+import time
 
 import tomli
 import tomli_w
 
-from . import _env
-
 DEFAULT_ENCLAVE_SIZE_NO_EDMM = '256M'
 DEFAULT_ENCLAVE_SIZE_WITH_EDMM = '1024G'  # 1TB; note that DebugInfo is at 1TB and ASan at 1.5TB
 DEFAULT_THREAD_NUM = 4
@@ -27,12 +29,51 @@ class ManifestError(Exception):
     Contains a string with error description.
     """
 
-def hash_file_contents(path):
+# Files at least this large are hashed through mmap() instead of read()
+HASH_MMAP_THRESHOLD = 16 * 1024 * 1024
+HASH_BUFFER_SIZE = 1024 * 1024
+
+_hash_buffers = threading.local()
+
+# Number of trusted files entries rendered at once by Manifest.dump()
+DUMP_CHUNK_ENTRIES = 4096
+
+def _hash_file(path):
+    """Hash a file, returning the hex-encoded SHA-256 hash and the number of bytes read."""
+    sha = hashlib.sha256()
+    bytes_read = 0
     with open(path, 'rb') as f:
-        sha = hashlib.sha256()
-        for chunk in iter(lambda: f.read(128 * sha.block_size), b''):
-            sha.update(chunk)
-        return sha.hexdigest()
+        size = os.fstat(f.fileno()).st_size
+        if size >= HASH_MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+                if hasattr(mapping, 'madvise'): # Python 3.8+
+                    mapping.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mapping) as view:
+                    sha.update(view)
+                    bytes_read = len(view)
+        else:
+            # reuse a per-thread buffer instead of allocating a new bytes object for every chunk
+            buf = getattr(_hash_buffers, 'buf', None)
+            if buf is None:
+                buf = _hash_buffers.buf = memoryview(bytearray(HASH_BUFFER_SIZE))
+            while True:
+                size = f.readinto(buf)
+                if not size:
+                    break
+                sha.update(buf[:size])
+                bytes_read += size
+    return sha.hexdigest(), bytes_read
+
+def hash_file_contents(path):
+    return _hash_file(path)[0]
+
+def toml_string(s):
+    # JSON strings are valid TOML basic strings, except that TOML doesn't allow raw DEL
+    return json.dumps(s, ensure_ascii=False).replace('\x7f', '\\u007f')
+
+def is_simple_tf(tf):
+    return (isinstance(tf, dict) and tf.keys() <= {'uri', 'sha256'}
+            and all(isinstance(v, str) for v in tf.values()))
 
 def uri2path(uri):
     if not uri.startswith('file:'):
@@ -40,10 +81,146 @@ def uri2path(uri):
     return pathlib.Path(uri[len('file:'):])
 
 def append_tf(trusted_files, path, hash_=None):
+    # Files without a hash are hashed later, in bulk, by hash_trusted_files()
     if path not in trusted_files:
-        trusted_files[path] = hash_ if hash_ is not None else hash_file_contents(path)
+        trusted_files[path] = hash_
+
+def hash_trusted_files(trusted_files, jobs=None, hash_cache=None, verbose=False):
+    """Fill in missing hashes of trusted files in place.
+
+    Args:
+        trusted_files (dict): Mapping from paths to hashes, where files yet to be hashed map to
+            ``None``. The order of the mapping is preserved.
+        jobs (:obj:`int`, optional): Number of worker threads used for hashing. Defaults to the
+            number of CPUs. If 1, files are hashed serially in the calling thread.
+        hash_cache (:obj:`graminelibos.hash_cache.HashCache`, optional): Persistent cache of
+            hashes to consult before hashing the files.
+        verbose (:obj:`bool`, optional): If true, print hashing statistics (including throughput)
+            to stdout.
+    """
+    paths = [path for path, hash_ in trusted_files.items() if hash_ is None]
+    if hash_cache is not None:
+        hash_func = hash_cache.hash_file_with_stats
+    else:
+        def hash_func(path):
+            return (*_hash_file(path), False)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    start_time = time.monotonic()
+    if jobs <= 1 or len(paths) <= 1:
+        results = [hash_func(path) for path in paths]
+    else:
+        # hashlib releases the GIL while hashing, so threads are enough to use all the cores
+        # concurrent.futures is slow to import (it pulls in logging), so import it only when needed
+        import concurrent.futures # pylint: disable=import-outside-toplevel
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(hash_func, paths))
+    for path, (hash_, _, _) in zip(paths, results):
+        trusted_files[path] = hash_
+    elapsed = time.monotonic() - start_time
+
+    if verbose:
+        total_read = sum(bytes_read for _, bytes_read, _ in results)
+        cache_hits = sum(cached for _, _, cached in results)
+        print('Trusted files:')
+        print(f'    files:       {len(paths) - cache_hits} hashed, {cache_hits} from cache, '
+              f'{len(trusted_files) - len(paths)} given')
+        print(f'    read:        {total_read / 1e9:.3f} GB')
+        print(f'    time:        {elapsed:.3f} s')
+        if elapsed > 0:
+            print(f'    throughput:  {total_read / 1e9 / elapsed:.3f} GB/s')
+
+def _entry_kind(entry):
+    if entry.is_dir(follow_symlinks=False):
+        return 'd'
+    if entry.is_symlink():
+        return 'l'
+    if entry.is_file(follow_symlinks=False):
+        return 'f'
+    return 'o'
+
+def list_dir(path, dir_index=None):
+    """List a directory.
 
-def append_trusted_dir_or_file(trusted_files, val, expanded):
+    Args:
+        path (str): Path to the directory.
+        dir_index (:obj:`graminelibos.hash_cache.HashCache`, optional): Persistent index of
+            directories to consult before listing the directory.
+
+    Returns:
+        list: Sorted list of ``(name, kind)`` tuples, where ``kind`` is one of ``'d'`` (directory),
+        ``'f'`` (regular file), ``'l'`` (symbolic link) or ``'o'`` (other).
+    """
+    if dir_index is not None:
+        st = os.stat(path)
+        listing = dir_index.lookup_dir(path, st)
+        if listing is not None:
+            return listing
+
+    try:
+        with os.scandir(path) as it:
+            listing = sorted((entry.name, _entry_kind(entry)) for entry in it)
+    except PermissionError:
+        # Skip inaccessible directories, like Path.rglob() does
+        return []
+
+    if dir_index is not None:
+        dir_index.store_dir(path, st, listing)
+    return listing
+
+def walk_tree(top, jobs=None, dir_index=None):
+    """Recursively list a directory.
+
+    Returns the same entries, in the same order, as ``sorted(pathlib.Path(top).rglob('*'))``, but
+    uses the file types returned by :py:func:`os.scandir` instead of calling :py:func:`os.stat` on
+    each entry. Symbolic links to directories are not followed. Subdirectories are listed in
+    parallel.
+
+    Args:
+        top (str or path-like): Path to the directory.
+        jobs (:obj:`int`, optional): Number of worker threads used for listing directories.
+            Defaults to the number of CPUs.
+        dir_index (:obj:`graminelibos.hash_cache.HashCache`, optional): Persistent index of
+            directories, used to avoid listing directories which did not change since the last run.
+
+    Returns:
+        list: List of ``(path, is_file)`` tuples, where ``path`` is a string and ``is_file`` tells
+        whether the entry is a regular file (or a symbolic link to one).
+    """
+    top = os.fspath(top)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    # List the tree level by level, each level in parallel
+    listings = {}
+    import concurrent.futures # pylint: disable=import-outside-toplevel
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        level = [top]
+        while level:
+            map_func = executor.map if jobs > 1 and len(level) > 1 else map
+            listings.update(zip(level, map_func(lambda path: list_dir(path, dir_index), level)))
+            level = [os.path.join(dirpath, name)
+                     for dirpath in level for name, kind in listings[dirpath] if kind == 'd']
+
+    # Flatten the tree in depth-first order, which is the same as the order of sorted paths
+    entries = []
+    dirpaths = [top]
+    stack = [iter(listings[top])]
+    while stack:
+        for name, kind in stack[-1]:
+            path = os.path.join(dirpaths[-1], name)
+            entries.append((path, kind == 'f' or kind == 'l' and os.path.isfile(path)))
+            if kind == 'd':
+                dirpaths.append(path)
+                stack.append(iter(listings[path]))
+                break
+        else:
+            dirpaths.pop()
+            stack.pop()
+    return entries
+
+def append_trusted_dir_or_file(trusted_files, val, expanded, jobs=None, dir_index=None):
     if isinstance(val, dict):
         uri = val['uri']
         if val.get('sha256'):
@@ -62,9 +239,10 @@ def append_trusted_dir_or_file(trusted_files, val, expanded):
             raise ManifestError(f'Directory URI ({uri}) does not end with "/"')
 
         expanded.append(path)
-        for sub_path in sorted(path.rglob('*')):
+        for sub_path, is_file in walk_tree(path, jobs=jobs, dir_index=dir_index):
+            sub_path = pathlib.Path(sub_path)
             expanded.append(sub_path)
-            if sub_path.is_file():
+            if is_file:
                 # Skip inaccessible files
                 if os.access(sub_path, os.R_OK):
                     append_tf(trusted_files, sub_path)
@@ -149,7 +327,9 @@ class Manifest:
         Returns:
             Manifest: instance created from rendered template.
         """
-        return cls(_env.from_string(template).render(**(variables or {})))
+        # jinja2 is slow to import, so don't do it unless rendering templates
+        from .gen_jinja_env import get_template # pylint: disable=import-outside-toplevel
+        return cls(get_template(template).render(**(variables or {})))
 
     @classmethod
     def loads(cls, s):
@@ -159,13 +339,33 @@ class Manifest:
     def load(cls, f):
         return cls.loads(f.read())
 
+    def _gen_chunks(self):
+        trusted_files = self['sgx']['trusted_files']
+        if not trusted_files or not all(is_simple_tf(tf) for tf in trusted_files):
+            yield tomli_w.dumps(self._manifest)
+            return
+
+        # With many trusted files, rendering them through tomli_w is slow and memory-hungry.
+        # Instead, we render the rest of the manifest with tomli_w and append trusted files at the
+        # end, as an array of tables.
+        manifest = dict(self._manifest)
+        manifest['sgx'] = {k: v for k, v in manifest['sgx'].items() if k != 'trusted_files'}
+        yield tomli_w.dumps(manifest)
+
+        for i in range(0, len(trusted_files), DUMP_CHUNK_ENTRIES):
+            yield ''.join(
+                '\n[[sgx.trusted_files]]\n' + ''.join(f'{k} = {toml_string(v)}\n'
+                                                       for k, v in tf.items())
+                for tf in trusted_files[i:i + DUMP_CHUNK_ENTRIES])
+
     def dumps(self):
-        return tomli_w.dumps(self._manifest)
+        return ''.join(self._gen_chunks())
 
     def dump(self, f):
-        tomli_w.dump(self._manifest, f)
+        for chunk in self._gen_chunks():
+            f.write(chunk.encode('utf-8'))
 
-    def expand_all_trusted_files(self):
+    def expand_all_trusted_files(self, jobs=None, hash_cache=None, verbose=False):
         """Expand all trusted files entries.
 
         Collects all trusted files entries, hashes each of them (skipping these which already had a
@@ -174,6 +374,14 @@ class Manifest:
         Returns a list of all expanded files, i.e. files that we need to hash, and directories that
         we needed to list.
 
+        Args:
+            jobs (:obj:`int`, optional): Number of worker threads used for listing directories and
+                hashing. Defaults to the number of CPUs. The result does not depend on this value.
+            hash_cache (:obj:`graminelibos.hash_cache.HashCache`, optional): Persistent cache of
+                hashes and directory listings, used to avoid rehashing files and relisting
+                directories which did not change since the last run.
+            verbose (:obj:`bool`, optional): If true, print hashing statistics to stdout.
+
         Raises:
             ManifestError: There was an error with the format of some trusted files in the manifest
                 or some of them could not be loaded from the filesystem.
@@ -182,7 +390,10 @@ class Manifest:
         trusted_files = {}
         expanded = []
         for tf in self['sgx']['trusted_files']:
-            append_trusted_dir_or_file(trusted_files, tf, expanded)
+            append_trusted_dir_or_file(trusted_files, tf, expanded, jobs=jobs,
+                                       dir_index=hash_cache)
+
+        hash_trusted_files(trusted_files, jobs=jobs, hash_cache=hash_cache, verbose=verbose)
 
         self['sgx']['trusted_files'] = [
             {'uri': f'file:{k}', 'sha256': v} for k, v in trusted_files.items()
@@ -1,12 +1,20 @@
+import asyncio
+import collections
 import contextlib
+import functools
+import json
 import logging
+import math
 import os
 import pathlib
 import resource
 import select
 import signal
+import sqlite3
+import statistics
 import subprocess
 import sys
+import tempfile
 import time
 import unittest
 
@@ -22,6 +30,7 @@ HAS_SGX = os.environ.get('SGX') == '1'
 IS_VM = os.environ.get('IS_VM') == '1'
 ON_X86 = os.uname().machine in ['x86_64']
 USES_MUSL = os.environ.get('GRAMINE_MUSL') == '1'
+HOST = 'sgx' if HAS_SGX else 'direct'
 
 def expectedFailureIf(predicate):
     if predicate:
@@ -32,45 +41,335 @@ def set_open_fds_limit(n):
     if n is not None:
         resource.setrlimit(resource.RLIMIT_NOFILE, (n, n))
 
-def run_command(cmd, *, timeout, open_fds_limit=None, can_fail=False, **kwds):
-    # pylint: disable=too-many-locals
-    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                          preexec_fn=lambda: set_open_fds_limit(open_fds_limit),
-                          start_new_session=True, **kwds) as proc:
-        class LoggingSplice:
-            def __init__(self, input_pipe, output_pipe):
-                self.logged_data = b''
-                self.closed = False
-                self.at_line_start = True
-                self.input_pipe = input_pipe
-                self.output_pipe = output_pipe
-                self.start_time = time.time()
-
-            def pump_data(self, pending_reads):
-                if self.input_pipe in pending_reads:
-                    data = self.input_pipe.read(1024)
-                    self.logged_data += data
-
-                    if not data:
-                        self.closed = True
-                        return
+# Number of the most recent runs of each command kept in the timing database
+TIMINGS_MAX_RUNS = 20
+
+# With `GRAMINE_TEST_ADAPTIVE_TIMEOUTS=1`, commands with enough recorded runs get a timeout of
+# ADAPTIVE_TIMEOUT_FACTOR times the 95th percentile of their previous wall times (but not less than
+# ADAPTIVE_TIMEOUT_MIN seconds, and never more than the timeout requested by the test)
+USE_ADAPTIVE_TIMEOUTS = os.environ.get('GRAMINE_TEST_ADAPTIVE_TIMEOUTS') == '1'
+# The timing database is used only with `GRAMINE_TEST_RECORD_TIMINGS=1` or adaptive timeouts
+RECORD_TIMINGS = os.environ.get('GRAMINE_TEST_RECORD_TIMINGS') == '1' or USE_ADAPTIVE_TIMEOUTS
+ADAPTIVE_TIMEOUT_MIN_RUNS = 5
+ADAPTIVE_TIMEOUT_FACTOR = 3
+ADAPTIVE_TIMEOUT_MIN = 5
+
+TimingKey = collections.namedtuple('TimingKey', ('test', 'cwd', 'host', 'cmd'))
+
+class TimingDatabase:
+    '''
+    Database of wall time, peak RSS and exit status of commands run by tests (using `run_command`).
+
+    Runs are keyed by the test (Pytest node ID), working directory, host (`direct` or `sgx`) and the
+    command line. The database is safe to use from many threads and processes at the same time.
+    '''
+
+    def __init__(self, path):
+        self.path = fspath(path)
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''CREATE TABLE IF NOT EXISTS runs (
+                test TEXT, cwd TEXT, host TEXT, cmd TEXT,
+                start_time REAL,
+                wall_time REAL,
+                max_rss INTEGER,
+                returncode INTEGER,
+                timed_out INTEGER
+            )''')
+            db.execute('CREATE INDEX IF NOT EXISTS runs_key ON runs (test, cwd, host, cmd)')
 
-                    timestamped = bytearray()
-                    for ch in data:
-                        if self.at_line_start:
-                            timestamped += b'[%.3f] ' % (time.time() - self.start_time)
-                            self.at_line_start = False
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def record(self, key, *, start_time, wall_time, max_rss, returncode, timed_out):
+        '''
+        Record a run of a command (`max_rss` is in kilobytes, `returncode` is None if the command
+        did not exit).
+        '''
+        # pylint: disable=too-many-arguments
+        with self._connect() as db:
+            db.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (*key, start_time, wall_time, max_rss, returncode, int(timed_out)))
+            db.execute('''DELETE FROM runs WHERE rowid IN (
+                SELECT rowid FROM runs WHERE test = ? AND cwd = ? AND host = ? AND cmd = ?
+                ORDER BY start_time DESC LIMIT -1 OFFSET ?
+            )''', (*key, TIMINGS_MAX_RUNS))
+
+    def get_wall_times(self, key):
+        '''Return wall times of the recorded runs of a command that did not time out.'''
+        with self._connect() as db:
+            return [row[0] for row in db.execute(
+                'SELECT wall_time FROM runs WHERE test = ? AND cwd = ? AND host = ? AND cmd = ? '
+                'AND NOT timed_out', key)]
+
+    def get_adaptive_timeout(self, key, timeout):
+        '''Return a timeout for a command based on its previous runs (at most `timeout`).'''
+        wall_times = self.get_wall_times(key)
+        if len(wall_times) < ADAPTIVE_TIMEOUT_MIN_RUNS:
+            return timeout
+        # 95th percentile, using the nearest-rank method
+        p95 = sorted(wall_times)[math.ceil(0.95 * len(wall_times)) - 1]
+        return min(timeout, max(ADAPTIVE_TIMEOUT_MIN, math.ceil(ADAPTIVE_TIMEOUT_FACTOR * p95)))
+
+    def get_durations(self, cwd=None, host=None):
+        '''
+        Return the typical (median) duration of tests in given directory (by default, the current
+        one) and host, as a dict mapping Pytest node IDs to seconds. If a test runs many commands,
+        their durations are added up.
+        '''
+        cwd = os.getcwd() if cwd is None else fspath(cwd)
+        host = HOST if host is None else host
+        wall_times = collections.defaultdict(list)
+        with self._connect() as db:
+            for test, cmd, wall_time in db.execute(
+                    'SELECT test, cmd, wall_time FROM runs WHERE cwd = ? AND host = ? '
+                    'AND NOT timed_out', (cwd, host)):
+                wall_times[test, cmd].append(wall_time)
+
+        durations = collections.defaultdict(float)
+        for (test, _cmd), times in wall_times.items():
+            durations[test] += statistics.median(times)
+        return dict(durations)
+
+@functools.lru_cache(maxsize=None)
+def get_timing_db():
+    '''
+    Return the timing database (in Gramine's cache directory), or None if disabled or it cannot be
+    opened.
+    '''
+    # pylint: disable=import-outside-toplevel
+    from .gen_jinja_env import get_cache_dir
+
+    if not RECORD_TIMINGS:
+        return None
+    try:
+        cache_dir = get_cache_dir()
+        if cache_dir is None:
+            return None
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        return TimingDatabase(cache_dir / 'test-timings.sqlite3')
+    except Exception as e: # pylint: disable=broad-except
+        # The database is not needed to run the tests, so don't fail them because of it
+        logging.warning('Cannot open timing database, not recording timings: %s', e)
+        return None
+
+def get_timing_key(cmd):
+    '''Return the key for recording a run of `cmd` by the current test (None outside of Pytest).'''
+    # "path/to/test.py::test_name (call)"
+    current_test = os.environ.get('PYTEST_CURRENT_TEST')
+    if not current_test:
+        return None
+    test = current_test.rsplit(' ', 1)[0]
+    return TimingKey(test, os.getcwd(), HOST, json.dumps([fspath(arg) for arg in cmd]))
+
+def wait_with_rusage(proc, timeout):
+    '''
+    Wait at most `timeout` seconds for the process to exit, and return its resource usage (or None
+    if it's still running). Sets `proc.returncode` like `proc.wait()` does.
+    '''
+    deadline = time.monotonic() + timeout
+    delay = 0.0005
+    while True:
+        try:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        except ChildProcessError:
+            # already reaped
+            proc.poll()
+            return None
+        if pid:
+            if os.WIFSIGNALED(status):
+                proc.returncode = -os.WTERMSIG(status)
+            else:
+                proc.returncode = os.WEXITSTATUS(status)
+            return rusage
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.05)
+
+# Size of a single read from the stdout/stderr pipes of a command run by `run_command`
+OUTPUT_READ_SIZE = 64 * 1024
+
+# Output of a command run by `run_command` above this size is kept in a temporary file instead of
+# memory, until the command finishes
+OUTPUT_SPILL_THRESHOLD = 64 * 1024 * 1024
+
+class LoggingSplice:
+    '''
+    Copy data from a pipe to an output stream, prefixing every line with a timestamp, and keep all
+    the data (in memory, or in a temporary file after `spill_threshold` bytes, if not None).
+    '''
+
+    def __init__(self, input_pipe, output_pipe, *, start_time=None,
+                 spill_threshold=OUTPUT_SPILL_THRESHOLD):
+        self.input_pipe = input_pipe
+        self.output_pipe = output_pipe
+        self.start_time = time.time() if start_time is None else start_time
+        self.spill_threshold = spill_threshold
+        self.closed = False
+        self.at_line_start = True
+        self.chunks = []
+        self.size = 0
+        self.spill_file = None
+
+    def pump_data(self, pending_reads):
+        if self.input_pipe in pending_reads:
+            data = self.input_pipe.read(OUTPUT_READ_SIZE)
+            if not data:
+                self.closed = True
+                return
+            self.feed(data)
+
+    def feed(self, data):
+        self.store(data)
+        self.output_pipe.write(self.timestamp(data))
+        self.output_pipe.flush()
+
+    def timestamp(self, data):
+        prefix = b'[%.3f] ' % (time.time() - self.start_time)
+        ends_with_newline = data.endswith(b'\n')
+        if ends_with_newline:
+            data = data[:-1]
+        timestamped = data.replace(b'\n', b'\n' + prefix)
+        if self.at_line_start:
+            timestamped = prefix + timestamped
+        if ends_with_newline:
+            timestamped += b'\n'
+        self.at_line_start = ends_with_newline
+        return timestamped
+
+    def store(self, data):
+        self.size += len(data)
+        if self.spill_file is not None:
+            self.spill_file.write(data)
+            return
+
+        self.chunks.append(data)
+        if self.spill_threshold is not None and self.size > self.spill_threshold:
+            # pylint: disable=consider-using-with
+            self.spill_file = tempfile.TemporaryFile(prefix='gramine-test-output-')
+            self.spill_file.writelines(self.chunks)
+            self.chunks = []
+
+    def get_data(self):
+        '''Return all data read so far.'''
+        if self.spill_file is None:
+            return b''.join(self.chunks)
+        self.spill_file.seek(0)
+        data = self.spill_file.read()
+        self.spill_file.seek(0, os.SEEK_END)
+        return data
+
+    def close(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+class CommandTiming:
+    '''
+    Timeout of a command run by a test (adaptive, if enabled), and recording of the run in the
+    timing database.
+    '''
+
+    def __init__(self, cmd, timeout):
+        self.db = get_timing_db()
+        self.key = None
+        self.timeout = timeout
+        self.adaptive = False
+        # Errors of the timing database are reported, but never fail the test
+        try:
+            self.key = get_timing_key(cmd) if self.db else None
+            if self.key and USE_ADAPTIVE_TIMEOUTS:
+                self.timeout = self.db.get_adaptive_timeout(self.key, timeout)
+                self.adaptive = self.timeout < timeout
+        except Exception as e: # pylint: disable=broad-except
+            logging.warning('run_command: cannot read timings: %s', e)
+            self.key = None
+        self.start_time = time.time()
+
+    def record(self, *, wall_time, max_rss, returncode, timed_out):
+        if not self.key:
+            return
+        try:
+            self.db.record(self.key, start_time=self.start_time, wall_time=wall_time,
+                           max_rss=max_rss, returncode=returncode, timed_out=timed_out)
+        except Exception as e: # pylint: disable=broad-except
+            logging.warning('run_command: cannot record timing: %s', e)
+
+def kill_process_group(pid):
+    '''Kill the whole process group of a command started with `start_new_session=True`.'''
+    try:
+        # after `setsid`, pgid should be the same as pid
+        if pid != os.getpgid(pid):
+            logging.warning(
+                'run_command: main process changed pgid, this might indicate an error and '
+                'prevent all processes from being cleaned up'
+            )
+    except ProcessLookupError:
+        pass
+
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def finish_command(cmd, timing, *, timed_out, main_returncode, stdout_splice, stderr_splice,
+                   can_fail):
+    '''Check the result of a command, and return its exit code and decoded output.'''
+    # pylint: disable=too-many-arguments
+    raw_stdout = stdout_splice.get_data()
+    raw_stderr = stderr_splice.get_data()
+    stdout_splice.close()
+    stderr_splice.close()
+
+    stdout = raw_stdout.decode(errors='surrogateescape')
+    stderr = raw_stderr.decode(errors='surrogateescape')
+
+    if timed_out:
+        if main_returncode is not None:
+            # XXX: Don't fail the test as long the main process exited (i.e. if it left dangling
+            # child processes). This can happen due to a known issue with Gramine failing to
+            # deliver a signal for an arbitrary amount of time. See the comment in
+            # `libos_internal.h:handle_signal` for details.
+            #
+            # This happens occasionally when running LTP tests (e.g. `sendfile04`,
+            # `fdatasync01`, `recvfrom01`, `sendto01`) that send SIGKILL to child processes.
+            logging.warning(
+                'run_command: Command %s timed out, but the main process exited. This might be '
+                'due to a known issue with Gramine failing to deliver a signal. Continuing.',
+                cmd)
+        else:
+            raise AssertionError('Command {} timed out after {} s{}'.format(cmd, timing.timeout,
+                ' (adaptive timeout based on previous runs)' if timing.adaptive else ''))
 
-                        timestamped.append(ch)
+    assert main_returncode is not None
 
-                        if ch == 10:
-                            self.at_line_start = True
+    if main_returncode != 0 and not can_fail:
+        raise subprocess.CalledProcessError(main_returncode, cmd, raw_stdout, raw_stderr)
 
-                    self.output_pipe.write(timestamped)
-                    self.output_pipe.flush()
+    return main_returncode, stdout, stderr
 
-        stdout_splice = LoggingSplice(proc.stdout.raw, sys.stdout.buffer)
-        stderr_splice = LoggingSplice(proc.stderr.raw, sys.stderr.buffer)
+def run_command(cmd, *, timeout, open_fds_limit=None, can_fail=False,
+                spill_threshold=OUTPUT_SPILL_THRESHOLD, **kwds):
+    # pylint: disable=too-many-locals
+    timing = CommandTiming(cmd, timeout)
+    timeout = timing.timeout
+    start_time = timing.start_time
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          preexec_fn=lambda: set_open_fds_limit(open_fds_limit),
+                          start_new_session=True, **kwds) as proc:
+        stdout_splice = LoggingSplice(proc.stdout.raw, sys.stdout.buffer, start_time=start_time,
+                                      spill_threshold=spill_threshold)
+        stderr_splice = LoggingSplice(proc.stderr.raw, sys.stderr.buffer, start_time=start_time,
+                                      spill_threshold=spill_threshold)
 
         # returns True if we've used only some of the time and more data can arrive later
         def try_pump(timeout):
@@ -104,64 +403,126 @@ def run_command(cmd, *, timeout, open_fds_limit=None, can_fail=False, **kwds):
         # Once we're here, we've either timed out, or both pipes got closed and the process is about
         # to exit
         time_remaining = time_end - time.time()
-        if time_remaining > 0:
-            proc.wait(time_remaining)
+        rusage = wait_with_rusage(proc, max(time_remaining, 0))
+        if rusage is None and time_remaining > 0 and proc.returncode is None:
+            raise subprocess.TimeoutExpired(cmd, timeout)
 
         timed_out = time_end < time.time()
-
-        proc.poll()
+        wall_time = time.time() - start_time
         main_returncode = proc.returncode
 
         # Kill the whole process group: even if we did not time out, there might be some processes
         # remaining
-
-        try:
-            # after `setsid`, pgid should be the same as pid
-            if proc.pid != os.getpgid(proc.pid):
-                logging.warning(
-                    'run_command: main process changed pgid, this might indicate an error and '
-                    'prevent all processes from being cleaned up'
-                )
-        except ProcessLookupError:
-            pass
-
-        try:
-            os.killpg(proc.pid, signal.SIGKILL)
-        except ProcessLookupError:
-            pass
+        kill_process_group(proc.pid)
 
         # Copy any output generated while we were busy killing the processes
         while try_pump(0):
             pass
 
-        raw_stdout = stdout_splice.logged_data
-        raw_stderr = stderr_splice.logged_data
-
-        stdout = raw_stdout.decode(errors='surrogateescape')
-        stderr = raw_stderr.decode(errors='surrogateescape')
-
-        if timed_out:
-            if main_returncode is not None:
-                # XXX: Don't fail the test as long the main process exited (i.e. if it left dangling
-                # child processes). This can happen due to a known issue with Gramine failing to
-                # deliver a signal for an arbitrary amount of time. See the comment in
-                # `libos_internal.h:handle_signal` for details.
-                #
-                # This happens occasionally when running LTP tests (e.g. `sendfile04`,
-                # `fdatasync01`, `recvfrom01`, `sendto01`) that send SIGKILL to child processes.
-                logging.warning(
-                    'run_command: Command %s timed out, but the main process exited. This might be '
-                    'due to a known issue with Gramine failing to deliver a signal. Continuing.',
-                    cmd)
-            else:
-                raise AssertionError('Command {} timed out after {} s'.format(cmd, timeout))
+        if main_returncode is None:
+            # reap the killed main process, to get its resource usage
+            rusage = wait_with_rusage(proc, timeout=60)
+
+        timing.record(wall_time=wall_time, max_rss=rusage.ru_maxrss if rusage else None,
+                      returncode=main_returncode, timed_out=timed_out)
+
+        return finish_command(cmd, timing, timed_out=timed_out, main_returncode=main_returncode,
+                              stdout_splice=stdout_splice, stderr_splice=stderr_splice,
+                              can_fail=can_fail)
 
-        assert main_returncode is not None
+# Maximum number of commands run at the same time by `run_commands_concurrently` (by default)
+DEFAULT_CONCURRENCY = int(os.environ.get('GRAMINE_TEST_CONCURRENCY', '0')) or os.cpu_count() or 1
 
-        if main_returncode != 0 and not can_fail:
-            raise subprocess.CalledProcessError(proc.returncode, cmd, raw_stdout, raw_stderr)
+async def run_command_async(cmd, *, timeout, open_fds_limit=None, can_fail=False,
+                            spill_threshold=OUTPUT_SPILL_THRESHOLD, **kwds):
+    '''
+    Asynchronous version of `run_command`, for running many commands at the same time (see
+    `run_commands_concurrently`).
+
+    Peak RSS is not recorded in the timing database, because asyncio reaps the processes itself.
+    '''
+    # pylint: disable=too-many-locals
+    timing = CommandTiming(cmd, timeout)
+    proc = await asyncio.create_subprocess_exec(*cmd,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        preexec_fn=lambda: set_open_fds_limit(open_fds_limit),
+        start_new_session=True, **kwds)
+
+    stdout_splice = LoggingSplice(None, sys.stdout.buffer, start_time=timing.start_time,
+                                  spill_threshold=spill_threshold)
+    stderr_splice = LoggingSplice(None, sys.stderr.buffer, start_time=timing.start_time,
+                                  spill_threshold=spill_threshold)
+
+    async def pump(stream, splice):
+        while True:
+            data = await stream.read(OUTPUT_READ_SIZE)
+            if not data:
+                break
+            splice.feed(data)
+
+    pumps = [asyncio.ensure_future(pump(proc.stdout, stdout_splice)),
+             asyncio.ensure_future(pump(proc.stderr, stderr_splice))]
+    wait = asyncio.ensure_future(proc.wait())
+    try:
+        # Like in `run_command`, wait until both pipes are closed and the main process exits
+        _, pending = await asyncio.wait([*pumps, wait], timeout=timing.timeout)
+        timed_out = bool(pending)
+        wall_time = time.time() - timing.start_time
+        main_returncode = proc.returncode
 
-        return main_returncode, stdout, stderr
+        # Kill the whole process group: even if we did not time out, there might be some processes
+        # remaining
+        kill_process_group(proc.pid)
+
+        if pending == {wait}:
+            # Like in `run_command`: both pipes got closed, but the main process did not exit
+            raise subprocess.TimeoutExpired(cmd, timing.timeout)
+
+        # Copy any output generated while we were busy killing the processes (pipes might still
+        # be held open by processes which changed their process group)
+        await asyncio.wait([*pumps, wait], timeout=1)
+    finally:
+        for task in [*pumps, wait]:
+            task.cancel()
+
+    timing.record(wall_time=wall_time, max_rss=None, returncode=main_returncode,
+                  timed_out=timed_out)
+
+    return finish_command(cmd, timing, timed_out=timed_out, main_returncode=main_returncode,
+                          stdout_splice=stdout_splice, stderr_splice=stderr_splice,
+                          can_fail=can_fail)
+
+def run_commands_concurrently(cmds, *, concurrency=None, **kwds):
+    '''
+    Run many commands at the same time (using `run_command_async`, with the same keyword
+    arguments), but not more than `concurrency` (by default, `DEFAULT_CONCURRENCY`) at once.
+
+    Returns a list of results of the commands (`(returncode, stdout, stderr)`), in order. If any of
+    the commands failed, raises the exception of the first one (after all of them finish).
+    '''
+    async def run_one(semaphore, cmd):
+        async with semaphore:
+            return await run_command_async(cmd, **kwds)
+
+    async def run_all():
+        # created here, so that it belongs to the event loop created below
+        semaphore = asyncio.Semaphore(concurrency or DEFAULT_CONCURRENCY)
+        return await asyncio.gather(*(run_one(semaphore, cmd) for cmd in cmds),
+                                    return_exceptions=True)
+
+    # Same as `asyncio.run()`, which is not available in Python 3.6. The loop has to be set as the
+    # current one, so that the child watcher (which reaps the processes) is attached to it.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        results = loop.run_until_complete(run_all())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
 
 
 class RegressionTestCase(unittest.TestCase):
@@ -208,10 +569,7 @@ class RegressionTestCase(unittest.TestCase):
 
         return self.run_binary(args, prefix=prefix, env=env, **kwds)
 
-    def run_binary(self, args, *, timeout=None, prefix=None, **kwds):
-        timeout = (max(self.DEFAULT_TIMEOUT, timeout) if timeout is not None
-            else self.DEFAULT_TIMEOUT)
-
+    def get_loader_cmd(self, args, prefix=None):
         if not self.loader_path.exists():
             self.fail('loader ({}) not found'.format(self.loader_path))
         if not self.libpal_path.exists():
@@ -220,10 +578,29 @@ class RegressionTestCase(unittest.TestCase):
         if prefix is None:
             prefix = []
 
-        cmd = [*prefix, fspath(self.loader_path), fspath(self.libpal_path), 'init', *args]
+        return [*prefix, fspath(self.loader_path), fspath(self.libpal_path), 'init', *args]
+
+    def run_binary(self, args, *, timeout=None, prefix=None, **kwds):
+        timeout = (max(self.DEFAULT_TIMEOUT, timeout) if timeout is not None
+            else self.DEFAULT_TIMEOUT)
+
+        cmd = self.get_loader_cmd(args, prefix=prefix)
         _returncode, stdout, stderr = run_command(cmd, timeout=timeout, **kwds)
         return stdout, stderr
 
+    def run_binaries(self, args_list, *, timeout=None, prefix=None, concurrency=None, **kwds):
+        '''
+        Run many independent Gramine instances at the same time (see `run_commands_concurrently`),
+        with the same arguments as `run_binary` (for each element of `args_list`).
+
+        Returns a list of `(returncode, stdout, stderr)` tuples.
+        '''
+        timeout = (max(self.DEFAULT_TIMEOUT, timeout) if timeout is not None
+            else self.DEFAULT_TIMEOUT)
+
+        cmds = [self.get_loader_cmd(args, prefix=prefix) for args in args_list]
+        return run_commands_concurrently(cmds, timeout=timeout, concurrency=concurrency, **kwds)
+
     @classmethod
     def run_native_binary(cls, args, timeout=None, libpath=None, **kwds):
         timeout = (max(cls.DEFAULT_TIMEOUT, timeout) if timeout is not None
@@ -2,40 +2,61 @@
 # Copyright (C) 2021 Intel Corporation
 #                    Borys Popławski <borysp@invisiblethingslab.com>
 
+import functools
 import hashlib
 import socket
 import struct
+import threading
 
 import _graminelibos_offsets as offs # pylint: disable=import-error
 
-def get_optional_sgx_features(sig):
-    '''Set optional SGX features if they are available on this machine.'''
-    optional_sgx_features = {
-        offs.SGX_XFRM_AVX:      'avx',
-        offs.SGX_XFRM_AVX512:   'avx512f',
-        offs.SGX_XFRM_MPX:      'mpx',
-        offs.SGX_XFRM_PKRU:     'pku', # "pku" is not a typo, that's how cpuinfo reports it
-        offs.SGX_XFRM_AMX:      'amx_tile',
-    }
-
-    cpu_features = ''
+# Optional XFRM features, with names of the corresponding CPU flags
+OPTIONAL_XFRM_FEATURES = {
+    offs.SGX_XFRM_AVX:      'avx',
+    offs.SGX_XFRM_AVX512:   'avx512f',
+    offs.SGX_XFRM_MPX:      'mpx',
+    offs.SGX_XFRM_PKRU:     'pku', # "pku" is not a typo, that's how cpuinfo reports it
+    offs.SGX_XFRM_AMX:      'amx_tile',
+}
+
+@functools.lru_cache(maxsize=None)
+def get_cpu_features():
+    """Get features of the CPU of this machine.
+
+    The features are read from ``/proc/cpuinfo`` (for the first CPU) once per process, and the
+    result is cached.
+
+    Returns:
+        frozenset: names of the CPU flags, as reported by ``/proc/cpuinfo`` (e.g. ``'avx512f'``).
+    """
     with open('/proc/cpuinfo', 'r') as file:
         for line in file:
             if line.startswith('flags'):
-                cpu_features = line.split(':')[1].strip().split()
-                break
-        else:
-            raise Exception('Failed to parse CPU flags')
+                return frozenset(line.split(':')[1].split())
+    raise Exception('Failed to parse CPU flags')
 
+@functools.lru_cache(maxsize=None)
+def get_supported_optional_xfrms():
+    """Get optional XFRM features supported by the CPU of this machine.
+
+    Returns:
+        tuple of int: XFRM bits of each supported feature from :data:`OPTIONAL_XFRM_FEATURES`.
+    """
+    cpu_features = get_cpu_features()
+    return tuple(bits for bits, feature in OPTIONAL_XFRM_FEATURES.items()
+                 if feature in cpu_features)
+
+def get_optional_sgx_features(sig):
+    '''Set optional SGX features if they are available on this machine.'''
     xfrms = sig['attribute_xfrms']
     xfrmmask = sig['attribute_xfrm_mask']
 
     new_xfrms = xfrms
-    for (bits, feature) in optional_sgx_features.items():
+    for bits in get_supported_optional_xfrms():
         # check if SIGSTRUCT.ATTRIBUTEMASK.XFRM doesn't care whether an optional CPU feature is
         # enabled or not (XFRM mask should completely unset these bits); set these CPU features as
         # enabled if so and if the current system supports these features (for performance)
-        if bits & xfrmmask == 0 and feature in cpu_features:
+        if bits & xfrmmask == 0:
             new_xfrms |= bits
 
     return new_xfrms
@@ -47,50 +68,266 @@ def is_oot():
 def p64(x):
     return x.to_bytes(8, byteorder='little')
 
-def connect_aesmd(mrenclave, modulus, flags, xfrms):
-    '''Connect with AESMD.'''
+# Interfaces exposed by AESMD, tried in this order
+AESMD_ADDRESSES = (
+    '/var/run/aesmd/aesm.socket',         # named socket (for PSW 1.8+)
+    '\0sgx_aesm_socket_base' + '\0' * 87  # unnamed socket (for PSW 1.6/1.7)
+)
+
+class AesmdError(Exception):
+    pass
 
-    from . import aesm_pb2 # pylint: disable=import-error,no-name-in-module
+class _ConnectionLost(ConnectionError):
+    pass
 
-    req_msg = aesm_pb2.GetTokenReq()
-    req_msg.req.signature = mrenclave
-    req_msg.req.key = modulus
-    req_msg.req.attributes = p64(flags) + p64(xfrms)
-    req_msg.req.timeout = 10000
+class AesmdClient:
+    """Client for the AESMD service.
 
-    req_msg_raw = req_msg.SerializeToString()
+    Connections to AESMD are kept open and reused by subsequent requests (also from other threads,
+    each of which uses a separate connection), until :meth:`close` is called. If AESMD closes a
+    connection, the requests which were not answered yet are retried on a new one.
 
-    aesm_service = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    Args:
+        address (str or None): address of the AESMD socket (a path, or a name starting with ``\\0``
+            for an abstract socket). If ``None``, all of :data:`AESMD_ADDRESSES` are tried.
+        timeout (float or None): timeout for socket operations, in seconds.
+        pipeline_depth (int): maximum number of requests sent before reading the responses in
+            :meth:`request_many`.
+        max_idle (int): maximum number of idle connections kept open.
+    """
 
-    # Try to connect to all possible interfaces exposed by aesm service
-    connections = (
-        '/var/run/aesmd/aesm.socket',         # named socket (for PSW 1.8+)
-        '\0sgx_aesm_socket_base' + '\0' * 87  # unnamed socket (for PSW 1.6/1.7)
-    )
+    def __init__(self, address=None, *, timeout=60, pipeline_depth=16, max_idle=4):
+        self.addresses = AESMD_ADDRESSES if address is None else (address,)
+        self.timeout = timeout
+        self.pipeline_depth = pipeline_depth
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
 
-    for conn in connections:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for sock in idle:
+            sock.close()
+
+    def _connect(self):
+        for address in self.addresses:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(address)
+            except OSError:
+                sock.close()
+                continue
+            return sock
+        raise ConnectionError('Cannot connect to the AESMD service')
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._connect(), False
+
+    def _release(self, sock):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(sock)
+                return
+        sock.close()
+
+    @staticmethod
+    def _send(sock, msg):
         try:
-            aesm_service.connect(conn)
-        except socket.error:
-            continue
-        break
-    else:
-        raise socket.error('Cannot connect to the AESMD service')
+            sock.sendall(struct.pack('<I', len(msg)) + msg)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            raise _ConnectionLost(f'AESMD closed the connection: {e}') from e
+
+    @staticmethod
+    def _recv_exact(sock, size):
+        buf = bytearray(size)
+        view = memoryview(buf)
+        pos = 0
+        while pos < size:
+            try:
+                received = sock.recv_into(view[pos:])
+            except ConnectionResetError as e:
+                raise _ConnectionLost(f'AESMD closed the connection: {e}') from e
+            if received == 0:
+                raise _ConnectionLost('AESMD closed the connection')
+            pos += received
+        return buf
+
+    def _recv(self, sock):
+        size, = struct.unpack('<I', self._recv_exact(sock, 4))
+        return bytes(self._recv_exact(sock, size))
+
+    def _exchange(self, sock, msgs, responses):
+        sent = 0
+        send_error = None
+        for received in range(len(msgs)):
+            while send_error is None and sent < len(msgs) and sent - received < self.pipeline_depth:
+                try:
+                    self._send(sock, msgs[sent])
+                except _ConnectionLost as e:
+                    # AESMD might have answered some of the requests before closing the connection
+                    # (e.g. if it answers only one request per connection), so stop sending and
+                    # read the responses which are already there
+                    send_error = e
+                    break
+                sent += 1
+            if received == sent:
+                raise send_error
+            responses.append(self._recv(sock))
+
+    def request_many(self, msgs):
+        """Send serialized requests to AESMD and receive serialized responses.
+
+        All the requests are sent over one connection, and up to *pipeline_depth* of them are sent
+        before waiting for responses.
+
+        Args:
+            msgs (list of bytes): serialized requests.
+
+        Returns:
+            list of bytes: serialized responses, in the order of the requests.
+
+        Raises:
+            ConnectionError: AESMD is not available or keeps closing the connection.
+        """
+        responses = []
+        while len(responses) < len(msgs):
+            done = len(responses)
+            sock, reused = self._acquire()
+            try:
+                self._exchange(sock, msgs[done:], responses)
+            except _ConnectionLost:
+                sock.close()
+                # A reused connection might have been closed by AESMD while it was idle, and some
+                # versions of AESMD answer only one request per connection, so try again with a new
+                # connection if this one was not new, or if it was but we got any response on it.
+                if not reused and len(responses) == done:
+                    raise
+                continue
+            except BaseException:
+                sock.close()
+                raise
+            self._release(sock)
+        return responses
+
+    def request(self, msg):
+        """Send a serialized request to AESMD and receive a serialized response."""
+        return self.request_many([msg])[0]
+
+    def get_tokens(self, requests):
+        """Get SGX tokens from AESMD.
 
-    aesm_service.send(struct.pack('<I', len(req_msg_raw)))
-    aesm_service.send(req_msg_raw)
+        Args:
+            requests (list of tuple): for each token, a tuple ``(mrenclave, modulus, flags,
+                xfrms)``, where *mrenclave* and *modulus* are bytes and *flags* and *xfrms* are
+                integers.
 
-    ret_msg_size = struct.unpack('<I', aesm_service.recv(4))[0]
-    ret_msg = aesm_pb2.GetTokenRet()
-    ret_msg_raw = aesm_service.recv(ret_msg_size)
-    ret_msg.ParseFromString(ret_msg_raw)
+        Returns:
+            list of bytes: SGX tokens, in the order of *requests*.
 
-    if ret_msg.ret.error != 0:
-        raise Exception(f'Failed. (Error Code = {ret_msg.ret.error})')
+        Raises:
+            AesmdError: AESMD failed to generate one of the tokens.
+            ConnectionError: AESMD is not available.
+        """
+        from . import aesm_pb2 # pylint: disable=import-error,no-name-in-module,import-outside-toplevel
 
-    return ret_msg.ret.token
+        msgs = []
+        for mrenclave, modulus, flags, xfrms in requests:
+            req_msg = aesm_pb2.GetTokenReq()
+            req_msg.req.signature = mrenclave
+            req_msg.req.key = modulus
+            req_msg.req.attributes = p64(flags) + p64(xfrms)
+            req_msg.req.timeout = 10000
+            msgs.append(req_msg.SerializeToString())
 
-def get_token(sig, verbose=False):
+        tokens = []
+        for ret_msg_raw in self.request_many(msgs):
+            ret_msg = aesm_pb2.GetTokenRet()
+            ret_msg.ParseFromString(ret_msg_raw)
+            if ret_msg.ret.error != 0:
+                raise AesmdError(f'Failed. (Error Code = {ret_msg.ret.error})')
+            tokens.append(ret_msg.ret.token)
+        return tokens
+
+    def get_token(self, mrenclave, modulus, flags, xfrms):
+        """Get an SGX token from AESMD. See :meth:`get_tokens`."""
+        return self.get_tokens([(mrenclave, modulus, flags, xfrms)])[0]
+
+@functools.lru_cache(maxsize=None)
+def get_aesmd_client():
+    '''Return the AESMD client shared by all callers in this process.'''
+    return AesmdClient()
+
+def connect_aesmd(mrenclave, modulus, flags, xfrms):
+    '''Get a token from AESMD, using the shared client.'''
+    return get_aesmd_client().get_token(mrenclave, modulus, flags, xfrms)
+
+def print_sigstruct_details(sig, xfrms):
+    # calculate MRSIGNER as sha256 hash over RSA public key's modulus
+    mrsigner = hashlib.sha256()
+    mrsigner.update(sig['modulus'])
+    mrsigner = mrsigner.hexdigest()
+
+    print('Attributes:')
+    print(f'    mr_enclave:  {sig["enclave_hash"].hex()}')
+    print(f'    mr_signer:   {mrsigner}')
+    print(f'    isv_prod_id: {sig["isv_prod_id"]}')
+    print(f'    isv_svn:     {sig["isv_svn"]}')
+    print(f'    attr.flags:  {sig["attribute_flags"]:016x}')
+    print(f'    attr.xfrm:   {xfrms:016x}')
+    print(f'    mask.flags:  {sig["attribute_flags_mask"]:016x}')
+    print(f'    mask.xfrm:   {sig["attribute_xfrm_mask"]:016x}')
+    print(f'    misc_select: {sig["misc_select"]:08x}')
+    print(f'    misc_mask:   {sig["misc_mask"]:08x}')
+    print(f'    modulus:     {sig["modulus"].hex()[:32]}...')
+    print(f'    exponent:    {sig["exponent"]}')
+    print(f'    signature:   {sig["signature"].hex()[:32]}...')
+    print(f'    date:        {sig["date_year"]:04d}-{sig["date_month"]:02d}-'
+          f'{sig["date_day"]:02d}')
+
+def get_tokens(sigs, verbose=False, client=None):
+    """Get SGX tokens (aka EINITTOKENs) for many SIGSTRUCTs.
+
+    This is faster than calling :func:`get_token` for each SIGSTRUCT, because all the requests are
+    sent to AESMD over one connection, without waiting for each response. See :func:`get_token` for
+    details.
+
+    Args:
+        sigs (list of Sigstruct): SIGSTRUCTs to generate the tokens for.
+        verbose (bool): If true, print details to stdout.
+        client (AesmdClient or None): AESMD client to use. If ``None``, a client shared by the whole
+            process is used.
+
+    Returns:
+        list of bytes: SGX tokens, in the order of *sigs*.
+    """
+    if not is_oot():
+        raise RuntimeError('The upstream driver doesn\'t use EINITTOKEN')
+
+    if client is None:
+        client = get_aesmd_client()
+
+    requests = []
+    for sig in sigs:
+        xfrms = get_optional_sgx_features(sig)
+        if verbose:
+            print_sigstruct_details(sig, xfrms)
+        requests.append((sig['enclave_hash'], sig['modulus'], sig['attribute_flags'], xfrms))
+
+    return client.get_tokens(requests)
+
+def get_token(sig, verbose=False, client=None):
     """Get SGX token (aka EINITTOKEN).
 
     Generates an SGX token from the given SIGSTRUCT. The resulting token might have some additional
@@ -103,36 +340,10 @@ def get_token(sig, verbose=False):
     Args:
         sig (Sigstruct): SIGSTRUCT to generate the token for.
         verbose (bool): If true, print details to stdout.
+        client (AesmdClient or None): AESMD client to use. If ``None``, a client shared by the whole
+            process (which keeps the connection to AESMD open between calls) is used.
 
     Returns:
         bytes: SGX token.
     """
-    if not is_oot():
-        raise RuntimeError('The upstream driver doesn\'t use EINITTOKEN')
-
-    xfrms = get_optional_sgx_features(sig)
-
-    # calculate MRSIGNER as sha256 hash over RSA public key's modulus
-    mrsigner = hashlib.sha256()
-    mrsigner.update(sig['modulus'])
-    mrsigner = mrsigner.hexdigest()
-
-    if verbose:
-        print('Attributes:')
-        print(f'    mr_enclave:  {sig["enclave_hash"].hex()}')
-        print(f'    mr_signer:   {mrsigner}')
-        print(f'    isv_prod_id: {sig["isv_prod_id"]}')
-        print(f'    isv_svn:     {sig["isv_svn"]}')
-        print(f'    attr.flags:  {sig["attribute_flags"]:016x}')
-        print(f'    attr.xfrm:   {xfrms:016x}')
-        print(f'    mask.flags:  {sig["attribute_flags_mask"]:016x}')
-        print(f'    mask.xfrm:   {sig["attribute_xfrm_mask"]:016x}')
-        print(f'    misc_select: {sig["misc_select"]:08x}')
-        print(f'    misc_mask:   {sig["misc_mask"]:08x}')
-        print(f'    modulus:     {sig["modulus"].hex()[:32]}...')
-        print(f'    exponent:    {sig["exponent"]}')
-        print(f'    signature:   {sig["signature"].hex()[:32]}...')
-        print(f'    date:        {sig["date_year"]:04d}-{sig["date_month"]:02d}-'
-              f'{sig["date_day"]:02d}')
-
-    return connect_aesmd(sig['enclave_hash'], sig['modulus'], sig['attribute_flags'], xfrms)
+    return get_tokens([sig], verbose=verbose, client=client)[0]
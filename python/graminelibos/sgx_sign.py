@@ -6,15 +6,19 @@
 #                    Wojtek Porczyk <woju@invisiblethingslab.com>
 #
 
+import array
+import datetime
 import hashlib
+import io
 import os
 import pathlib
 import struct
-import subprocess
+import sys
+import threading
 
 from cryptography.hazmat import backends
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
 
 import elftools.elf.elffile
 
@@ -40,8 +44,6 @@ SGX_RSA_KEY_PATH = _xdg_config_home / 'gramine' / 'enclave-key.pem'
 
 # Utilities
 
-ZERO_PAGE = bytes(offs.PAGESIZE)
-
 
 def roundup(addr):
     remaining = addr % offs.PAGESIZE
@@ -114,23 +116,49 @@ PAGEINFO_TCS = 0x100
 PAGEINFO_REG = 0x200
 
 
+def iter_loadcmds(elf):
+    for seg in elf.iter_segments():
+        if seg.header.p_type != 'PT_LOAD':
+            continue
+        yield (
+            seg.header.p_offset,
+            seg.header.p_vaddr,
+            seg.header.p_filesz,
+            seg.header.p_memsz,
+            seg.header.p_flags)
+
+
 def get_loadcmds(elf_filename):
     with open(elf_filename, 'rb') as file:
-        for seg in elftools.elf.elffile.ELFFile(file).iter_segments():
-            if seg.header.p_type != 'PT_LOAD':
-                continue
-            yield (
-                seg.header.p_offset,
-                seg.header.p_vaddr,
-                seg.header.p_filesz,
-                seg.header.p_memsz,
-                seg.header.p_flags)
+        yield from iter_loadcmds(elftools.elf.elffile.ELFFile(file))
+
+
+class ElfImage:
+    """ELF file loaded into memory, with the loadable segments laid out in pages.
+
+    Args:
+        elf_filename (str): Path to the ELF file.
+        data (:obj:`bytes`, optional): Contents of the file, if already read.
+    """
+    # pylint: disable=too-few-public-methods
+    def __init__(self, elf_filename, data=None):
+        if data is None:
+            with open(elf_filename, 'rb') as file:
+                data = file.read()
+
+        file = io.BytesIO(data)
+        elf = elftools.elf.elffile.ELFFile(file)
+        self.filename = elf_filename
+        self.entry = elf.header.e_entry
+        self.loadcmds = list(iter_loadcmds(elf))
+        self.segments = [read_segment(file, offset, addr, filesize, memsize)
+                         for (offset, addr, filesize, memsize, _) in self.loadcmds]
 
 
 class MemoryArea:
     # pylint: disable=too-few-public-methods,too-many-instance-attributes
     def __init__(self, desc, elf_filename=None, content=None, addr=None, size=None,
-                 flags=None, measure=True):
+                 flags=None, measure=True, elf=None):
         # pylint: disable=too-many-arguments
         self.desc = desc
         self.elf_filename = elf_filename
@@ -139,11 +167,15 @@ class MemoryArea:
         self.size = size
         self.flags = flags
         self.measure = measure
+        self.elf = elf
 
         if elf_filename:
+            if self.elf is None:
+                self.elf = ElfImage(elf_filename)
+
             mapaddr = 0xffffffffffffffff
             mapaddr_end = 0
-            for (_, addr_, _, memsize, _) in get_loadcmds(elf_filename):
+            for (_, addr_, _, memsize, _) in self.elf.loadcmds:
                 if rounddown(addr_) < mapaddr:
                     mapaddr = rounddown(addr_)
                 if roundup(addr_ + memsize) > mapaddr_end:
@@ -159,26 +191,62 @@ class MemoryArea:
             self.size = roundup(self.size)
 
 
-def get_memory_areas(attr, libpal):
-    areas = []
-    areas.append(
-        MemoryArea('ssa',
-                   size=attr['max_threads'] * offs.SSA_FRAME_SIZE * offs.SSA_FRAME_NUM,
-                   flags=PAGEINFO_R | PAGEINFO_W | PAGEINFO_REG))
-    areas.append(MemoryArea('tcs', size=attr['max_threads'] * offs.TCS_SIZE,
-                            flags=PAGEINFO_TCS))
-    areas.append(MemoryArea('tls', size=attr['max_threads'] * offs.PAGESIZE,
-                            flags=PAGEINFO_R | PAGEINFO_W | PAGEINFO_REG))
-
-    for _ in range(attr['max_threads']):
-        areas.append(MemoryArea('stack', size=offs.ENCLAVE_STACK_SIZE,
-                                flags=PAGEINFO_R | PAGEINFO_W | PAGEINFO_REG))
-    for _ in range(attr['max_threads']):
-        areas.append(MemoryArea('sig_stack', size=offs.ENCLAVE_SIG_STACK_SIZE,
+class MeasurementPlan:
+    """Parts of the enclave layout, which do not depend on the manifest.
+
+    This holds the parsed libpal, with its segments already laid out in pages, and the sizes of
+    memory areas. Plans are cached per libpal contents, enclave size, number of threads and EDMM
+    enablement, so signing many manifests against the same libpal parses it only once. Use
+    :py:meth:`get` to obtain a plan.
+    """
+    # pylint: disable=too-few-public-methods
+    _cache = {}
+    _cache_lock = threading.Lock()
+
+    def __init__(self, attr, pal):
+        self.max_threads = attr['max_threads']
+        self.pal = pal
+
+    @classmethod
+    def get(cls, attr, libpal):
+        """Get a (possibly cached) plan for enclave attributes *attr* and the libpal file."""
+        with open(libpal, 'rb') as file:
+            data = file.read()
+        key = (hashlib.sha256(data).digest(), attr['enclave_size'], attr['max_threads'],
+               attr['edmm_enable'])
+
+        with cls._cache_lock:
+            plan = cls._cache.get(key)
+            if plan is None:
+                plan = cls._cache[key] = cls(attr, ElfImage(libpal, data))
+        return plan
+
+    def get_memory_areas(self):
+        """Create memory areas (except the manifest), not yet placed in the enclave."""
+        areas = []
+        areas.append(
+            MemoryArea('ssa',
+                       size=self.max_threads * offs.SSA_FRAME_SIZE * offs.SSA_FRAME_NUM,
+                       flags=PAGEINFO_R | PAGEINFO_W | PAGEINFO_REG))
+        areas.append(MemoryArea('tcs', size=self.max_threads * offs.TCS_SIZE,
+                                flags=PAGEINFO_TCS))
+        areas.append(MemoryArea('tls', size=self.max_threads * offs.PAGESIZE,
                                 flags=PAGEINFO_R | PAGEINFO_W | PAGEINFO_REG))
 
-    areas.append(MemoryArea('pal', elf_filename=libpal, flags=PAGEINFO_REG))
-    return areas
+        for _ in range(self.max_threads):
+            areas.append(MemoryArea('stack', size=offs.ENCLAVE_STACK_SIZE,
+                                    flags=PAGEINFO_R | PAGEINFO_W | PAGEINFO_REG))
+        for _ in range(self.max_threads):
+            areas.append(MemoryArea('sig_stack', size=offs.ENCLAVE_SIG_STACK_SIZE,
+                                    flags=PAGEINFO_R | PAGEINFO_W | PAGEINFO_REG))
+
+        areas.append(MemoryArea('pal', elf_filename=self.pal.filename, elf=self.pal,
+                                flags=PAGEINFO_REG))
+        return areas
+
+
+def get_memory_areas(attr, libpal):
+    return MeasurementPlan.get(attr, libpal).get_memory_areas()
 
 
 def find_areas(areas, desc):
@@ -240,7 +308,7 @@ def gen_area_content(attr, areas, enclave_base, enclave_heap_min):
         set_tcs_field(t, offs.TCS_OSSA, '<Q', ssa_offset)
         set_tcs_field(t, offs.TCS_NSSA, '<L', offs.SSA_FRAME_NUM)
         set_tcs_field(t, offs.TCS_OENTRY, '<Q',
-                      pal_area.addr + entry_point(pal_area.elf_filename) - enclave_base)
+                      pal_area.addr + pal_area.elf.entry - enclave_base)
         set_tcs_field(t, offs.TCS_OGS_BASE, '<Q', tls_area.addr - enclave_base + offs.PAGESIZE * t)
         set_tcs_field(t, offs.TCS_OFS_LIMIT, '<L', 0xfff)
         set_tcs_field(t, offs.TCS_OGS_LIMIT, '<L', 0xfff)
@@ -301,36 +369,162 @@ def populate_memory_areas(attr, areas, enclave_base, enclave_heap_min):
     return areas + free_areas
 
 
-def generate_measurement(enclave_base, attr, areas, verbose=False):
-    # pylint: disable=too-many-statements,too-many-branches,too-many-locals
+# Measurement records, see "Intel SDM, Vol. 3D, 38.7 Enclave Measurement"
+EADD_RECORD = struct.Struct('<8sQQ40s')
+EEXTEND_RECORD = struct.Struct('<8sQ48s')
+EEXTEND_CHUNK_SIZE = 256
 
-    def do_ecreate(digest, size):
-        data = struct.pack('<8sLQ44s', b'ECREATE', offs.SSA_FRAME_SIZE // offs.PAGESIZE, size, b'')
-        digest.update(data)
+# Number of pages, for which measurement records are generated and hashed at once
+MEASUREMENT_BATCH_PAGES = 1024
 
-    def do_eadd(digest, offset, flags):
-        assert offset < attr['enclave_size']
-        data = struct.pack('<8sQQ40s', b'EADD', offset, flags, b'')
-        digest.update(data)
+# Size of enclave memory, for which EADD records of unmeasured pages are prebuilt. Must be 2**24,
+# so that page offsets inside an aligned window differ only in the lowest 3 bytes.
+UNMEASURED_WINDOW_SIZE = 1 << 24
 
-    def do_eextend(digest, offset, content):
-        assert offset < attr['enclave_size']
 
-        if len(content) != 256:
-            raise ValueError('Exactly 256 bytes expected')
+def uint64_array(values):
+    """Create a little-endian ``array.array`` of unsigned 64-bit integers."""
+    ret = array.array('Q', values)
+    if sys.byteorder != 'little':
+        ret.byteswap()
+    return ret
 
-        data = struct.pack('<8sQ48s', b'EEXTEND', offset, b'')
-        digest.update(data)
-        digest.update(content)
 
-    def include_page(digest, addr, flags, content, measure):
-        if len(content) != offs.PAGESIZE:
-            raise ValueError('Exactly one page expected')
+def measure_unmeasured_pages(digest, offset, npages, flags):
+    """Add EADD records of consecutive unmeasured enclave pages to *digest*.
+
+    Such ranges (the heap of non-EDMM enclaves) can span gigabytes, so instead of generating all
+    the records, we prebuild a template of records for one window of ``UNMEASURED_WINDOW_SIZE``
+    bytes of enclave memory. Within a window aligned to its size, offsets of pages differ only in
+    their lowest 3 bytes, so moving the template to the next window requires patching only the
+    upper 5 bytes of the offsets, each with a single strided assignment.
+
+    Args:
+        digest: SHA-256 object to update.
+        offset (int): Offset of the first page, relative to the enclave base.
+        npages (int): Number of pages.
+        flags (int): ``PAGEINFO_*`` flags of the pages.
+    """
+    # pylint: disable=too-many-locals
+    window_pages = UNMEASURED_WINDOW_SIZE // offs.PAGESIZE
+    record_size = EADD_RECORD.size
+    field = 8 # position of the page offset in EADD record
+
+    buf = bytearray(EADD_RECORD.pack(b'EADD', 0, flags, b'')) * window_pages
+    with memoryview(buf).cast('Q') as words:
+        words[field // 8::record_size // 8] = uint64_array(
+            range(0, UNMEASURED_WINDOW_SIZE, offs.PAGESIZE))
+    template_base = 0
+
+    end = offset + npages * offs.PAGESIZE
+    with memoryview(buf) as view:
+        while offset < end:
+            window = offset - offset % UNMEASURED_WINDOW_SIZE
+            for i in range(3, 8):
+                byte = (window >> (8 * i)) & 0xff
+                if (template_base >> (8 * i)) & 0xff != byte:
+                    view[field + i::record_size] = bytes((byte,)) * window_pages
+            template_base = window
+
+            first = (offset - window) // offs.PAGESIZE
+            last = (min(end, window + UNMEASURED_WINDOW_SIZE) - window) // offs.PAGESIZE
+            digest.update(view[first * record_size:last * record_size])
+            offset = window + UNMEASURED_WINDOW_SIZE
+
+
+def measure_pages(digest, offset, npages, flags, content=None, measure=True):
+    """Add measurement of consecutive enclave pages to *digest*.
+
+    Equivalent to issuing EADD (and, if *measure* is true, EEXTEND over each 256-byte chunk) for
+    every page, but generates the records for many pages in one buffer, using strided copies over
+    a :py:class:`memoryview` instead of per-chunk Python calls.
+
+    Args:
+        digest: SHA-256 object to update.
+        offset (int): Offset of the first page, relative to the enclave base.
+        npages (int): Number of pages.
+        flags (int): ``PAGEINFO_*`` flags of the pages.
+        content (:obj:`bytes`-like, optional): Content of the pages, exactly *npages* pages long.
+            If not given, the pages are zeroed.
+        measure (:obj:`bool`, optional): Whether to EEXTEND the pages.
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+    if not measure:
+        measure_unmeasured_pages(digest, offset, npages, flags)
+        return
+
+    chunks_per_page = offs.PAGESIZE // EEXTEND_CHUNK_SIZE
+    eadd = EADD_RECORD.pack(b'EADD', 0, flags, b'')
+    eextend = EEXTEND_RECORD.pack(b'EEXTEND', 0, b'') + bytes(EEXTEND_CHUNK_SIZE)
+    page_record = eadd + eextend * chunks_per_page
+
+    # All indices below are in 64-bit words
+    record_words = len(page_record) // 8
+    eadd_words = len(eadd) // 8
+    eextend_words = len(eextend) // 8
+    chunk_words = EEXTEND_CHUNK_SIZE // 8
+    page_words = offs.PAGESIZE // 8
+
+    if content is not None:
+        if len(content) != npages * offs.PAGESIZE:
+            raise ValueError('Content does not match the number of pages')
+        content = memoryview(content).cast('B')
+
+    for batch_start in range(0, npages, MEASUREMENT_BATCH_PAGES):
+        batch_pages = min(MEASUREMENT_BATCH_PAGES, npages - batch_start)
+        batch_offset = offset + batch_start * offs.PAGESIZE
+        batch_end = batch_offset + batch_pages * offs.PAGESIZE
+
+        buf = bytearray(page_record * batch_pages)
+        with memoryview(buf).cast('Q') as words:
+            words[1::record_words] = uint64_array(
+                range(batch_offset, batch_end, offs.PAGESIZE))
+
+            for chunk in range(chunks_per_page):
+                record = eadd_words + chunk * eextend_words
+                words[record + 1::record_words] = uint64_array(
+                    range(batch_offset + chunk * EEXTEND_CHUNK_SIZE, batch_end, offs.PAGESIZE))
+
+            if content is not None:
+                start = batch_start * offs.PAGESIZE
+                with content[start:start + batch_pages * offs.PAGESIZE].cast('Q') as src:
+                    for chunk in range(chunks_per_page):
+                        dst = eadd_words + chunk * eextend_words + EEXTEND_RECORD.size // 8
+                        for i in range(chunk_words):
+                            words[dst + i::record_words] = src[chunk * chunk_words + i::
+                                                               page_words]
+
+        digest.update(buf)
+
+
+def read_segment(file, offset, addr, filesize, memsize):
+    """Read an ELF segment into a buffer spanning whole pages, as it is mapped in memory."""
+    m_addr = rounddown(addr)
+    m_size = roundup(addr + memsize) - m_addr
+
+    file.seek(offset)
+    data = file.read(filesize)
+    if len(data) != filesize:
+        raise Exception('wrong calculation')
+
+    content = bytearray(m_size)
+    start = addr - m_addr
+    content[start:start + filesize] = data
+    return m_addr, content
+
 
-        do_eadd(digest, addr - enclave_base, flags)
-        if measure:
-            for i in range(0, offs.PAGESIZE, 256):
-                do_eextend(digest, addr - enclave_base + i, content[i:i + 256])
+def generate_measurement(enclave_base, attr, areas, verbose=False):
+    # pylint: disable=too-many-locals
+
+    def do_ecreate(digest, size):
+        data = struct.pack('<8sLQ44s', b'ECREATE', offs.SSA_FRAME_SIZE // offs.PAGESIZE, size, b'')
+        digest.update(data)
+
+    def include_pages(digest, addr, size, flags, content, measure):
+        # pylint: disable=too-many-arguments
+        offset = addr - enclave_base
+        assert offset + size <= attr['enclave_size']
+        measure_pages(digest, offset, size // offs.PAGESIZE, flags, content, measure)
 
     mrenclave = hashlib.sha256()
     do_ecreate(mrenclave, attr['enclave_size'])
@@ -357,80 +551,37 @@ def generate_measurement(enclave_base, attr, areas, verbose=False):
 
         print(f'    {addr:016x}-{addr+size:016x} [{type_}:{prot}] {desc}')
 
-    def load_file(digest, file, offset, addr, filesize, memsize, desc, flags):
-        # pylint: disable=too-many-arguments
-        f_addr = rounddown(offset)
-        m_addr = rounddown(addr)
-        m_size = roundup(addr + memsize) - m_addr
-
-        if verbose:
-            print_area(m_addr, m_size, flags, desc, True)
-
-        for page in range(m_addr, m_addr + m_size, offs.PAGESIZE):
-            start = page - m_addr + f_addr
-            end = start + offs.PAGESIZE
-            start_zero = b''
-            if start < offset:
-                if offset - start >= offs.PAGESIZE:
-                    start_zero = ZERO_PAGE
-                else:
-                    start_zero = bytes(offset - start)
-            end_zero = b''
-            if end > offset + filesize:
-                if end - offset - filesize >= offs.PAGESIZE:
-                    end_zero = ZERO_PAGE
-                else:
-                    end_zero = bytes(end - offset - filesize)
-            start += len(start_zero)
-            end -= len(end_zero)
-            if start < end:
-                file.seek(start)
-                data = file.read(end - start)
-            else:
-                data = b''
-            if len(start_zero + data + end_zero) != offs.PAGESIZE:
-                raise Exception('wrong calculation')
-
-            include_page(digest, page, flags, start_zero + data + end_zero, True)
-
     if verbose:
         print('Memory:')
 
     for area in areas:
-        if area.elf_filename is not None:
-            with open(area.elf_filename, 'rb') as file:
-                loadcmds = list(get_loadcmds(area.elf_filename))
-                if loadcmds:
-                    mapaddr = 0xffffffffffffffff
-                    for (offset, addr, filesize, memsize,
-                         prot) in loadcmds:
-                        if rounddown(addr) < mapaddr:
-                            mapaddr = rounddown(addr)
-                baseaddr_ = area.addr - mapaddr
-                for (offset, addr, filesize, memsize, prot) in loadcmds:
-                    flags = area.flags
-                    if prot & 4:
-                        flags = flags | PAGEINFO_R
-                    if prot & 2:
-                        flags = flags | PAGEINFO_W
-                    if prot & 1:
-                        flags = flags | PAGEINFO_X
-
-                    if flags & PAGEINFO_X:
-                        desc = 'code'
-                    else:
-                        desc = 'data'
-                    load_file(mrenclave, file, offset, baseaddr_ + addr, filesize, memsize,
-                              desc, flags)
+        if area.elf is not None:
+            loadcmds = area.elf.loadcmds
+            mapaddr = min(rounddown(addr) for (_, addr, _, _, _) in loadcmds)
+            baseaddr_ = area.addr - mapaddr
+            for (_, _, _, _, prot), (m_addr, content) in zip(loadcmds, area.elf.segments):
+                flags = area.flags
+                if prot & 4:
+                    flags = flags | PAGEINFO_R
+                if prot & 2:
+                    flags = flags | PAGEINFO_W
+                if prot & 1:
+                    flags = flags | PAGEINFO_X
+
+                if flags & PAGEINFO_X:
+                    desc = 'code'
+                else:
+                    desc = 'data'
+
+                if verbose:
+                    print_area(baseaddr_ + m_addr, len(content), flags, desc, True)
+                include_pages(mrenclave, baseaddr_ + m_addr, len(content), flags, content, True)
         else:
-            for addr in range(area.addr, area.addr + area.size, offs.PAGESIZE):
-                data = ZERO_PAGE
-                if area.content is not None:
-                    start = addr - area.addr
-                    end = start + offs.PAGESIZE
-                    data = area.content[start:end]
-                    data += b'\0' * (offs.PAGESIZE - len(data)) # pad last page
-                include_page(mrenclave, addr, area.flags, data, area.measure)
+            content = None
+            if area.content is not None:
+                content = area.content[:area.size]
+                content += b'\0' * (area.size - len(content)) # pad last page
+            include_pages(mrenclave, area.addr, area.size, area.flags, content, area.measure)
 
             if verbose:
                 print_area(area.addr, area.size, area.flags, area.desc, area.measure)
@@ -438,10 +589,13 @@ def generate_measurement(enclave_base, attr, areas, verbose=False):
     return mrenclave.digest()
 
 
-def get_mrenclave_and_manifest(manifest_path, libpal, verbose=False):
-    with open(manifest_path, 'rb') as f: # pylint: disable=invalid-name
-        manifest_data = f.read()
-    manifest = Manifest.loads(manifest_data.decode('utf-8'))
+def get_mrenclave_and_manifest(manifest_path, libpal, verbose=False, *, manifest=None,
+                               manifest_data=None):
+    if manifest_data is None:
+        with open(manifest_path, 'rb') as f: # pylint: disable=invalid-name
+            manifest_data = f.read()
+    if manifest is None:
+        manifest = Manifest.loads(manifest_data.decode('utf-8'))
 
     manifest_sgx = manifest['sgx']
     attr = {
@@ -502,7 +656,8 @@ def get_mrenclave_and_manifest(manifest_path, libpal, verbose=False):
     return mrenclave, manifest
 
 
-def get_tbssigstruct(manifest_path, date, libpal=SGX_LIBPAL, verbose=False):
+def get_tbssigstruct(manifest_path, date, libpal=SGX_LIBPAL, verbose=False, *, manifest=None,
+                     manifest_data=None):
     """Generate To Be Signed Sigstruct (TBSSIGSTRUCT).
 
     Generates a Sigstruct object using the provided data with all required fields initialized (i.e.
@@ -513,12 +668,20 @@ def get_tbssigstruct(manifest_path, date, libpal=SGX_LIBPAL, verbose=False):
         date (date): Date to put into SIGSTRUCT.
         libpal (:obj:`str`, optional): Path to the libpal file.
         verbose (:obj:`bool`, optional): If true, print details to stdout.
+        manifest (:obj:`Manifest`, optional): The manifest, if already loaded. Must correspond to
+            *manifest_data*.
+        manifest_data (:obj:`bytes`, optional): Contents of the manifest file, if already known.
+            If given, *manifest_path* is not read.
 
     Returns:
         Sigstruct: SIGSTRUCT generated from provided data.
     """
+    # The last two are optional keyword-only arguments, which let sign_manifest() skip writing and
+    # parsing the manifest again, so they don't make the usual calls any more complicated
+    # pylint: disable=too-many-arguments
 
-    mrenclave, manifest = get_mrenclave_and_manifest(manifest_path, libpal, verbose=verbose)
+    mrenclave, manifest = get_mrenclave_and_manifest(manifest_path, libpal, verbose=verbose,
+                                                     manifest=manifest, manifest_data=manifest_data)
 
     manifest_sgx = manifest['sgx']
 
@@ -539,6 +702,70 @@ def get_tbssigstruct(manifest_path, date, libpal=SGX_LIBPAL, verbose=False):
     return sig
 
 
+_private_keys = {}
+_private_keys_lock = threading.Lock()
+
+def load_private_key(key):
+    """Load RSA private key from a PEM file.
+
+    Keys are cached (by path and modification time of the file), so the file is parsed only once
+    per process, even if used for signing many SIGSTRUCTs.
+
+    Args:
+        key (str): Path to a file with RSA private key.
+
+    Returns:
+        cryptography.hazmat.primitives.asymmetric.rsa.RSAPrivateKey: private key
+
+    Raises:
+        ValueError: The key is not a 3072-bit RSA key with the public exponent of 3.
+    """
+    cache_key = (os.path.abspath(key), os.stat(key).st_mtime_ns)
+    with _private_keys_lock:
+        private_key = _private_keys.get(cache_key)
+    if private_key is not None:
+        return private_key
+
+    with open(key, 'rb') as f:
+        private_key = serialization.load_pem_private_key(f.read(), password=None,
+                                                         backend=_cryptography_backend)
+    if not isinstance(private_key, rsa.RSAPrivateKey):
+        raise ValueError(f'{key} is not an RSA private key')
+    if private_key.key_size != SGX_RSA_KEY_SIZE:
+        raise ValueError(f'{key} has wrong key size ({private_key.key_size}), '
+                         f'SGX requires {SGX_RSA_KEY_SIZE}')
+    exponent = private_key.public_key().public_numbers().e
+    if exponent != SGX_RSA_PUBLIC_EXPONENT:
+        raise ValueError(f'{key} has wrong public exponent ({exponent}), '
+                         f'SGX requires {SGX_RSA_PUBLIC_EXPONENT}')
+
+    with _private_keys_lock:
+        return _private_keys.setdefault(cache_key, private_key)
+
+
+def sign_with_private_key(data, private_key):
+    """Signs *data* using *private_key*.
+
+    Like :py:func:`sign_with_local_key`, but takes an already loaded key. Suitable to be used as
+    a callback to :py:func:`graminelibos.Sigstruct.sign()`.
+
+    Args:
+        data (bytes): Data to calculate the signature over.
+        private_key (cryptography.hazmat.primitives.asymmetric.rsa.RSAPrivateKey): Private key.
+
+    Returns:
+        (int, int, int): Tuple of exponent, modulus and signature respectively.
+    """
+    signature = private_key.sign(bytes(data), padding.PKCS1v15(), hashes.SHA256())
+    public_numbers = private_key.public_key().public_numbers()
+
+    exponent_int = public_numbers.e
+    modulus_int = public_numbers.n
+    signature_int = int.from_bytes(signature, byteorder='big')
+
+    return exponent_int, modulus_int, signature_int
+
+
 def sign_with_local_key(data, key):
     """Signs *data* using *key*.
 
@@ -553,22 +780,48 @@ def sign_with_local_key(data, key):
     Returns:
         (int, int, int): Tuple of exponent, modulus and signature respectively.
     """
-    proc = subprocess.Popen(
-        ['openssl', 'rsa', '-modulus', '-in', key, '-noout'],
-        stdout=subprocess.PIPE)
-    modulus_out, _ = proc.communicate()
-    modulus = bytes.fromhex(modulus_out[8:8+offs.SE_KEY_SIZE*2].decode())
-
-    proc = subprocess.Popen(
-        ['openssl', 'sha256', '-binary', '-sign', key],
-        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    signature, _ = proc.communicate(data)
-
-    exponent_int = 3
-    modulus_int = int.from_bytes(modulus, byteorder='big')
-    signature_int = int.from_bytes(signature, byteorder='big')
+    return sign_with_private_key(data, load_private_key(key))
 
-    return exponent_int, modulus_int, signature_int
+
+def sign_manifest(manifest, output, sigfile, key, libpal=SGX_LIBPAL, *, date=None, jobs=None,
+                  hash_cache=None, verbose=False):
+    """Expand trusted files of a manifest and sign it.
+
+    Writes the final manifest (with all trusted files expanded) to *output* and the SIGSTRUCT
+    signed with *key* to *sigfile*. Can be called from many threads at once.
+
+    Args:
+        manifest (Manifest): Manifest to sign.
+        output (str): Path to the output manifest file.
+        sigfile (str): Path to the output SIGSTRUCT file.
+        key (str): Path to a file with RSA private key.
+        libpal (:obj:`str`, optional): Path to the libpal file.
+        date (:obj:`date`, optional): Date to put into SIGSTRUCT. Defaults to today.
+        jobs (:obj:`int`, optional): Number of threads used for hashing trusted files.
+        hash_cache (:obj:`graminelibos.hash_cache.HashCache`, optional): Cache of trusted files
+            hashes.
+        verbose (:obj:`bool`, optional): If true, print details to stdout.
+
+    Returns:
+        list: All expanded files (see :py:meth:`Manifest.expand_all_trusted_files`).
+    """
+    # pylint: disable=too-many-arguments
+    expanded = manifest.expand_all_trusted_files(jobs=jobs, hash_cache=hash_cache,
+                                                 verbose=verbose)
+
+    # Measure the same bytes that we write, instead of reading and parsing the output back
+    manifest_data = manifest.dumps().encode('utf-8')
+    with open(output, 'wb') as f:
+        f.write(manifest_data)
+
+    sigstruct = get_tbssigstruct(output, date or datetime.date.today(), libpal, verbose=verbose,
+                                 manifest=manifest, manifest_data=manifest_data)
+    sigstruct.sign(sign_with_local_key, key)
+
+    with open(sigfile, 'wb') as f:
+        f.write(sigstruct.to_bytes())
+
+    return expanded
 
 
 def generate_private_key():
@@ -2,11 +2,41 @@
 # Copyright (C) 2021 Intel Corporation
 #                    Borys Popławski <borysp@invisiblethingslab.com>
 
+import hashlib
+import mmap
+import operator
+import os
 import struct
 import sys
 
 import _graminelibos_offsets as offs # pylint: disable=import-error
 
+# DER encoding of DigestInfo for SHA-256, prepended to the hash in RSASSA-PKCS1-v1_5 (RFC 8017)
+_SHA256_DIGEST_INFO_PREFIX = bytes.fromhex('3031300d060960864801650304020105000420')
+
+_DATE_FIELDS = ('date_year', 'date_month', 'date_day')
+_SIGNATURE_FIELDS = ('modulus', 'exponent', 'signature', 'q1', 'q2')
+
+
+class _Field:
+    __slots__ = ('name', 'offset', 'struct', 'bit', 'is_date')
+
+    def __init__(self, name, offset, fmt, bit):
+        self.name = name
+        self.offset = offset
+        self.struct = struct.Struct(fmt)
+        self.bit = bit
+        self.is_date = name in _DATE_FIELDS
+
+
+def _pack_defaults(fields, defaults):
+    buffer = bytearray(offs.SGX_ARCH_SIGSTRUCT_SIZE)
+    set_fields = 0
+    for name, value in defaults.items():
+        fields[name].struct.pack_into(buffer, fields[name].offset, value)
+        set_fields |= fields[name].bit
+    return bytes(buffer), set_fields
+
 
 class Sigstruct:
     """Class for holding SGX SIGSTRUCT.
@@ -14,8 +44,15 @@ class Sigstruct:
     Each field can be accessed and modified using ``[]`` operator. Accessing or setting an unknown
     key raises ``KeyError`` and setting a key to a value not matching required format raises
     ``ValueError``.
+
+    The fields are stored directly in a buffer with the byte representation of SIGSTRUCT, so
+    serializing and parsing it only copies the buffer. Values set with ``[]`` are also kept as they
+    were given (e.g. byte strings shorter than the field are not padded), and returned unchanged.
+    Byte fields can also be accessed without copying (on Python 3.8+) with :meth:`get_view`.
     """
 
+    __slots__ = ('_buffer', '_set_fields', '_values')
+
     fields = {
         'header': (offs.SGX_ARCH_SIGSTRUCT_HEADER, '16s'),
         'vendor': (offs.SGX_ARCH_SIGSTRUCT_VENDOR, '<L'),
@@ -40,7 +77,6 @@ class Sigstruct:
         'q2': (offs.SGX_ARCH_SIGSTRUCT_Q2, '384s'),
     }
 
-
     defaults = {
         'header': b'\x06\x00\x00\x00\xe1\x00\x00\x00\x00\x00\x01\x00\x00\x00\x00\x00',
         'vendor': 0,
@@ -51,30 +87,102 @@ class Sigstruct:
         'attribute_xfrm_mask': offs.SGX_XFRM_MASK_CONST,
     }
 
+    _fields = {name: _Field(name, offset, fmt, 1 << i)
+               for i, (name, (offset, fmt)) in enumerate(fields.items())}
+    _initial_buffer, _initial_set_fields = _pack_defaults(_fields, defaults)
+
+    # Fields which need to be set before calling to_bytes(verify=True), without and with
+    # `verify_sig_fields`
+    _required_mask = sum(field.bit for field in _fields.values()
+                         if field.name not in _SIGNATURE_FIELDS)
+    _required_mask_sig = sum(field.bit for field in _fields.values())
+
 
     def __init__(self):
-        self._data = {}
-        for k, v in self.defaults.items():
-            self._data[k] = v
+        self._buffer = bytearray(self._initial_buffer)
+        self._set_fields = self._initial_set_fields
+        self._values = {}
 
 
     def __getitem__(self, key):
-        return self._data[key]
+        field = self._fields[key]
+        if not self._set_fields & field.bit:
+            raise KeyError(key)
+        if key in self._values:
+            return self._values[key]
+        value = field.struct.unpack_from(self._buffer, field.offset)[0]
+        if field.is_date:
+            # See __setitem__() for explanation.
+            return int(f'{value:x}')
+        return value
 
 
     def __setitem__(self, key, val):
         try:
-            struct.pack(self.fields[key][1], val)
+            field = self._fields[key]
         except KeyError:
-            raise KeyError(f'unknown field name {key}')
-        except struct.error:
-            raise ValueError(f'{val} does not match required format {self.fields[key][1]}')
+            raise KeyError(f'unknown field name {key}') from None
 
-        self._data[key] = val
+        try:
+            if field.is_date:
+                # `SIGSTRUCT.DATE` (signing date) is stored in yyyymmdd format in hex: yyyy=4
+                # digit year, mm=1-12, dd=1-31 according to Intel SDM (Table 35-21. Layout of
+                # Enclave Signature Structure (SIGSTRUCT), Chapter 34, Volume 3, version March
+                # 2023). Further, SGX SDK and some code signing systems interpret it as
+                # "Binary-coded decimal", e.g., expecting "14 04 23 20" rather than "0e 04 e7 07"
+                # for date "2023-04-14" in its byte representation. See below for details:
+                # - https://github.com/intel/linux-sgx/blob/1efe23c20e37f868498f8287921eedfbcecdc216/sdk/sign_tool/SignTool/manage_metadata.cpp#L252-L253
+                # - https://en.wikipedia.org/wiki/Binary-coded_decimal
+                # We thus treat the date-related inputs as if they are hex numbers.
+                packed_val = int(f'{operator.index(val)}', 16)
+            else:
+                packed_val = val
+            # not pack_into(), which may partially overwrite the field before failing
+            data = field.struct.pack(packed_val)
+        except (struct.error, TypeError):
+            raise ValueError(f'{val} does not match required format {self.fields[key][1]}') \
+                from None
+
+        self._buffer[field.offset:field.offset + len(data)] = data
+        self._set_fields |= field.bit
+        self._values[key] = val
 
 
     def __contains__(self, key):
-        return key in self._data
+        field = self._fields.get(key)
+        return field is not None and bool(self._set_fields & field.bit)
+
+
+    def get_view(self, key):
+        """Get a read-only view of a field, without copying it (on Python 3.8+).
+
+        Whether the view reflects later modifications of the field depends on the Python version,
+        so it should not be kept after modifying the SIGSTRUCT.
+
+        Args:
+            key (str): name of the field.
+
+        Returns:
+            memoryview: raw bytes of the field (for integer fields, in little-endian order).
+
+        Raises:
+            KeyError: *key* is an unknown field name or the field is not set.
+        """
+        field = self._fields[key]
+        if not self._set_fields & field.bit:
+            raise KeyError(key)
+        view = memoryview(self._buffer)[field.offset:field.offset + field.struct.size]
+        if hasattr(view, 'toreadonly'): # Python 3.8+
+            return view.toreadonly()
+        return memoryview(bytes(view))
+
+
+    def _verify_set(self, verify_sig_fields):
+        mask = self._required_mask_sig if verify_sig_fields else self._required_mask
+        if self._set_fields & mask != mask:
+            for field in self._fields.values():
+                if mask & field.bit and not self._set_fields & field.bit:
+                    raise KeyError(f'{field.name} is not set')
 
 
     def to_bytes(self, verify=True, verify_sig_fields=False):
@@ -96,27 +204,9 @@ class Sigstruct:
         Raises:
             KeyError: some SIGSTRUCT fields were not set.
         """
-        buffer = bytearray(offs.SGX_ARCH_SIGSTRUCT_SIZE)
-        for key, (offset, fmt) in self.fields.items():
-            if key not in self:
-                if verify and (key not in ['modulus', 'exponent', 'signature', 'q1', 'q2']
-                               or verify_sig_fields):
-                    raise KeyError(f'{key} is not set')
-                continue
-            # `SIGSTRUCT.DATE` (signing date) is stored in yyyymmdd format in hex: yyyy=4 digit
-            # year, mm=1-12, dd=1-31 according to Intel SDM (Table 35-21. Layout of Enclave
-            # Signature Structure (SIGSTRUCT), Chapter 34, Volume 3, version March 2023). Further,
-            # SGX SDK and some code signing systems interpret it as "Binary-coded decimal", e.g.,
-            # expecting "14 04 23 20" rather than "0e 04 e7 07" for date "2023-04-14" in its byte
-            # representation. See below for details:
-            # - https://github.com/intel/linux-sgx/blob/1efe23c20e37f868498f8287921eedfbcecdc216/sdk/sign_tool/SignTool/manage_metadata.cpp#L252-L253
-            # - https://en.wikipedia.org/wiki/Binary-coded_decimal
-            # We thus treat the date-related inputs as if they are hex numbers.
-            if key in ['date_year', 'date_month', 'date_day']:
-                struct.pack_into(fmt, buffer, offset, int(f'{self[key]}', 16))
-                continue
-            struct.pack_into(fmt, buffer, offset, self[key])
-        return buffer
+        if verify:
+            self._verify_set(verify_sig_fields)
+        return bytearray(self._buffer)
 
 
     @classmethod
@@ -137,23 +227,43 @@ class Sigstruct:
         """
         if not isinstance(buffer, bytes) and not isinstance(buffer, bytearray):
             raise TypeError(f'a bytes-like object is required, not {type(buffer).__name__}')
+        return cls.from_buffer(buffer)
+
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """Load a SIGSTRUCT from any object supporting the buffer protocol.
+
+        Unlike :meth:`from_bytes`, this accepts also e.g. :class:`memoryview` or :class:`mmap.mmap`
+        objects.
+
+        Args:
+            buffer (buffer): buffer containing SIGSTRUCT.
+
+        Returns:
+            Sigstruct: parsed SIGSTRUCT object.
+
+        Raises:
+            ValueError: *buffer* does not have required length or one of the headers does not match.
+        """
         if len(buffer) != offs.SGX_ARCH_SIGSTRUCT_SIZE:
             raise ValueError(f'buffer len does not equal {offs.SGX_ARCH_SIGSTRUCT_SIZE}')
 
-        sig = cls()
-
-        for key, (offset, fmt) in cls.fields.items():
-            # See the analogous place in to_bytes() method for explanation.
-            if key in ['date_year', 'date_month', 'date_day']:
-                try:
-                    sig[key] = int(f'{struct.unpack_from(fmt, buffer, offset)[0]:x}')
-                except ValueError:
-                    print(f'Misencoded {key} in SIGSTRUCT! '
-                          f'Please consider generating a new SIGSTRUCT with "gramine-sgx-sign".',
-                          file=sys.stderr)
-                    raise
-                continue
-            sig[key] = struct.unpack_from(fmt, buffer, offset)[0]
+        sig = cls.__new__(cls)
+        sig._buffer = bytearray(buffer) # pylint: disable=protected-access
+        sig._set_fields = cls._required_mask_sig # pylint: disable=protected-access
+        sig._values = {} # pylint: disable=protected-access
+
+        # See __setitem__() for explanation.
+        for key in _DATE_FIELDS:
+            field = cls._fields[key]
+            try:
+                int(f'{field.struct.unpack_from(buffer, field.offset)[0]:x}')
+            except ValueError:
+                print(f'Misencoded {key} in SIGSTRUCT! '
+                      f'Please consider generating a new SIGSTRUCT with "gramine-sgx-sign".',
+                      file=sys.stderr)
+                raise
 
         if sig['header'] != cls.defaults['header']:
             raise ValueError('header value does not mach')
@@ -163,11 +273,35 @@ class Sigstruct:
         return sig
 
 
+    @classmethod
+    def from_file(cls, path):
+        """Load a SIGSTRUCT from a file (usually ``.sig``).
+
+        The file is memory-mapped and parsed with :meth:`from_buffer`.
+
+        Args:
+            path (str or pathlib.Path): path to the file.
+
+        Returns:
+            Sigstruct: parsed SIGSTRUCT object.
+
+        Raises:
+            OSError: the file cannot be read.
+            ValueError: the file does not have required length or one of the headers does not
+                match.
+        """
+        with open(path, 'rb') as file:
+            # mmap() refuses to map empty files, so check the size first
+            if os.fstat(file.fileno()).st_size != offs.SGX_ARCH_SIGSTRUCT_SIZE:
+                raise ValueError(f'file size does not equal {offs.SGX_ARCH_SIGSTRUCT_SIZE}')
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                return cls.from_buffer(buffer)
+
+
     def get_signing_data(self):
-        data = self.to_bytes()
-        assert len(data) == offs.SGX_ARCH_SIGSTRUCT_SIZE
+        self._verify_set(verify_sig_fields=False)
         after_sig_offset = offs.SGX_ARCH_SIGSTRUCT_MISC_SELECT
-        return data[:128] + data[after_sig_offset:after_sig_offset+128]
+        return self._buffer[:128] + self._buffer[after_sig_offset:after_sig_offset+128]
 
 
     def sign(self, do_sign_callback, *args, **kwargs):
@@ -202,3 +336,34 @@ class Sigstruct:
         self['signature'] = signature_int.to_bytes(384, byteorder='little')
         self['q1'] = q1_int.to_bytes(384, byteorder='little')
         self['q2'] = q2_int.to_bytes(384, byteorder='little')
+
+
+    def verify_signature(self):
+        """Verify the signature of the SIGSTRUCT.
+
+        Checks that *signature* is a valid RSASSA-PKCS1-v1_5 signature (with SHA-256) of this
+        SIGSTRUCT, made with the key given by *modulus* and *exponent*, and that *q1* and *q2* match
+        the signature (as required by EINIT).
+
+        Returns:
+            bool: ``True`` if the signature is valid.
+
+        Raises:
+            KeyError: some SIGSTRUCT fields were not set.
+        """
+        modulus_int = int.from_bytes(self['modulus'], byteorder='little')
+        signature_int = int.from_bytes(self['signature'], byteorder='little')
+        if not 0 < signature_int < modulus_int:
+            return False
+
+        tmp1 = signature_int * signature_int
+        if int.from_bytes(self['q1'], byteorder='little') != tmp1 // modulus_int:
+            return False
+        if int.from_bytes(self['q2'], byteorder='little') != (tmp1 % modulus_int) * signature_int \
+                // modulus_int:
+            return False
+
+        digest = _SHA256_DIGEST_INFO_PREFIX + hashlib.sha256(self.get_signing_data()).digest()
+        expected = b'\x00\x01' + b'\xff' * (384 - 3 - len(digest)) + b'\x00' + digest
+        decrypted = pow(signature_int, self['exponent'], modulus_int)
+        return decrypted.to_bytes(384, byteorder='big') == expected
@@ -2,15 +2,20 @@
 # Copyright (C) 2021 Intel Corporation
 #                    Paweł Marczewski <pawel@invisiblethingslab.com>
 
+import hashlib
 import io
+import json
 import os
 import platform
+import re
 import subprocess
 import sys
 
 import tomli
 
-from . import ninja_syntax, _CONFIG_SYSLIBDIR, _CONFIG_PKGLIBDIR
+from . import ninja_syntax, Manifest, _CONFIG_SYSLIBDIR, _CONFIG_PKGLIBDIR
+from .hash_cache import HashCache
+from .manifest import list_dir
 
 try:
     from .sgx_sign import SGX_RSA_KEY_PATH as _SGX_RSA_KEY_PATH
@@ -18,6 +23,9 @@ except ImportError:
     # if we don't have sgx built, this won't work anyway
     _SGX_RSA_KEY_PATH = '/dev/null'
 
+# Database used in the content hash mode, next to `.ninja_log`
+CONTENT_HASHES_DIR = '.gramine_content_hashes'
+
 
 class TestConfig:
     '''
@@ -43,10 +51,15 @@ class TestConfig:
     - `NAME.manifest`, `NAME.manifest.sgx`, `NAME.sig`, `NAME.token`
     - `direct`, `sgx`: all files
     - `direct-NAME`, `sgx-NAME`: files related to a single manifest
+
+    In the content hash mode (`content_hash=True`), the manifests are signed with `gramine-test
+    sgx-sign`, which doesn't touch the outputs if the contents of all their inputs are the same as
+    recorded in :py:class:`ContentHashes` (and Ninja doesn't rebuild the files depending on them).
     '''
 
-    def __init__(self, path):
+    def __init__(self, path, content_hash=False):
         self.config_path = path
+        self.content_hash = content_hash
 
         with open(path, "rb") as f:
             data = tomli.load(f)
@@ -95,6 +108,13 @@ class TestConfig:
             manifests += output.splitlines()
         return manifests
 
+    @staticmethod
+    def get_template(name):
+        template = f'{name}.manifest.template'
+        if not os.path.exists(template):
+            template = 'manifest.template'
+        return template
+
     def gen_build_file(self, ninja_path):
         output = io.StringIO()
         ninja = ninja_syntax.Writer(output)
@@ -131,13 +151,22 @@ class TestConfig:
         )
         ninja.newline()
 
-        ninja.rule(
-            name='sgx-sign',
-            command=('gramine-sgx-sign --quiet --manifest $in --key $KEY --depfile $out.d '
-                     '--output $out'),
-            depfile='$out.d',
-            description='SGX sign: $out',
-        )
+        if self.content_hash:
+            ninja.rule(
+                name='sgx-sign',
+                command='gramine-test sgx-sign --key $KEY $in $out',
+                depfile='$out.d',
+                description='SGX sign: $out',
+                restat=True,
+            )
+        else:
+            ninja.rule(
+                name='sgx-sign',
+                command=('gramine-sgx-sign --quiet --manifest $in --key $KEY --depfile $out.d '
+                         '--output $out'),
+                depfile='$out.d',
+                description='SGX sign: $out',
+            )
         ninja.newline()
 
         ninja.rule(
@@ -149,7 +178,8 @@ class TestConfig:
 
         ninja.rule(
             name='regenerate',
-            command='gramine-test regenerate',
+            command=('gramine-test --content-hash regenerate' if self.content_hash
+                     else 'gramine-test regenerate'),
             description='Regenerating build file',
             generator=True,
         )
@@ -183,9 +213,7 @@ class TestConfig:
         ninja.newline()
 
         for name in self.all_manifests:
-            template = f'{name}.manifest.template'
-            if not os.path.exists(template):
-                template = 'manifest.template'
+            template = self.get_template(name)
 
             ninja.build(
                 outputs=[f'{name}.manifest'],
@@ -223,8 +251,253 @@ class TestConfig:
             ninja.newline()
 
 
-def gen_build_file(conf_file_name='tests.toml'):
-    config = TestConfig(conf_file_name)
+class BuildError(Exception):
+    '''Raised when building some of the files failed.'''
+
+
+def read_depfile(path):
+    '''Read dependencies from a depfile in Makefile format (as written by `gramine-sgx-sign`).'''
+    with open(path, 'r', encoding='utf-8') as f:
+        _, _, deps = f.read().partition(':')
+    # paths are separated by whitespace, spaces in paths are escaped with a backslash
+    return [dep.replace('\\ ', ' ') for dep in re.findall(r'(?:\\ |[^\s\\]|\\(?!\n))+', deps)]
+
+
+class ContentHashes(HashCache):
+    '''
+    Record of the contents of all files that signed manifests were built from (kept next to
+    `.ninja_log`), used to skip signing when the modification times of these files changed, but
+    their contents did not (e.g. after reinstalling the same packages in a new container image).
+
+    Files are hashed with the help of :py:class:`graminelibos.hash_cache.HashCache`, so unchanged
+    files are not read again. Directories are represented by a hash of their listing.
+    '''
+
+    def __init__(self, cache_dir=CONTENT_HASHES_DIR):
+        super().__init__(cache_dir)
+        with self._lock:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS outputs (
+                path TEXT PRIMARY KEY,
+                digests TEXT
+            )''')
+            self._db.commit()
+
+    def digest(self, path):
+        '''Return a hash of the contents of a file or directory, or `None` if it does not exist.'''
+        try:
+            if os.path.isdir(path):
+                listing = json.dumps(list_dir(path))
+                return hashlib.sha256(listing.encode('utf-8')).hexdigest()
+            return self.hash_file(path)
+        except FileNotFoundError:
+            return None
+
+    def _digests(self, paths, jobs=None):
+        # pylint: disable=import-outside-toplevel
+        import concurrent.futures
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            return dict(zip(paths, executor.map(self.digest, paths)))
+
+    def record(self, outputs, inputs, jobs=None):
+        '''Record the contents of `outputs` (built together) and of all their `inputs`.'''
+        paths = dict.fromkeys(os.fspath(path) for path in [*outputs, *inputs])
+        digests = self._digests(list(paths), jobs=jobs)
+        # Commit right away (like HashCache does), so that parallel `gramine-test sgx-sign`
+        # processes run by Ninja don't wait for each other's write lock
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO outputs VALUES (?, ?)',
+                             (os.fspath(outputs[0]), json.dumps(digests)))
+
+    def is_unchanged(self, outputs, inputs, jobs=None):
+        '''
+        Check if `outputs` and all files they were built from have the same contents as when
+        recorded. The recorded files have to include `inputs`.
+        '''
+        with self._lock:
+            row = self._db.execute('SELECT digests FROM outputs WHERE path = ?',
+                                   (os.fspath(outputs[0]),)).fetchone()
+        if row is None:
+            return False
+        recorded = json.loads(row[0])
+        if any(os.fspath(path) not in recorded for path in [*outputs, *inputs]):
+            return False
+        return self._digests(list(recorded), jobs=jobs) == recorded
+
+
+def sign_test_manifest(manifest_path, output, sigfile, key, *, content_hashes=None, force=False,
+                       jobs=None):
+    '''
+    Sign a manifest, and write the `OUTPUT.d` depfile in the same format as `gramine-sgx-sign
+    --depfile`.
+
+    If `content_hashes` (:py:class:`ContentHashes`) is given, the outputs are left untouched if
+    neither they, nor any of the files they were built from, changed their contents since they were
+    last recorded there (unless `force` is true).
+
+    Returns `True` if the manifest was signed.
+    '''
+    # pylint: disable=import-outside-toplevel,too-many-arguments,too-many-locals
+    from .sgx_sign import SGX_LIBPAL, sign_manifest
+
+    depfile = f'{output}.d'
+    inputs = [manifest_path, SGX_LIBPAL, key]
+    if (content_hashes is not None and not force and os.path.exists(depfile)
+            and content_hashes.is_unchanged([output, sigfile], inputs, jobs=jobs)):
+        return False
+
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = Manifest.load(f)
+    try:
+        expanded = sign_manifest(manifest, output, sigfile, key, jobs=jobs,
+                                 hash_cache=content_hashes)
+    except Exception:
+        # don't leave outputs which would look up to date
+        for path in (output, sigfile):
+            if os.path.exists(path):
+                os.unlink(path)
+        raise
+
+    with open(depfile, 'w', encoding='utf-8') as f:
+        f.write(f'{output}:')
+        for filename in [*expanded, SGX_LIBPAL, key]:
+            escaped = os.fspath(filename).replace(' ', '\\ ')
+            f.write(f' \\\n\t{escaped}')
+        f.write('\n')
+
+    if content_hashes is not None:
+        content_hashes.record([output, sigfile], [*inputs, *expanded], jobs=jobs)
+    return True
+
+
+class InProcessBuilder:
+    '''
+    Class building the same files as the Ninja build file generated by `TestConfig`, but in a single
+    process, without spawning `gramine-manifest`, `gramine-sgx-sign` and `gramine-sgx-get-token`
+    for every manifest.
+
+    Manifests are built in parallel (in a thread pool). A file is rebuilt with the same rules as
+    Ninja uses: if it's missing or older than any of its inputs, including the dependencies from
+    the depfile written when signing. If `content_hashes` (:py:class:`ContentHashes`) is given,
+    manifests are not signed again if the contents of their inputs didn't change.
+    '''
+
+    def __init__(self, config, jobs=None, verbose=False, content_hashes=None):
+        self.config = config
+        self.jobs = jobs or os.cpu_count() or 1
+        self.verbose = verbose
+        self.content_hashes = content_hashes
+
+    @staticmethod
+    def is_up_to_date(outputs, inputs):
+        try:
+            oldest_output = min(os.stat(output).st_mtime_ns for output in outputs)
+            newest_input = max((os.stat(path).st_mtime_ns for path in inputs), default=0)
+        except FileNotFoundError:
+            return False
+        return oldest_output >= newest_input
+
+    def log(self, description, command):
+        print(command if self.verbose else description, flush=True)
+
+    def render(self, name, force):
+        template = self.config.get_template(name)
+        output = f'{name}.manifest'
+        if not force and self.is_up_to_date([output], [template]):
+            return False
+
+        self.log(f'manifest: {output}', f'gramine-manifest -Dentrypoint={name} {template} {output}')
+        with open(template, 'r', encoding='utf-8') as f:
+            manifest = Manifest.from_template(f.read(), {
+                'arch_libdir': self.config.arch_libdir,
+                'coreutils_libdir': self.config.coreutils_libdir,
+                'entrypoint': name,
+                'binary_dir': self.config.binary_dir,
+                'libc': self.config.libc,
+            })
+        data = manifest.dumps().encode('utf-8')
+        with open(output, 'wb') as f:
+            f.write(data)
+        return True
+
+    def sign(self, name, force, dirty):
+        manifest_path = f'{name}.manifest'
+        output = f'{name}.manifest.sgx'
+        sigfile = f'{name}.sig'
+        if not force and not dirty:
+            try:
+                deps = read_depfile(f'{output}.d')
+            except FileNotFoundError:
+                pass
+            else:
+                if self.is_up_to_date([output, sigfile], [manifest_path, self.config.key, *deps]):
+                    return False
+
+        self.log(f'SGX sign: {output}',
+            f'gramine-sgx-sign --quiet --manifest {manifest_path} --key {self.config.key} '
+            f'--depfile {output}.d --output {output}')
+        return sign_test_manifest(manifest_path, output, sigfile, self.config.key,
+                                  content_hashes=self.content_hashes, force=force, jobs=1)
+
+    def get_token(self, name, force):
+        # pylint: disable=import-outside-toplevel
+        from .sgx_get_token import get_token, is_oot
+        from .sigstruct import Sigstruct
+
+        if not is_oot():
+            # `gramine-sgx-get-token` doesn't generate the token with the upstream driver
+            return False
+
+        sigfile = f'{name}.sig'
+        output = f'{name}.token'
+        if not force and self.is_up_to_date([output], [sigfile]):
+            return False
+
+        self.log(f'SGX token: {output}', f'gramine-sgx-get-token --quiet --sig {sigfile} '
+            f'--output {output}')
+        with open(sigfile, 'rb') as f:
+            sig = Sigstruct.from_bytes(f.read())
+        token = get_token(sig)
+        with open(output, 'wb') as f:
+            f.write(token)
+        return True
+
+    def build_one(self, name, sgx, force):
+        # like in Ninja, a file is rebuilt if any file it depends on was rebuilt
+        dirty = self.render(name, force)
+        if sgx:
+            dirty = self.sign(name, force, dirty)
+            self.get_token(name, force or dirty)
+
+    def build(self, *names, sgx=False, force=False):
+        '''
+        Build the files for given manifests (or all of them), like the `direct-NAME`/`sgx-NAME`
+        (or `direct`/`sgx`) Ninja targets.
+        '''
+        for name in names:
+            if name not in self.config.all_manifests:
+                raise BuildError(f'unknown manifest: {name}')
+        if not names:
+            names = self.config.all_manifests if sgx else self.config.manifests
+
+        # pylint: disable=import-outside-toplevel
+        import concurrent.futures
+
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {executor.submit(self.build_one, name, sgx, force): name for name in names}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e: # pylint: disable=broad-except
+                    print(f'FAILED: {futures[future]}: {e}', file=sys.stderr, flush=True)
+                    failed.append(futures[future])
+        if failed:
+            raise BuildError(f'failed to build: {", ".join(sorted(failed))}')
+
+
+def gen_build_file(conf_file_name='tests.toml', content_hash=False):
+    config = TestConfig(conf_file_name, content_hash=content_hash)
     config.gen_build_file('build.ninja')
 
 
@@ -0,0 +1,157 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (C) 2024 Intel Corporation
+
+import concurrent.futures
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+
+import pytest
+
+# the module requires Gramine built with SGX
+pytest.importorskip('_graminelibos_offsets')
+
+from graminelibos.sgx_get_token import AesmdClient # pylint: disable=wrong-import-position
+
+def recv_exact(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def response_for(msg):
+    return b'response to ' + msg
+
+class MockAesmd:
+    '''
+    AESMD server which answers every request with :func:`response_for`. It closes a connection after
+    *per_conn* requests (if not None), and sends responses in chunks of *chunk* bytes (if not None).
+    '''
+
+    def __init__(self, path, per_conn=None, chunk=None):
+        self.per_conn = per_conn
+        self.chunk = chunk
+        self.connections = 0
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(16)
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def close(self):
+        self.sock.close()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        with conn:
+            answered = 0
+            while self.per_conn is None or answered < self.per_conn:
+                header = recv_exact(conn, 4)
+                if header is None:
+                    return
+                msg = recv_exact(conn, struct.unpack('<I', header)[0])
+                response = response_for(msg)
+                data = struct.pack('<I', len(response)) + response
+                chunk = self.chunk or len(data)
+                for pos in range(0, len(data), chunk):
+                    conn.sendall(data[pos:pos + chunk])
+                answered += 1
+
+class MockSocket:
+    '''
+    Socket which answers the first *answered* requests, and then fails to send like a socket closed
+    by the other side.
+    '''
+
+    def __init__(self, answered):
+        self.answered = answered
+        self.requests = 0
+        self.buffer = bytearray()
+
+    def sendall(self, data):
+        if self.requests == self.answered:
+            raise BrokenPipeError('Broken pipe')
+        self.requests += 1
+        response = response_for(bytes(data[4:]))
+        self.buffer += struct.pack('<I', len(response)) + response
+
+    def recv_into(self, view):
+        size = min(len(view), len(self.buffer))
+        view[:size] = self.buffer[:size]
+        del self.buffer[:size]
+        return size
+
+    def close(self):
+        pass
+
+class TC_00_AesmdClient(unittest.TestCase):
+    MSGS = [f'request {i}'.encode() for i in range(100)]
+    RESPONSES = [response_for(msg) for msg in MSGS]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'aesm.socket')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def start_server(self, **kwargs):
+        server = MockAesmd(self.path, **kwargs)
+        self.addCleanup(server.close)
+        return server
+
+    def test_000_request_many(self):
+        server = self.start_server()
+        with AesmdClient(self.path) as client:
+            self.assertEqual(client.request_many(self.MSGS), self.RESPONSES)
+            self.assertEqual(client.request(b'x'), response_for(b'x'))
+        self.assertEqual(server.connections, 1)
+
+    def test_010_short_reads(self):
+        self.start_server(per_conn=7, chunk=3)
+        with AesmdClient(self.path, pipeline_depth=4) as client:
+            self.assertEqual(client.request_many(self.MSGS), self.RESPONSES)
+            # reuses a connection which might have been closed by the server
+            self.assertEqual(client.request(b'x'), response_for(b'x'))
+
+    def test_020_one_request_per_connection(self):
+        self.start_server(per_conn=1)
+        with AesmdClient(self.path) as client:
+            self.assertEqual(client.request_many(self.MSGS), self.RESPONSES)
+
+    def test_030_send_fails_after_responses(self):
+        # Sending the second request fails, but the response to the first one is already there
+        client = AesmdClient(self.path)
+        client._connect = lambda: MockSocket(answered=1) # pylint: disable=protected-access
+        self.assertEqual(client.request_many(self.MSGS[:5]), self.RESPONSES[:5])
+
+    def test_040_threads(self):
+        self.start_server()
+        with AesmdClient(self.path) as client:
+            with concurrent.futures.ThreadPoolExecutor(8) as executor:
+                self.assertEqual(list(executor.map(client.request, self.MSGS)), self.RESPONSES)
+
+    def test_050_connection_closed(self):
+        self.start_server(per_conn=0)
+        with AesmdClient(self.path) as client:
+            with self.assertRaises(ConnectionError):
+                client.request(b'x')
+
+    def test_060_no_server(self):
+        with AesmdClient(self.path) as client:
+            with self.assertRaises(ConnectionError):
+                client.request(b'x')
@@ -0,0 +1,55 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (C) 2024 Intel Corporation
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+# Rendered in a separate process, so that the on-disk caches are opened anew
+RENDER_SCRIPT = '''
+import json, sys
+from graminelibos import Manifest
+variables = {'binary': sys.argv[2], 'interpreter': sys.argv[3]}
+manifest = Manifest.from_template(sys.argv[1], variables)
+print(json.dumps({'libs': manifest['libs'], 'sys_path': manifest['sys_path']}))
+'''
+
+TEMPLATE = '''
+libs = {{ ldd(binary) | tojson }}
+sys_path = {{ python.get_sys_path(interpreter) | map('string') | list | tojson }}
+'''
+
+class TC_00_FileInfoCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def render(self, **env):
+        env = {**os.environ, **env}
+        # use the default cache directory ($XDG_CACHE_HOME/gramine)
+        env.pop('GRAMINE_CACHE_DIR', None)
+        output = subprocess.check_output([sys.executable, '-c', RENDER_SCRIPT, TEMPLATE,
+                                          shutil.which('ls'), sys.executable], env=env)
+        return json.loads(output.decode())
+
+    def test_000_default_cache_dir(self):
+        first = self.render(XDG_CACHE_HOME=self.tmpdir)
+        self.assertTrue(first['libs'])
+        self.assertTrue(first['sys_path'])
+        for name in ('ldd.sqlite3', 'python.sqlite3'):
+            self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'gramine', name)))
+
+        # now from the on-disk cache
+        self.assertEqual(self.render(XDG_CACHE_HOME=self.tmpdir), first)
+
+    def test_010_unusable_cache_dir(self):
+        # the cache directory cannot be created, because its parent is a file
+        cache_home = os.path.join(self.tmpdir, 'file')
+        with open(cache_home, 'w', encoding='utf-8'):
+            pass
+        self.assertEqual(self.render(XDG_CACHE_HOME=cache_home),
+                         self.render(XDG_CACHE_HOME=self.tmpdir))
@@ -0,0 +1,104 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (C) 2024 Intel Corporation
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from graminelibos import hash_cache
+from graminelibos.hash_cache import HashCache
+from graminelibos.manifest import ManifestError, hash_file_contents
+
+class TC_00_HashCache(unittest.TestCase):
+    @staticmethod
+    def stat_key_without_ctime(st):
+        # ctime cannot be set from userspace, so tests replace files unnoticed by ignoring it
+        return (st.st_ino, st.st_size, st.st_mtime_ns, 0)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+
+    def write_file(self, name, data, age=10):
+        '''Write a file, with mtime *age* seconds in the past (outside of the racy window).'''
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as file:
+            file.write(data)
+        if age:
+            mtime = time.time() - age
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_000_hit(self):
+        path = self.write_file('a', b'a')
+        with HashCache(self.cache_dir) as cache:
+            self.assertEqual(cache.hash_file(path), hash_file_contents(path))
+            self.assertEqual(cache.hash_file(path), hash_file_contents(path))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        with HashCache(self.cache_dir) as cache:
+            self.assertEqual(cache.hash_file(path), hash_file_contents(path))
+            self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_010_modified(self):
+        path = self.write_file('a', b'a')
+        with HashCache(self.cache_dir) as cache:
+            cache.hash_file(path)
+            self.write_file('a', b'bb')
+            self.assertEqual(cache.hash_file(path), hash_file_contents(path))
+            self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_020_racy(self):
+        with mock.patch.object(hash_cache, '_stat_key', self.stat_key_without_ctime):
+            # the file is not cached, because it was modified just now
+            path = self.write_file('a', b'a', age=0)
+            st = os.stat(path)
+            with HashCache(self.cache_dir) as cache:
+                cache.hash_file(path)
+
+                # modified again within the same mtime
+                self.write_file('a', b'b', age=0)
+                os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+                self.assertEqual(cache.hash_file(path), hash_file_contents(path))
+                self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_030_strict(self):
+        path = self.write_file('a', b'a')
+        st = os.stat(path)
+        with mock.patch.object(hash_cache, '_stat_key', self.stat_key_without_ctime):
+            with HashCache(self.cache_dir) as cache:
+                cache.hash_file(path)
+
+            # same size and mtime, different contents
+            self.write_file('a', b'b')
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+            with HashCache(self.cache_dir) as cache:
+                # without strict mode, the stale hash is returned
+                self.assertNotEqual(cache.hash_file(path), hash_file_contents(path))
+            with HashCache(self.cache_dir, strict=True) as cache:
+                with self.assertRaises(ManifestError):
+                    cache.hash_file(path)
+
+    def test_040_eviction(self):
+        paths = [self.write_file(name, name.encode()) for name in 'abcde']
+        with HashCache(self.cache_dir) as cache:
+            for path in paths:
+                cache.hash_file(path)
+
+        # only the entries used most recently (here, in this session) survive
+        with HashCache(self.cache_dir, max_entries=2) as cache:
+            for path in paths[1:3]:
+                cache.hash_file(path)
+            self.assertEqual(cache.hits, 2)
+
+        with HashCache(self.cache_dir) as cache:
+            hits = []
+            for path in paths:
+                cache.hash_file(path)
+                hits.append(cache.hits)
+            self.assertEqual(hits, [0, 1, 2, 2, 2])
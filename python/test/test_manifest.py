@@ -0,0 +1,129 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (C) 2024 Intel Corporation
+
+import contextlib
+import io
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from graminelibos.hash_cache import HashCache
+from graminelibos.manifest import (
+    HASH_MMAP_THRESHOLD, hash_file_contents, hash_trusted_files, list_dir, walk_tree,
+)
+
+class TC_00_WalkTree(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.top = os.path.join(self.tmpdir, 'top')
+
+        # 'a-x' sorts before 'a/...' as a string, but after 'a' as a path
+        for path in ('a/b/c/d', 'a/b/e', 'a-x/f', 'a.y', 'g/h', 'empty'):
+            os.makedirs(os.path.join(self.top, path))
+        for path in ('a/1', 'a/b/2', 'a/b/c/3', 'a/b/c/d/4', 'a-x/5', 'g/h/6', 'z'):
+            self.write_file(path)
+        os.symlink('a/b', os.path.join(self.top, 'link-dir'))
+        os.symlink('z', os.path.join(self.top, 'link-file'))
+        os.symlink('nonexistent', os.path.join(self.top, 'link-broken'))
+        os.mkfifo(os.path.join(self.top, 'fifo'))
+
+        # make the directories old enough to be stored in the index
+        for dirpath, _, _ in os.walk(self.top):
+            os.utime(dirpath, (time.time() - 10, time.time() - 10))
+
+    def write_file(self, path):
+        with open(os.path.join(self.top, path), 'w', encoding='utf-8') as file:
+            file.write(path)
+
+    def expected(self):
+        return [(str(path), path.is_file()) for path in sorted(pathlib.Path(self.top).rglob('*'))]
+
+    def test_000_walk_tree(self):
+        expected = self.expected()
+        for jobs in (1, 4):
+            with self.subTest(jobs=jobs):
+                self.assertEqual(walk_tree(self.top, jobs=jobs), expected)
+                self.assertEqual(walk_tree(pathlib.Path(self.top), jobs=jobs), expected)
+
+    def test_010_list_dir(self):
+        self.assertEqual(list_dir(os.path.join(self.top, 'a')),
+                         [('1', 'f'), ('b', 'd')])
+        self.assertEqual(list_dir(os.path.join(self.top, 'empty')), [])
+
+    def test_020_unreadable_dir(self):
+        if os.geteuid() == 0:
+            self.skipTest('root can read any directory')
+        path = os.path.join(self.top, 'a', 'b')
+        os.chmod(path, 0)
+        self.addCleanup(os.chmod, path, 0o755)
+
+        self.assertEqual(list_dir(path), [])
+        self.assertEqual(walk_tree(self.top), self.expected())
+
+    def test_030_dir_index(self):
+        with HashCache(os.path.join(self.tmpdir, 'cache')) as cache:
+            self.assertEqual(walk_tree(self.top, dir_index=cache), self.expected())
+
+            # unchanged directories are not listed again
+            expected = self.expected()
+            with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+                self.assertEqual(walk_tree(self.top, dir_index=cache), expected)
+            scandir.assert_not_called()
+
+            # changed directories are
+            self.write_file('a/b/c/7')
+            shutil.rmtree(os.path.join(self.top, 'g', 'h'))
+            expected = self.expected()
+            with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+                self.assertEqual(walk_tree(self.top, dir_index=cache), expected)
+            self.assertEqual(sorted(call[0][0] for call in scandir.call_args_list),
+                             [os.path.join(self.top, 'a', 'b', 'c'), os.path.join(self.top, 'g')])
+
+class TC_10_HashTrustedFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        # the last one is hashed through mmap()
+        self.sizes = [0, 1, 100000, HASH_MMAP_THRESHOLD]
+        self.paths = []
+        for i, size in enumerate(self.sizes):
+            path = os.path.join(self.tmpdir, str(i))
+            with open(path, 'wb') as file:
+                file.write(bytes([i]) * size)
+            # make the files old enough to be cached
+            os.utime(path, (time.time() - 10, time.time() - 10))
+            self.paths.append(path)
+
+    def hash_trusted_files(self, **kwargs):
+        trusted_files = {path: None for path in self.paths}
+        trusted_files['/given'] = 'ab' * 32
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            hash_trusted_files(trusted_files, verbose=True, **kwargs)
+        self.assertEqual(trusted_files,
+                         {**{path: hash_file_contents(path) for path in self.paths},
+                          '/given': 'ab' * 32})
+        return output.getvalue()
+
+    def test_000_stats(self):
+        for jobs in (1, 4):
+            with self.subTest(jobs=jobs):
+                output = self.hash_trusted_files(jobs=jobs)
+                self.assertIn('files:       4 hashed, 0 from cache, 1 given', output)
+                self.assertIn(f'read:        {sum(self.sizes) / 1e9:.3f} GB', output)
+
+    def test_010_stats_cache(self):
+        with HashCache(os.path.join(self.tmpdir, 'cache')) as cache:
+            output = self.hash_trusted_files(hash_cache=cache)
+            self.assertIn('files:       4 hashed, 0 from cache, 1 given', output)
+            self.assertIn(f'read:        {sum(self.sizes) / 1e9:.3f} GB', output)
+
+            output = self.hash_trusted_files(hash_cache=cache)
+            self.assertIn('files:       0 hashed, 4 from cache, 1 given', output)
+            self.assertIn('read:        0.000 GB', output)
@@ -0,0 +1,144 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (C) 2024 Intel Corporation
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from graminelibos import regression
+from graminelibos.regression import TIMINGS_MAX_RUNS, TimingDatabase, TimingKey
+
+KEY = TimingKey('test_foo.py::test_foo', '/cwd', 'direct', '["foo"]')
+
+class TC_00_TimingDatabase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.db = TimingDatabase(os.path.join(self.tmpdir, 'timings.sqlite3'))
+
+    def record(self, wall_times, key=KEY, timed_out=False):
+        for wall_time in wall_times:
+            self.db.record(key, start_time=len(self.db.get_wall_times(key)), wall_time=wall_time,
+                           max_rss=1024, returncode=None if timed_out else 0, timed_out=timed_out)
+
+    def test_000_not_enough_runs(self):
+        self.assertEqual(self.db.get_adaptive_timeout(KEY, 100), 100)
+        self.record([1, 1, 1, 1])
+        self.assertEqual(self.db.get_adaptive_timeout(KEY, 100), 100)
+
+    def test_010_p95(self):
+        # nearest rank: the 19th of 20 runs, times 3
+        self.record(range(1, 21))
+        self.assertEqual(self.db.get_adaptive_timeout(KEY, 100), 57)
+
+    def test_011_p95_few_runs(self):
+        # with 5 runs, the 95th percentile is the slowest one
+        self.record([1, 1, 1, 1, 10])
+        self.assertEqual(self.db.get_adaptive_timeout(KEY, 100), 30)
+
+    def test_012_p95_rounded_up(self):
+        self.record([2.1] * 5)
+        self.assertEqual(self.db.get_adaptive_timeout(KEY, 100), 7)
+
+    def test_020_minimum(self):
+        self.record([0.1] * 5)
+        self.assertEqual(self.db.get_adaptive_timeout(KEY, 100), 5)
+
+    def test_030_capped_at_timeout(self):
+        self.record([10] * 5)
+        self.assertEqual(self.db.get_adaptive_timeout(KEY, 20), 20)
+        # even below the minimum
+        self.assertEqual(self.db.get_adaptive_timeout(KEY, 3), 3)
+
+    def test_040_timed_out_runs_ignored(self):
+        self.record([1] * 5)
+        self.record([100] * 5, timed_out=True)
+        self.assertEqual(self.db.get_wall_times(KEY), [1] * 5)
+        self.assertEqual(self.db.get_adaptive_timeout(KEY, 100), 5)
+
+    def test_050_max_runs(self):
+        self.record(range(TIMINGS_MAX_RUNS + 5))
+        # only the most recent runs are kept
+        self.assertEqual(sorted(self.db.get_wall_times(KEY)), list(range(5, TIMINGS_MAX_RUNS + 5)))
+
+    def test_060_durations(self):
+        self.record([1, 2, 6])
+        self.record([10, 20], key=KEY._replace(cmd='["bar"]'))
+        self.record([100], key=KEY._replace(test='test_foo.py::test_bar'))
+        self.record([1000], key=KEY._replace(host='sgx'))
+        self.record([1000], key=KEY._replace(cwd='/other'))
+        self.assertEqual(self.db.get_durations(cwd='/cwd', host='direct'), {
+            'test_foo.py::test_foo': 2 + 15,
+            'test_foo.py::test_bar': 100,
+        })
+
+class TC_10_RunCommand(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        for name, value in (('RECORD_TIMINGS', True), ('USE_ADAPTIVE_TIMEOUTS', True)):
+            patcher = mock.patch.object(regression, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # so that runs are recorded also outside of Pytest (e.g. with `python -m unittest`)
+        env = {'PYTEST_CURRENT_TEST': 'test_regression.py::test (call)'}
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        regression.get_timing_db.cache_clear()
+        self.addCleanup(regression.get_timing_db.cache_clear)
+
+    def set_cache_dir(self, cache_dir):
+        patcher = mock.patch.dict(os.environ, {'GRAMINE_CACHE_DIR': cache_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_000_record(self):
+        self.set_cache_dir(self.tmpdir)
+        regression.run_command(['true'], timeout=10)
+        db = TimingDatabase(os.path.join(self.tmpdir, 'test-timings.sqlite3'))
+        self.assertEqual(len(db.get_wall_times(regression.get_timing_key(['true']))), 1)
+
+    def test_010_disabled(self):
+        self.set_cache_dir(self.tmpdir)
+        with mock.patch.object(regression, 'RECORD_TIMINGS', False):
+            self.assertIsNone(regression.get_timing_db())
+            regression.run_command(['true'], timeout=10)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_020_unusable_cache_dir(self):
+        # a file instead of a directory
+        cache_dir = os.path.join(self.tmpdir, 'file')
+        with open(cache_dir, 'w', encoding='utf-8'):
+            pass
+        self.set_cache_dir(cache_dir)
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(regression.get_timing_db())
+        regression.run_command(['true'], timeout=10)
+
+    def test_030_database_errors(self):
+        db = mock.Mock(spec=TimingDatabase)
+        db.get_adaptive_timeout.side_effect = OSError('cannot read')
+        with mock.patch.object(regression, 'get_timing_db', lambda: db):
+            with self.assertLogs(level='WARNING'):
+                timing = regression.CommandTiming(['true'], 10)
+            self.assertEqual(timing.timeout, 10)
+
+            db.get_adaptive_timeout.side_effect = None
+            db.get_adaptive_timeout.return_value = 5
+            db.record.side_effect = OSError('cannot write')
+            with self.assertLogs(level='WARNING'):
+                regression.run_command(['true'], timeout=10)
+            db.record.assert_called_once()
+
+    def test_040_unusable_database(self):
+        # the cache directory is fine, but the database cannot be opened
+        self.set_cache_dir(self.tmpdir)
+        os.mkdir(os.path.join(self.tmpdir, 'test-timings.sqlite3'))
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(regression.get_timing_db())
+        regression.run_command(['true'], timeout=10)
@@ -0,0 +1,165 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (C) 2024 Intel Corporation
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import pytest
+import tomli_w
+
+# the module requires Gramine built with SGX
+pytest.importorskip('_graminelibos_offsets')
+
+# pylint: disable=wrong-import-position
+import _graminelibos_offsets as offs
+from graminelibos import sgx_sign
+from graminelibos.sgx_sign import (
+    EADD_RECORD, EEXTEND_CHUNK_SIZE, EEXTEND_RECORD, MEASUREMENT_BATCH_PAGES, PAGEINFO_R,
+    PAGEINFO_REG, PAGEINFO_W, PAGEINFO_X, UNMEASURED_WINDOW_SIZE, MeasurementPlan, measure_pages,
+    measure_unmeasured_pages,
+)
+# pylint: enable=wrong-import-position
+
+FLAGS = PAGEINFO_R | PAGEINFO_W | PAGEINFO_REG
+WINDOW_PAGES = UNMEASURED_WINDOW_SIZE // offs.PAGESIZE
+
+def reference_measure_pages(digest, offset, npages, flags, content=None, measure=True):
+    '''Measure pages one by one, like the SGX instructions do.'''
+    # pylint: disable=too-many-arguments
+    for page in range(npages):
+        page_offset = offset + page * offs.PAGESIZE
+        digest.update(EADD_RECORD.pack(b'EADD', page_offset, flags, b''))
+        if not measure:
+            continue
+        for chunk in range(0, offs.PAGESIZE, EEXTEND_CHUNK_SIZE):
+            digest.update(EEXTEND_RECORD.pack(b'EEXTEND', page_offset + chunk, b''))
+            if content is None:
+                digest.update(bytes(EEXTEND_CHUNK_SIZE))
+            else:
+                start = page * offs.PAGESIZE + chunk
+                digest.update(content[start:start + EEXTEND_CHUNK_SIZE])
+
+def get_digest(func, *args, **kwargs):
+    digest = hashlib.sha256()
+    func(digest, *args, **kwargs)
+    return digest.hexdigest()
+
+class TC_00_MeasurePages(unittest.TestCase):
+    def assertMeasurementEqual(self, *args, **kwargs):
+        self.assertEqual(get_digest(measure_pages, *args, **kwargs),
+                         get_digest(reference_measure_pages, *args, **kwargs))
+
+    def test_000_no_pages(self):
+        self.assertMeasurementEqual(0, 0, FLAGS)
+        self.assertMeasurementEqual(0x10000, 0, FLAGS, b'')
+        self.assertEqual(get_digest(measure_pages, 0, 0, FLAGS), hashlib.sha256().hexdigest())
+
+    def test_010_zero_pages(self):
+        for npages in (1, 3, MEASUREMENT_BATCH_PAGES):
+            with self.subTest(npages=npages):
+                self.assertMeasurementEqual(0x200000, npages, FLAGS)
+
+    def test_020_content(self):
+        # last batch is partial
+        npages = 2 * MEASUREMENT_BATCH_PAGES + 3
+        content = os.urandom(npages * offs.PAGESIZE)
+        self.assertMeasurementEqual(0x123456000, npages, FLAGS | PAGEINFO_X, content)
+        self.assertMeasurementEqual(0x123456000, npages, FLAGS | PAGEINFO_X,
+                                    bytearray(content))
+
+    def test_030_content_size_mismatch(self):
+        with self.assertRaises(ValueError):
+            get_digest(measure_pages, 0, 2, FLAGS, bytes(offs.PAGESIZE))
+
+class TC_01_MeasureUnmeasuredPages(unittest.TestCase):
+    def assertMeasurementEqual(self, offset, npages, flags=FLAGS | PAGEINFO_X):
+        expected = get_digest(reference_measure_pages, offset, npages, flags, measure=False)
+        self.assertEqual(get_digest(measure_unmeasured_pages, offset, npages, flags), expected)
+        self.assertEqual(get_digest(measure_pages, offset, npages, flags, measure=False),
+                         expected)
+
+    def test_000_no_pages(self):
+        self.assertMeasurementEqual(0, 0)
+        self.assertMeasurementEqual(UNMEASURED_WINDOW_SIZE + offs.PAGESIZE, 0)
+
+    def test_010_inside_window(self):
+        self.assertMeasurementEqual(0, 1)
+        self.assertMeasurementEqual(5 * offs.PAGESIZE, 100)
+        self.assertMeasurementEqual(UNMEASURED_WINDOW_SIZE, WINDOW_PAGES)
+
+    def test_020_several_windows(self):
+        # starts in the middle of a window, ends with a partial window
+        self.assertMeasurementEqual(3 * UNMEASURED_WINDOW_SIZE - 5 * offs.PAGESIZE,
+                                    2 * WINDOW_PAGES + 17)
+        # whole windows
+        self.assertMeasurementEqual(UNMEASURED_WINDOW_SIZE, 3 * WINDOW_PAGES)
+
+    def test_030_high_offsets(self):
+        # the windows differ in the upper bytes of the offsets, not only in the 4th one
+        self.assertMeasurementEqual((1 << 32) - UNMEASURED_WINDOW_SIZE - 7 * offs.PAGESIZE,
+                                    2 * WINDOW_PAGES)
+        self.assertMeasurementEqual((0x12345 << 32) + 3 * offs.PAGESIZE, WINDOW_PAGES)
+
+class TC_10_Mrenclave(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        # any ELF file will do as libpal
+        self.libpal = os.path.join(self.tmpdir, 'libpal.so')
+        shutil.copy(shutil.which('true'), self.libpal)
+        # start every test with empty cache of measurement plans
+        plans = MeasurementPlan._cache # pylint: disable=protected-access
+        patcher = mock.patch.dict(plans, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_mrenclave(self, enclave_size, **sgx):
+        sgx = {'enclave_size': enclave_size, 'max_threads': 4, **sgx}
+        manifest_path = os.path.join(self.tmpdir, 'test.manifest')
+        with open(manifest_path, 'wb') as file:
+            tomli_w.dump({'sgx': sgx}, file)
+        mrenclave, _ = sgx_sign.get_mrenclave_and_manifest(manifest_path, self.libpal)
+        return mrenclave
+
+    def assertMrenclaveMatchesReference(self, enclave_size, **sgx):
+        mrenclave = self.get_mrenclave(enclave_size, **sgx)
+        with mock.patch.object(sgx_sign, 'measure_pages', reference_measure_pages):
+            self.assertEqual(mrenclave, self.get_mrenclave(enclave_size, **sgx))
+
+    def test_000_mrenclave(self):
+        self.assertMrenclaveMatchesReference('64M')
+
+    def test_010_mrenclave_large_heap(self):
+        # the unmeasured heap spans many windows
+        self.assertMrenclaveMatchesReference('256M')
+
+    def test_020_mrenclave_edmm(self):
+        self.assertMrenclaveMatchesReference('64M', edmm_enable=True)
+
+    def test_030_plan_cache(self):
+        attr = {'enclave_size': 64 * 1024 * 1024, 'max_threads': 4, 'edmm_enable': False}
+        plan = MeasurementPlan.get(attr, self.libpal)
+        self.assertIs(MeasurementPlan.get(attr, self.libpal), plan)
+        self.assertIsNot(MeasurementPlan.get({**attr, 'max_threads': 8}, self.libpal), plan)
+
+    def test_040_libpal_changed(self):
+        mrenclave = self.get_mrenclave('64M')
+
+        # replace libpal at the same path, and with the same mtime
+        with open(shutil.which('false'), 'rb') as file:
+            new_libpal = file.read()
+        with open(self.libpal, 'rb') as file:
+            self.assertNotEqual(file.read(), new_libpal)
+        st = os.stat(self.libpal)
+        with open(self.libpal, 'wb') as file:
+            file.write(new_libpal)
+        os.utime(self.libpal, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        new_mrenclave = self.get_mrenclave('64M')
+        self.assertNotEqual(new_mrenclave, mrenclave)
+        MeasurementPlan._cache.clear() # pylint: disable=protected-access
+        self.assertEqual(self.get_mrenclave('64M'), new_mrenclave)
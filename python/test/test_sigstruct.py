@@ -0,0 +1,159 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (C) 2024 Intel Corporation
+
+import csv
+import datetime
+import io
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import pytest
+
+# the module requires Gramine built with SGX
+pytest.importorskip('_graminelibos_offsets')
+
+# pylint: disable=wrong-import-position
+import _graminelibos_offsets as offs
+from graminelibos.manifest import Manifest
+from graminelibos.sgx_sign import generate_private_key_pem, get_tbssigstruct, sign_manifest
+from graminelibos.sigstruct import Sigstruct
+# pylint: enable=wrong-import-position
+
+DATE = datetime.date(2024, 5, 31)
+
+class TC_00_Sigstruct(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.key = os.path.join(cls.tmpdir, 'key.pem')
+        with open(cls.key, 'wb') as file:
+            file.write(generate_private_key_pem())
+        # any ELF file will do as libpal
+        cls.libpal = os.path.join(cls.tmpdir, 'libpal.so')
+        shutil.copy(shutil.which('true'), cls.libpal)
+
+        cls.sigdir = os.path.join(cls.tmpdir, 'sigs')
+        os.mkdir(cls.sigdir)
+        cls.sigfiles = []
+        for isvprodid in (1, 2):
+            manifest = Manifest.loads(f'''
+                [sgx]
+                enclave_size = "64M"
+                max_threads = 2
+                isvprodid = {isvprodid}
+            ''')
+            path = os.path.join(cls.sigdir, f'test{isvprodid}')
+            sign_manifest(manifest, f'{path}.manifest.sgx', f'{path}.sig', cls.key, cls.libpal,
+                          date=DATE)
+            cls.sigfiles.append(f'{path}.sig')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def read_sigfile(self, index=0):
+        with open(self.sigfiles[index], 'rb') as file:
+            return file.read()
+
+    def test_000_round_trip(self):
+        data = self.read_sigfile()
+        for sig in (Sigstruct.from_file(self.sigfiles[0]), Sigstruct.from_bytes(data),
+                    Sigstruct.from_bytes(bytearray(data)), Sigstruct.from_buffer(memoryview(data))):
+            self.assertEqual(sig.to_bytes(verify_sig_fields=True), data)
+            self.assertEqual((sig['date_year'], sig['date_month'], sig['date_day']), (2024, 5, 31))
+            self.assertEqual(sig['isv_prod_id'], 1)
+            self.assertEqual(sig['exponent'], 3)
+            self.assertEqual(bytes(sig.get_view('enclave_hash')), sig['enclave_hash'])
+
+        tbs = get_tbssigstruct(self.sigfiles[0][:-len('.sig')] + '.manifest.sgx', DATE,
+                               self.libpal)
+        self.assertEqual(sig['enclave_hash'], tbs['enclave_hash'])
+        self.assertEqual(sig.get_signing_data(), tbs.get_signing_data())
+
+    def test_010_verify_signature(self):
+        for path in self.sigfiles:
+            self.assertTrue(Sigstruct.from_file(path).verify_signature())
+
+    def test_020_verify_signature_corrupted(self):
+        for offset in (offs.SGX_ARCH_SIGSTRUCT_ENCLAVE_HASH, offs.SGX_ARCH_SIGSTRUCT_ISV_SVN,
+                       offs.SGX_ARCH_SIGSTRUCT_SIGNATURE + 100, offs.SGX_ARCH_SIGSTRUCT_Q1 + 1,
+                       offs.SGX_ARCH_SIGSTRUCT_Q2 + 383):
+            with self.subTest(offset=offset):
+                data = bytearray(self.read_sigfile())
+                data[offset] ^= 1
+                self.assertFalse(Sigstruct.from_bytes(data).verify_signature())
+
+    def test_030_set_fields(self):
+        sig = Sigstruct()
+        sig['enclave_hash'] = b'short'
+        sig['date_year'] = 2024
+        sig['isv_svn'] = 7
+        # values are returned as they were set
+        self.assertEqual(sig['enclave_hash'], b'short')
+        self.assertEqual(sig['date_year'], 2024)
+        self.assertEqual(sig['isv_svn'], 7)
+        self.assertEqual(sig['header'], Sigstruct.defaults['header'])
+        self.assertNotIn('date_month', sig)
+        with self.assertRaises(KeyError):
+            sig['date_month'] # pylint: disable=pointless-statement
+        with self.assertRaises(KeyError):
+            sig['unknown'] = 0
+        with self.assertRaises(ValueError):
+            sig['isv_svn'] = 1 << 16
+        with self.assertRaises(ValueError):
+            sig['enclave_hash'] = 'not bytes'
+
+        # but are padded in the buffer
+        parsed = Sigstruct.from_bytes(sig.to_bytes(verify=False))
+        self.assertEqual(parsed['enclave_hash'], b'short' + bytes(27))
+        self.assertEqual(parsed['date_year'], 2024)
+
+    def run_sigstruct_view(self, *args):
+        # pylint: disable=subprocess-run-check
+        return subprocess.run(['gramine-sgx-sigstruct-view', *args], stdout=subprocess.PIPE,
+                              universal_newlines=True)
+
+    def test_100_bulk_ndjson(self):
+        result = self.run_sigstruct_view('--bulk', '--verify-signature', '-j', '2', self.sigdir)
+        self.assertEqual(result.returncode, 0)
+        records = [json.loads(line) for line in result.stdout.splitlines()]
+        self.assertEqual([record['path'] for record in records], self.sigfiles)
+        for record, path in zip(records, self.sigfiles):
+            sig = Sigstruct.from_file(path)
+            self.assertEqual(record['mr_enclave'], sig['enclave_hash'].hex())
+            self.assertEqual(record['isv_prod_id'], sig['isv_prod_id'])
+            self.assertIs(record['signature_valid'], True)
+
+    def test_110_bulk_csv(self):
+        bad = os.path.join(self.tmpdir, 'bad.sig')
+        with open(bad, 'wb') as file:
+            file.write(b'not a sigstruct')
+        self.addCleanup(os.remove, bad)
+
+        result = self.run_sigstruct_view('--bulk', '--output-format', 'csv', '-v', '-j', '2',
+                                         *self.sigfiles, bad)
+        self.assertEqual(result.returncode, 1)
+        records = list(csv.DictReader(io.StringIO(result.stdout)))
+        self.assertEqual([record['path'] for record in records], [*self.sigfiles, bad])
+        self.assertEqual([record['isv_prod_id'] for record in records], ['1', '2', ''])
+        self.assertEqual(records[0]['date'], '2024-05-31')
+        self.assertEqual(records[0]['error'], '')
+        self.assertTrue(records[2]['error'])
+
+    def test_120_bulk_invalid_signature(self):
+        data = bytearray(self.read_sigfile())
+        data[offs.SGX_ARCH_SIGSTRUCT_ENCLAVE_HASH] ^= 1
+        corrupted = os.path.join(self.tmpdir, 'corrupted.sig')
+        with open(corrupted, 'wb') as file:
+            file.write(data)
+        self.addCleanup(os.remove, corrupted)
+
+        result = self.run_sigstruct_view('--bulk', '--verify-signature', self.sigfiles[0],
+                                         corrupted)
+        self.assertEqual(result.returncode, 1)
+        records = [json.loads(line) for line in result.stdout.splitlines()]
+        self.assertEqual([record['signature_valid'] for record in records], [True, False])
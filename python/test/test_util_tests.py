@@ -0,0 +1,258 @@
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (C) 2024 Intel Corporation
+
+import contextlib
+import io
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import tomli_w
+
+from graminelibos import _CONFIG_SGX_ENABLED, util_tests
+from graminelibos.util_tests import (
+    ContentHashes, InProcessBuilder, read_depfile, sign_test_manifest,
+)
+
+def write_file(path, data):
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(data)
+
+def touch(*paths):
+    '''Change the mtimes of *paths*, as if they were written again with the same contents.'''
+    for path in paths:
+        os.utime(path, (time.time() + 100, time.time() + 100))
+
+class TC_00_ContentHashes(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.content_hashes = ContentHashes(self.tmpdir / 'hashes')
+        self.addCleanup(self.content_hashes.close)
+
+        self.outputs = [self.tmpdir / 'out1', self.tmpdir / 'out2']
+        self.inputs = [self.tmpdir / 'in', self.tmpdir / 'dir']
+        (self.tmpdir / 'dir').mkdir()
+        for path in [*self.outputs, self.inputs[0], self.tmpdir / 'dir' / 'file']:
+            write_file(path, path.name)
+
+    def test_000_unchanged(self):
+        self.assertFalse(self.content_hashes.is_unchanged(self.outputs, self.inputs))
+        # path-like objects and strings are interchangeable
+        self.content_hashes.record(self.outputs, self.inputs)
+        self.assertTrue(self.content_hashes.is_unchanged(self.outputs, self.inputs))
+        self.assertTrue(self.content_hashes.is_unchanged([str(path) for path in self.outputs],
+                                                         [str(path) for path in self.inputs]))
+
+    def test_010_mtime_changed(self):
+        self.content_hashes.record(self.outputs, self.inputs)
+        touch(*self.outputs, *self.inputs, self.tmpdir / 'dir' / 'file')
+        self.assertTrue(self.content_hashes.is_unchanged(self.outputs, self.inputs))
+
+    def test_020_changed(self):
+        self.content_hashes.record(self.outputs, self.inputs)
+        write_file(self.inputs[0], 'changed')
+        self.assertFalse(self.content_hashes.is_unchanged(self.outputs, self.inputs))
+
+    def test_030_dir_changed(self):
+        self.content_hashes.record(self.outputs, self.inputs)
+        write_file(self.tmpdir / 'dir' / 'new', '')
+        self.assertFalse(self.content_hashes.is_unchanged(self.outputs, self.inputs))
+
+    def test_040_output_removed(self):
+        self.content_hashes.record(self.outputs, self.inputs)
+        self.outputs[1].unlink()
+        self.assertFalse(self.content_hashes.is_unchanged(self.outputs, self.inputs))
+
+    def test_050_new_input(self):
+        self.content_hashes.record(self.outputs, self.inputs)
+        self.assertFalse(self.content_hashes.is_unchanged(self.outputs,
+                                                          [*self.inputs, self.tmpdir / 'new']))
+
+class TC_01_Depfile(unittest.TestCase):
+    def test_000_read_depfile(self):
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8') as file:
+            file.write('out.manifest.sgx: \\\n\t/a/b \\\n\t/with\\ space\\ \\\n\t/c\n')
+            file.flush()
+            self.assertEqual(read_depfile(file.name), ['/a/b', '/with space ', '/c'])
+
+@unittest.skipUnless(_CONFIG_SGX_ENABLED, 'requires Gramine built with SGX')
+class TC_10_SignTestManifest(unittest.TestCase):
+    '''What `gramine-test sgx-sign` does.'''
+
+    @classmethod
+    def setUpClass(cls):
+        # pylint: disable=import-outside-toplevel
+        from graminelibos.sgx_sign import generate_private_key_pem
+        cls.key_pem = generate_private_key_pem()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.content_hashes = ContentHashes(os.path.join(self.tmpdir, 'hashes'))
+        self.addCleanup(self.content_hashes.close)
+
+        self.key = os.path.join(self.tmpdir, 'key.pem')
+        with open(self.key, 'wb') as file:
+            file.write(self.key_pem)
+
+        self.trusted_dir = os.path.join(self.tmpdir, 'trusted')
+        os.mkdir(self.trusted_dir)
+        write_file(os.path.join(self.trusted_dir, 'a'), 'a')
+        write_file(os.path.join(self.trusted_dir, 'b'), 'b')
+
+        self.manifest = os.path.join(self.tmpdir, 'test.manifest')
+        with open(self.manifest, 'wb') as file:
+            tomli_w.dump({'sgx': {
+                'enclave_size': '64M',
+                'max_threads': 2,
+                'trusted_files': [f'file:{self.trusted_dir}/'],
+            }}, file)
+        self.output = os.path.join(self.tmpdir, 'test.manifest.sgx')
+        self.sigfile = os.path.join(self.tmpdir, 'test.sig')
+
+    def sign(self, **kwargs):
+        return sign_test_manifest(self.manifest, self.output, self.sigfile, self.key,
+                                  content_hashes=self.content_hashes, **kwargs)
+
+    def stat_outputs(self):
+        ret = []
+        for path in (self.output, self.sigfile, f'{self.output}.d'):
+            with open(path, 'rb') as file:
+                ret.append((os.stat(path).st_mtime_ns, file.read()))
+        return ret
+
+    def test_000_mtime_changed(self):
+        self.assertTrue(self.sign())
+        outputs = self.stat_outputs()
+
+        touch(self.manifest, self.key, self.trusted_dir, *(
+            os.path.join(self.trusted_dir, name) for name in os.listdir(self.trusted_dir)))
+        self.assertFalse(self.sign())
+        self.assertEqual(self.stat_outputs(), outputs)
+
+        self.assertTrue(self.sign(force=True))
+
+    def test_010_contents_changed(self):
+        self.assertTrue(self.sign())
+        outputs = self.stat_outputs()
+
+        write_file(os.path.join(self.trusted_dir, 'b'), 'changed')
+        self.assertTrue(self.sign())
+        new_outputs = self.stat_outputs()
+        # both the manifest (with the new hash) and SIGSTRUCT (with new MRENCLAVE) changed
+        self.assertNotEqual(new_outputs[0][1], outputs[0][1])
+        self.assertNotEqual(new_outputs[1][1], outputs[1][1])
+
+        self.assertFalse(self.sign())
+
+    def test_020_file_added(self):
+        self.assertTrue(self.sign())
+        write_file(os.path.join(self.trusted_dir, 'c'), 'c')
+        self.assertTrue(self.sign())
+        with open(f'{self.output}.d', 'r', encoding='utf-8') as file:
+            self.assertIn(os.path.join(self.trusted_dir, 'c'), file.read())
+
+    def test_030_output_removed(self):
+        self.assertTrue(self.sign())
+        os.unlink(self.sigfile)
+        self.assertTrue(self.sign())
+
+@unittest.skipUnless(_CONFIG_SGX_ENABLED, 'requires Gramine built with SGX')
+class TC_20_InProcessBuilder(unittest.TestCase):
+    NAMES = ('m1', 'm2')
+    TEMPLATE = """
+        [sgx]
+        enclave_size = "64M"
+        max_threads = 2
+        trusted_files = ["file:{trusted_file}"]
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        # pylint: disable=import-outside-toplevel
+        from graminelibos.sgx_sign import generate_private_key_pem
+        cls.key_pem = generate_private_key_pem()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        # the builder works in the current directory, like Ninja
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.tmpdir)
+
+        with open('key.pem', 'wb') as file:
+            file.write(self.key_pem)
+        with open('tests.toml', 'wb') as file:
+            tomli_w.dump({'sgx': {'manifests': list(self.NAMES)}}, file)
+        for name in self.NAMES:
+            # a space in the path checks that depfiles are escaped properly
+            trusted_file = os.path.join(self.tmpdir, f'data {name}')
+            write_file(trusted_file, name)
+            write_file(f'{name}.manifest.template', self.TEMPLATE.format(trusted_file=trusted_file))
+
+        env = {**os.environ, 'SGX_SIGNER_KEY': os.path.join(self.tmpdir, 'key.pem')}
+        with mock.patch.dict(os.environ, env):
+            # not imported directly, so that pytest doesn't try to collect it
+            self.config = util_tests.TestConfig('tests.toml')
+
+        # pretend that tokens are needed, without asking AESMD for them
+        for name, value in (('is_oot', lambda: True), ('get_token', lambda sig: b'token')):
+            patcher = mock.patch(f'graminelibos.sgx_get_token.{name}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def build(self, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            InProcessBuilder(self.config, jobs=2, **kwargs).build(sgx=True)
+
+    def get_mtimes(self):
+        return {path: os.stat(path).st_mtime_ns for name in self.NAMES
+                for path in (f'{name}.manifest', f'{name}.manifest.sgx', f'{name}.manifest.sgx.d',
+                             f'{name}.sig', f'{name}.token')}
+
+    def assertRebuilt(self, old_mtimes, *paths):
+        new_mtimes = self.get_mtimes()
+        self.assertEqual(sorted(path for path in new_mtimes
+                                if new_mtimes[path] != old_mtimes[path]),
+                         sorted(paths))
+
+    def test_000_build(self):
+        self.build()
+        mtimes = self.get_mtimes()
+        self.build()
+        self.assertRebuilt(mtimes)
+
+    def test_010_trusted_file_touched(self):
+        self.build()
+        mtimes = self.get_mtimes()
+        touch(os.path.join(self.tmpdir, 'data m1'))
+        self.build()
+        self.assertRebuilt(mtimes, 'm1.manifest.sgx', 'm1.manifest.sgx.d', 'm1.sig', 'm1.token')
+
+    def test_020_template_touched(self):
+        self.build()
+        mtimes = self.get_mtimes()
+        touch('m2.manifest.template')
+        self.build()
+        self.assertRebuilt(mtimes, 'm2.manifest', 'm2.manifest.sgx', 'm2.manifest.sgx.d',
+                           'm2.sig', 'm2.token')
+
+    def test_030_content_hashes(self):
+        with ContentHashes(os.path.join(self.tmpdir, 'hashes')) as content_hashes:
+            self.build(content_hashes=content_hashes)
+            mtimes = self.get_mtimes()
+
+            # only mtime changed, so nothing is signed again
+            touch(os.path.join(self.tmpdir, 'data m1'))
+            self.build(content_hashes=content_hashes)
+            self.assertRebuilt(mtimes)
+
+            write_file(os.path.join(self.tmpdir, 'data m1'), 'changed')
+            self.build(content_hashes=content_hashes)
+            self.assertRebuilt(mtimes, 'm1.manifest.sgx', 'm1.manifest.sgx.d', 'm1.sig',
+                               'm1.token')
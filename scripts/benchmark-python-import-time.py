@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-3.0-or-later
+# Copyright (C) 2024 Intel Corporation
+
+'''
+Measure how long it takes to import graminelibos in Python tools.
+
+Every import statement is run in a fresh interpreter many times, and the median time (minus the
+startup time of an empty interpreter) is reported. With ``--budget``, the script fails if any of the
+statements takes longer than that, so it can be used to catch regressions.
+
+The installed graminelibos is used. To benchmark the one from the source tree, run with
+``PYTHONPATH=python GRAMINE_IMPORT_FOR_SPHINX_ANYWAY=1`` (note that it requires
+``_graminelibos_offsets`` from a build directory for the SGX-specific statements).
+'''
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+# Imports done by the tools which are run by Ninja (and which don't render templates)
+STATEMENTS = {
+    'graminelibos': 'import graminelibos',
+    'gramine-gen-depend': 'from graminelibos import Manifest, _CONFIG_PKGLIBDIR',
+}
+
+# Same, but only available if Gramine was built with SGX
+SGX_STATEMENTS = {
+    'gramine-sgx-sigstruct-view': 'from graminelibos.sigstruct import Sigstruct',
+    'gramine-sgx-get-token': 'from graminelibos.sgx_get_token import get_token, is_oot; '
+                             'from graminelibos.sigstruct import Sigstruct',
+}
+
+argparser = argparse.ArgumentParser()
+argparser.add_argument('--python', default=sys.executable,
+    help='Python interpreter to use (default: %(default)s)')
+argparser.add_argument('--repeat', '-n', type=int, default=20,
+    help='number of runs of each statement (default: %(default)s)')
+argparser.add_argument('--budget', type=float,
+    help='maximum allowed import time, in milliseconds')
+argparser.add_argument('statements', nargs='*', metavar='NAME',
+    help='statements to measure (default: all of: '
+         f'{", ".join([*STATEMENTS, *SGX_STATEMENTS])}; the SGX ones only if SGX is enabled)')
+
+def measure(python, statement, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([python, '-c', statement], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def sgx_enabled(python):
+    result = subprocess.run([python, '-c', 'import graminelibos; '
+        'print(graminelibos._CONFIG_SGX_ENABLED)'], stdout=subprocess.PIPE, check=True)
+    return result.stdout.strip() == b'True'
+
+def main(args=None):
+    args = argparser.parse_args(args)
+    statements = {**STATEMENTS, **SGX_STATEMENTS}
+    for name in args.statements:
+        if name not in statements:
+            argparser.error(f'unknown statement: {name}')
+    if not args.statements and not sgx_enabled(args.python):
+        statements = STATEMENTS
+
+    baseline = measure(args.python, 'pass', args.repeat)
+    print(f'{"interpreter startup":30} {baseline * 1000:8.1f} ms')
+
+    ret = 0
+    for name in args.statements or statements:
+        elapsed = measure(args.python, statements[name], args.repeat) - baseline
+        over_budget = args.budget is not None and elapsed * 1000 > args.budget
+        print(f'{name:30} {elapsed * 1000:8.1f} ms{"  (over budget)" if over_budget else ""}')
+        if over_budget:
+            ret = 1
+    return ret
+
+if __name__ == '__main__':
+    sys.exit(main())